@@ -0,0 +1,726 @@
+# asgi.py - Modo de servicio asíncrono (ASGI) de Price Finder USA
+"""Punto de entrada ASGI: la búsqueda (/api/search y los jobs que usa la
+página, con su polling y su stream SSE) y /auth/login se atienden con E/S
+asíncrona (httpx para SerpAPI y Firebase, Gemini async) y el resto de rutas
+se delegan a la app Flask de webapp.py a través de un adaptador WSGI.
+
+Un solo worker mantiene cientos de búsquedas en curso sin un hilo por
+petición. Las búsquedas idénticas se comparten dentro del proceso y, con la
+caché en SQLite, entre workers mediante el mismo lease que el modo síncrono. Caché, limitador de tasa, circuit breaker, histórico y agrupado
+son los mismos objetos que usa el modo síncrono; la sesión es la cookie
+firmada de Flask, por lo que ambos modos son intercambiables. Las llamadas
+bloqueantes de esos objetos (SQLite, agrupado, JWKS, plantillas) se hacen
+con asyncio.to_thread en un pool propio (ASGI_BLOCKING_THREADS).
+
+Uso:
+  pip install httpx uvicorn a2wsgi
+  uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 1
+
+Detrás de un proxy (p. ej. Render) TRUSTED_PROXY_HOPS indica cuántos hay de
+confianza; la IP del cliente se toma entonces de X-Forwarded-For.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from flask import render_template, url_for
+from itsdangerous import BadSignature
+from werkzeug.formparser import parse_form_data
+from werkzeug.http import dump_cookie, parse_cookie
+
+from webapp import (
+    app as flask_app, log, price_finder, firebase_auth, login_throttle,
+    search_jobs, SearchJobManager,
+    LOG_SAMPLE_RATE, HTTP_IN_FLIGHT, HTTP_LATENCY,
+    request_id_var, request_timings_var, log_context_var,
+    timed, record_phase, record_upstream_response, bind_log_context,
+    analyze_image_with_gemini_async, parse_search_input, store_last_search,
+    record_login_result, touch_session, forwarded_client_ip,
+)
+
+# ==============================================================================
+# CLIENTE HTTP ASÍNCRONO (keep-alive + pool compartido)
+# ==============================================================================
+
+class AsyncHttpClient:
+    """httpx.AsyncClient compartido; se crea dentro del event loop que lo usa"""
+    def __init__(self, max_connections=200, max_keepalive=50, retries=2):
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        # Reintenta solo errores de conexión: 429/5xx los gestiona el circuit breaker
+        self.retries = retries
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(limits=self.limits, retries=self.retries))
+        return self._client
+
+    async def get(self, url, **kwargs):
+        return await self.client.get(url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.client.post(url, **kwargs)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+# httpx registra cada URL (con la API key de SerpAPI) a nivel INFO
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+async_http_client = AsyncHttpClient(
+    max_connections=int(os.environ.get('ASGI_HTTP_MAX_CONNECTIONS', 200)),
+    max_keepalive=int(os.environ.get('ASGI_HTTP_MAX_KEEPALIVE', 50)),
+    retries=int(os.environ.get('HTTP_RETRIES', 2))
+)
+
+# ==============================================================================
+# BÚSQUEDA ASÍNCRONA (mismos pasos que PriceFinder.search_products)
+# ==============================================================================
+
+class AsyncPriceFinder:
+    """Búsqueda de PriceFinder con E/S asíncrona; solo cambian las llamadas a upstreams"""
+    def __init__(self, finder, client):
+        self.finder = finder
+        self.client = client
+        # Single-flight dentro del proceso; entre workers, _leased usa el lease de SingleFlight
+        self._flights = {}
+
+    @timed('serpapi')
+    async def _make_api_request(self, engine, query):
+        finder = self.finder
+        if not finder.api_key:
+            return None
+
+        params = finder._build_params(engine, query)
+        # Con SERPAPI_RATE_SHARED la reserva es una transacción en SQLite
+        wait = await asyncio.to_thread(finder._admit_request, engine)
+        if wait is None:
+            return None
+        if wait > 0:
+            await asyncio.sleep(wait)
+        failed = True
+        try:
+            response = await self.client.get(
+                finder.base_url, params=params,
+                timeout=httpx.Timeout(finder.timeouts['read'], connect=finder.timeouts['connect'])
+            )
+            failed = finder._upstream_failed(response)
+            if response.status_code != 200:
+                return None
+            return response.json()
+        except Exception as e:
+            log.error('Error en request a SerpAPI', engine=engine, error=str(e))
+            return None
+        finally:
+            finder.circuit_breaker.record(failed)
+
+    async def _query_engine(self, engine, final_query):
+        data = await self._make_api_request(engine, self.finder._engine_query(engine, final_query))
+        return self.finder._process_results(data, engine, final_query)
+
+    def _partial_results(self, products):
+        return self.finder.clusterer.cluster(self.finder._dedupe_products(products))
+
+    async def _search_engines(self, final_query, engines, progress=None):
+        """Consulta los motores a la vez y devuelve lo que llegue antes del límite"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.finder.search_deadline
+        tasks = {asyncio.create_task(self._query_engine(engine, final_query)): engine for engine in engines}
+        pending = set(tasks)
+        all_products = []
+        while pending:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    all_products.extend(task.result())
+                except Exception as e:
+                    log.error('Error en motor', engine=tasks[task], error=str(e))
+            if progress and done and all_products:
+                await progress('partial_results', await asyncio.to_thread(self._partial_results, all_products))
+        if pending:
+            log.warning('Límite de tiempo alcanzado - resultados parciales', deadline=self.finder.search_deadline,
+                        pending=[tasks[t] for t in pending])
+            for task in pending:
+                task.cancel()
+        return self.finder._dedupe_products(all_products)
+
+    async def _fetch_products(self, cache_key, final_query, engines, progress=None):
+        products = await self._search_engines(final_query, engines, progress)
+        # Agrupar y escribir en la caché es CPU + SQLite
+        return await asyncio.to_thread(self.finder._store_results, cache_key, final_query, products)
+
+    async def _leased(self, key, fetch):
+        """Igual que SingleFlight._run_leader: entre workers, el lease en SQLite
+        decide quién consulta y el resto espera el resultado en la caché"""
+        flights = self.finder.single_flight
+        if flights.db is None:
+            return await fetch()
+        deadline = time.time() + flights.wait_timeout
+        while not await asyncio.to_thread(flights._acquire_lease, key):
+            flights.remote_waits += 1
+            await asyncio.sleep(flights.poll_interval)
+            result = await asyncio.to_thread(self.finder._poll_fresh, key)
+            if result is not None:
+                return result
+            if time.time() >= deadline:
+                flights.timeouts += 1
+                return await fetch()
+        try:
+            # Otro worker pudo publicar justo antes de soltar su lease
+            result = await asyncio.to_thread(self.finder._poll_fresh, key)
+            return result if result is not None else await fetch()
+        finally:
+            await asyncio.to_thread(flights._release_lease, key)
+
+    async def _single_flight(self, key, fetch):
+        # La consulta corre en su propia tarea: si el cliente que la inició se desconecta, las demás siguen esperándola
+        task = self._flights.get(key)
+        if task is None:
+            self.finder.single_flight.leaders += 1
+            task = asyncio.create_task(self._leased(key, fetch))
+            self._flights[key] = task
+            task.add_done_callback(lambda _: self._flights.pop(key, None))
+            return await asyncio.shield(task)
+        self.finder.single_flight.coalesced += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.finder.single_flight.wait_timeout)
+        except asyncio.TimeoutError:
+            log.warning('Tiempo de espera agotado en búsqueda compartida', sample=LOG_SAMPLE_RATE)
+            return None
+
+    async def search_products(self, query=None, image_content=None, engines=None, progress=None, user_id=None):
+        """progress(fase, productos), si se pasa, es una corrutina (mismas fases que el modo síncrono)"""
+        finder = self.finder
+        analyzed = finder._needs_image_analysis(image_content)
+        image_query = None
+        if analyzed:
+            if progress:
+                await progress('analyzing_image', None)
+            image_query = await analyze_image_with_gemini_async(image_content)
+        final_query, search_source = finder._resolve_query(query, analyzed, image_query)
+
+        if not final_query or len(final_query.strip()) < 2:
+            return finder._get_examples("producto")
+
+        final_query = final_query.strip()
+        bind_log_context(search_source=search_source)
+        log.info('Búsqueda final', sample=LOG_SAMPLE_RATE, query=final_query)
+
+        if not finder.api_key:
+            log.warning('Sin API key - usando ejemplos')
+            return finder._get_examples(final_query)
+
+        engines = engines or finder.engines
+        cache_key, products = await asyncio.to_thread(finder._cached_products, final_query, engines)
+        if products is None:
+            if progress:
+                await progress('querying_engines', None)
+            products = await self._single_flight(cache_key, lambda: self._fetch_products(cache_key, final_query, engines, progress))
+            if products is None:
+                products = finder._get_examples(final_query)
+
+        # _annotate guarda la consulta para sugerencias en SQLite
+        return await asyncio.to_thread(finder._annotate, products, query, search_source, user_id)
+
+async_price_finder = AsyncPriceFinder(price_finder, async_http_client)
+
+class AsyncSearchJobs:
+    """Jobs de búsqueda de SearchJobManager ejecutados como tareas del event
+    loop en lugar de en su pool de hilos. La cola, la tabla y los límites son
+    los mismos; además se avisa a los streams SSE de este proceso en cuanto
+    un job cambia, sin esperar al siguiente sondeo de SQLite.
+    """
+    def __init__(self, jobs, finder, max_pending=512):
+        self.jobs = jobs
+        self.finder = finder
+        # Una tarea pendiente cuesta poco más que su estado: el límite es mayor que con hilos
+        self.max_pending = max_pending
+        self._tasks = set()
+        self._changed = {}
+
+    async def submit(self, user_id, query, image_content, meta):
+        """ID del job o None si la cola está llena"""
+        if not self.jobs._reserve(self.max_pending):
+            return None
+        try:
+            job_id = await asyncio.to_thread(self.jobs._create, user_id, meta)
+        except BaseException:
+            self.jobs._release()
+            raise
+        self._changed[job_id] = asyncio.Event()
+        # La tarea hereda el contexto de la petición (ID y usuario en los logs)
+        task = asyncio.create_task(self._run(job_id, user_id, query, image_content))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job_id
+
+    async def _update(self, job_id, status, products=None, error=None):
+        await asyncio.to_thread(self.jobs._update, job_id, status, products, error)
+        event = self._changed.pop(job_id, None)
+        if event is not None:
+            if status not in SearchJobManager.FINISHED:
+                self._changed[job_id] = asyncio.Event()
+            event.set()
+
+    async def _run(self, job_id, user_id, query, image_content):
+        try:
+            progress = lambda phase, products: self._update(job_id, phase, products)
+            products = await self.finder.search_products(query=query, image_content=image_content,
+                                                         progress=progress, user_id=user_id)
+            await self._update(job_id, 'done', products)
+        except Exception as e:
+            log.error('Error en job de búsqueda', job_id=job_id, error=str(e))
+            await self._update(job_id, 'error', price_finder._get_examples(query or 'producto'), 'Error en la búsqueda')
+        finally:
+            self.jobs._release()
+
+    async def get(self, job_id):
+        return await asyncio.to_thread(self.jobs.get, job_id)
+
+    def changed(self, job_id):
+        """Evento que se activa en el próximo cambio del job, o None si no corre en este proceso"""
+        return self._changed.get(job_id)
+
+    async def wait_change(self, event, poll):
+        """Espera al evento del job; los jobs de otros workers se sondean cada `poll` segundos"""
+        if event is None:
+            await asyncio.sleep(poll)
+            return
+        try:
+            await asyncio.wait_for(event.wait(), timeout=5.0)
+        except asyncio.TimeoutError:
+            pass
+
+async_search_jobs = AsyncSearchJobs(
+    search_jobs, async_price_finder,
+    max_pending=int(os.environ.get('ASGI_SEARCH_JOB_QUEUE_MAX', 512))
+)
+
+@timed('firebase_login')
+async def login_user_async(email, password):
+    """Versión asíncrona de FirebaseAuth.login_user"""
+    if not firebase_auth.firebase_web_api_key:
+        return {'success': False, 'message': 'Servicio no configurado', 'user_data': None, 'error_code': 'SERVICE_NOT_CONFIGURED'}
+
+    url, payload = firebase_auth.sign_in_request(email, password)
+    try:
+        response = await async_http_client.post(url, json=payload, timeout=8)
+        record_upstream_response('firebase', response)
+    except Exception as e:
+        log.error('Error de Firebase Auth', error=str(e))
+        return {'success': False, 'message': 'Error interno del servidor', 'user_data': None, 'error_code': 'UNEXPECTED_ERROR'}
+    return firebase_auth.login_result(response, email)
+
+# ==============================================================================
+# PETICIÓN, SESIÓN Y RESPUESTA (compatibles con la app Flask)
+# ==============================================================================
+
+class SessionCodec:
+    """Lee y escribe la cookie de sesión firmada de Flask"""
+    def __init__(self, app):
+        self.app = app
+        self.interface = app.session_interface
+        self.serializer = self.interface.get_signing_serializer(app)
+        self.max_age = int(app.permanent_session_lifetime.total_seconds())
+
+    def load(self, cookie_header):
+        value = parse_cookie(cookie_header).get(self.interface.get_cookie_name(self.app))
+        if not value:
+            return self.interface.session_class()
+        try:
+            return self.interface.session_class(self.serializer.loads(value, max_age=self.max_age))
+        except BadSignature:
+            return self.interface.session_class()
+
+    def set_cookie_header(self, sess):
+        """Valor de Set-Cookie para la sesión, o None si no hay que enviarla"""
+        app, interface = self.app, self.interface
+        options = {
+            'domain': interface.get_cookie_domain(app),
+            'path': interface.get_cookie_path(app),
+            'secure': interface.get_cookie_secure(app),
+            'httponly': interface.get_cookie_httponly(app),
+            'samesite': interface.get_cookie_samesite(app),
+        }
+        name = interface.get_cookie_name(app)
+        if not sess:
+            return dump_cookie(name, '', expires=0, max_age=0, **options) if sess.modified else None
+        if not interface.should_set_cookie(app, sess):
+            return None
+        return dump_cookie(name, self.serializer.dumps(dict(sess)), expires=interface.get_expiration_time(app, sess), **options)
+
+session_codec = SessionCodec(flask_app)
+
+with flask_app.test_request_context():
+    URLS = {'index': url_for('index'), 'login_page': url_for('auth_login_page')}
+
+# Los jobs se siguen aquí sin ocupar hilos: la página puede usar SSE
+flask_app.config['SEARCH_JOB_SSE'] = True
+
+def job_urls(job_id):
+    with flask_app.test_request_context():
+        return {
+            'status_url': url_for('api_search_job_status', job_id=job_id),
+            'events_url': url_for('api_search_job_events', job_id=job_id),
+        }
+
+class AsyncRequest:
+    def __init__(self, scope, body, sess, path_params=None):
+        self.scope = scope
+        self.path = scope['path']
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+        self.body = body
+        self.session = sess
+        self.path_params = path_params or {}
+        # La IP del cliente sale de X-Forwarded-For con TRUSTED_PROXY_HOPS, igual que en la app Flask
+        self.remote_addr = forwarded_client_ip(scope['client'][0] if scope.get('client') else None,
+                                               self.headers.get('x-forwarded-for'))
+
+    def form(self):
+        """(form, files) parseados con werkzeug, igual que request.form / request.files.
+        Es CPU (multipart): se llama con asyncio.to_thread"""
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': self.headers.get('content-type', ''),
+            'CONTENT_LENGTH': str(len(self.body)),
+            'wsgi.input': io.BytesIO(self.body),
+        }
+        _, form, files = parse_form_data(environ)
+        return form, files
+
+def parse_search_body(request):
+    """(form, consulta, imagen, tipo, error) de una petición de búsqueda"""
+    form, files = request.form()
+    return (form,) + parse_search_input(form, files)
+
+def flash(sess, message, category='message'):
+    flashes = sess.get('_flashes', [])
+    flashes.append((category, message))
+    sess['_flashes'] = flashes
+
+def json_response(payload, status=200):
+    return status, [('Content-Type', 'application/json')], json.dumps(payload).encode('utf-8')
+
+def redirect_response(location):
+    return 302, [('Location', location), ('Content-Type', 'text/html; charset=utf-8')], b''
+
+def render_page(template_name, sess, **context):
+    start = time.perf_counter()
+    with flask_app.test_request_context():
+        body = render_template(template_name, flashes=sess.pop('_flashes', []), **context)
+    record_phase('render_template', time.perf_counter() - start)
+    return body.encode('utf-8')
+
+def login_required(handler):
+    """Igual que webapp.login_required: sin sesión válida, aviso y redirección al login"""
+    async def decorated(request):
+        if not await is_logged_in(request.session):
+            flash(request.session, 'Tu sesion ha expirado. Inicia sesion nuevamente.', 'warning')
+            return redirect_response(URLS['login_page'])
+        return await handler(request)
+    return decorated
+
+async def is_logged_in(sess):
+    # Verificar el ID token puede descargar las claves de Google y renovarlo
+    # llama a Firebase y a SQLite: ambas cosas fuera del event loop
+    if firebase_auth.token_verifier is not None:
+        return await asyncio.to_thread(firebase_auth.is_user_logged_in, sess)
+    return firebase_auth.is_user_logged_in(sess)
+
+# ==============================================================================
+# RUTAS NATIVAS
+# ==============================================================================
+
+@login_required
+async def api_search(request):
+    sess = request.session
+    form = None
+    try:
+        # Parsear el multipart y decodificar la imagen es CPU: fuera del event loop
+        form, query, image_content, search_type, error = await asyncio.to_thread(parse_search_body, request)
+        if error:
+            return json_response({'success': False, 'error': error}, 400)
+
+        log.info('Solicitud de búsqueda', sample=LOG_SAMPLE_RATE, search_type=search_type)
+
+        products = await async_price_finder.search_products(query=query, image_content=image_content,
+                                                            user_id=sess.get('user_id'))
+        await asyncio.to_thread(store_last_search, query, products, search_type, sess=sess)
+
+        log.info('Búsqueda completada', sample=LOG_SAMPLE_RATE, results=len(products))
+        return json_response({'success': True, 'products': products, 'total': len(products)})
+
+    except Exception as e:
+        log.error('Error en búsqueda', error=str(e))
+        try:
+            query = form.get('query') if form is not None and form.get('query') else 'producto'
+            fallback = price_finder._get_examples(query)
+            await asyncio.to_thread(store_last_search, str(query), fallback, 'texto', sess=sess)
+            return json_response({'success': True, 'products': fallback, 'total': len(fallback)})
+        except Exception:
+            return json_response({'success': False, 'error': 'Error interno del servidor'}, 500)
+
+@login_required
+async def api_search_job_create(request):
+    """Encola la búsqueda y responde de inmediato con el ID del job"""
+    _, query, image_content, search_type, error = await asyncio.to_thread(parse_search_body, request)
+    if error:
+        return json_response({'success': False, 'error': error}, 400)
+
+    log.info('Solicitud de job de búsqueda', sample=LOG_SAMPLE_RATE, search_type=search_type)
+    job_id = await async_search_jobs.submit(request.session.get('user_id'), query, image_content,
+                                            {'query': query, 'search_type': search_type})
+    if job_id is None:
+        return json_response({'success': False, 'error': 'Servidor ocupado, intenta de nuevo en unos segundos'}, 503)
+    return json_response({'success': True, 'job_id': job_id, **job_urls(job_id)}, 202)
+
+async def job_for_current_user(request):
+    job = await async_search_jobs.get(request.path_params['job_id'])
+    if job is None or job['user_id'] != request.session.get('user_id'):
+        return None
+    return job
+
+@login_required
+async def api_search_job_status(request):
+    """Polling del estado; al terminar guarda los resultados para /results"""
+    job = await job_for_current_user(request)
+    if job is None:
+        return json_response({'success': False, 'error': 'Búsqueda no encontrada'}, 404)
+    done = job['status'] in SearchJobManager.FINISHED
+    if done:
+        await asyncio.to_thread(store_last_search, job['meta'].get('query'), job['products'],
+                                job['meta'].get('search_type', 'texto'),
+                                result_id=request.path_params['job_id'], sess=request.session)
+    return json_response({
+        'success': True,
+        'status': job['status'],
+        'done': done,
+        'products': job['products'],
+        'total': len(job['products'])
+    })
+
+@login_required
+async def api_search_job_events(request):
+    """Progreso por Server-Sent Events: cada stream es una corrutina, no un hilo"""
+    job_id = request.path_params['job_id']
+    if await job_for_current_user(request) is None:
+        return json_response({'success': False, 'error': 'Búsqueda no encontrada'}, 404)
+
+    async def stream():
+        last_update = None
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            # El evento se toma antes de leer para no perder un cambio entre ambas cosas
+            event = async_search_jobs.changed(job_id)
+            job = await async_search_jobs.get(job_id)
+            if job is None:
+                break
+            if job['updated_at'] != last_update:
+                last_update = job['updated_at']
+                payload = {'status': job['status'], 'total': len(job['products'])}
+                yield f"event: {job['status']}\ndata: {json.dumps(payload)}\n\n".encode('utf-8')
+                if job['status'] in SearchJobManager.FINISHED:
+                    return
+            await async_search_jobs.wait_change(event, poll=0.25)
+        yield b"event: timeout\ndata: {}\n\n"
+
+    return 200, [('Content-Type', 'text/event-stream; charset=utf-8'), ('X-Accel-Buffering', 'no')], stream()
+
+async def auth_login(request):
+    sess = request.session
+    form, _ = await asyncio.to_thread(request.form)
+    email = form.get('email', '').strip()
+    password = form.get('password', '').strip()
+
+    if not email or not password:
+        flash(sess, 'Por favor completa todos los campos.', 'danger')
+        return redirect_response(URLS['login_page'])
+
+    email_hash = hashlib.sha256(email.lower().encode('utf-8')).hexdigest()[:12]
+    client_ip = request.remote_addr or 'unknown'
+    retry_after = await asyncio.to_thread(login_throttle.attempt, client_ip, email)
+    if retry_after:
+        log.warning('Login limitado', email_hash=email_hash, retry_after=round(retry_after, 1))
+        flash(sess, f'Demasiados intentos. Intenta de nuevo en {int(retry_after) + 1} segundos.', 'danger')
+        headers = [('Content-Type', 'text/html; charset=utf-8'), ('Retry-After', str(int(retry_after) + 1))]
+        return 429, headers, await asyncio.to_thread(render_page, 'auth_login.html', sess)
+
+    log.info('Intento de login', email_hash=email_hash)
+    result = await login_user_async(email, password)
+    await asyncio.to_thread(record_login_result, client_ip, email, result)
+
+    if result['success']:
+        # Guarda el refresh token en SQLite
+        await asyncio.to_thread(firebase_auth.set_user_session, result['user_data'], sess)
+        flash(sess, result['message'], 'success')
+        log.info('Login correcto', user=result['user_data']['user_id'])
+        return redirect_response(URLS['index'])
+    flash(sess, result['message'], 'danger')
+    log.warning('Login fallido', email_hash=email_hash, error_code=result['error_code'])
+    return redirect_response(URLS['login_page'])
+
+NATIVE_ROUTES = {
+    ('POST', '/api/search'): ('api_search', api_search),
+    ('POST', '/api/search/jobs'): ('api_search_job_create', api_search_job_create),
+    ('POST', '/auth/login'): ('auth_login', auth_login),
+}
+
+# Rutas con parámetros: (método, patrón, endpoint, handler)
+NATIVE_PATTERNS = [
+    ('GET', re.compile(r'^/api/search/jobs/(?P<job_id>[^/]+)$'), 'api_search_job_status', api_search_job_status),
+    ('GET', re.compile(r'^/api/search/jobs/(?P<job_id>[^/]+)/events$'), 'api_search_job_events', api_search_job_events),
+]
+
+def match_route(method, path):
+    """(endpoint, handler, parámetros) de la ruta nativa, o None si la atiende Flask"""
+    route = NATIVE_ROUTES.get((method, path))
+    if route:
+        return route + ({},)
+    for route_method, pattern, endpoint, handler in NATIVE_PATTERNS:
+        match = pattern.match(path) if route_method == method else None
+        if match:
+            return endpoint, handler, match.groupdict()
+    return None
+
+# ==============================================================================
+# APLICACIÓN ASGI
+# ==============================================================================
+
+wsgi_app = WSGIMiddleware(flask_app, workers=int(os.environ.get('ASGI_WSGI_THREADS', 16)))
+
+# Pool de asyncio.to_thread: llamadas cortas a SQLite/CPU de las rutas nativas
+blocking_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ASGI_BLOCKING_THREADS', 32)),
+    thread_name_prefix='asgi-blocking'
+)
+
+async def read_body(receive, limit):
+    """Cuerpo completo de la petición; None si supera el límite"""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise asyncio.CancelledError()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def send_response(send, status, headers, body):
+    headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+    headers.append((b'content-length', str(len(body)).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def send_stream(send, receive, status, headers, chunks):
+    """Respuesta por trozos (SSE); se corta en cuanto el cliente se desconecta"""
+    headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    disconnected = asyncio.create_task(wait_disconnect(receive))
+    try:
+        while True:
+            next_chunk = asyncio.ensure_future(chunks.__anext__())
+            await asyncio.wait({next_chunk, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_chunk.done():
+                next_chunk.cancel()
+                await asyncio.wait({next_chunk})
+                return
+            try:
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        await chunks.aclose()
+
+async def handle_native(scope, receive, send, endpoint, handler, path_params):
+    """Equivalente a los before/after_request de webapp.py para las rutas nativas"""
+    request_start = time.perf_counter()
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+    request_id = headers.get('x-request-id') or uuid.uuid4().hex
+    timings = []
+    request_id_var.set(request_id)
+    request_timings_var.set(timings)
+    HTTP_IN_FLIGHT.inc()
+    try:
+        sess = session_codec.load(headers.get('cookie', ''))
+        touch_session(sess)
+        log_context_var.set({'request_id': request_id, 'user': sess.get('user_id'), 'path': scope['path']})
+        body = await read_body(receive, flask_app.config['MAX_CONTENT_LENGTH'])
+        if body is None:
+            status, response_headers, content = 413, [('Content-Type', 'text/html; charset=utf-8')], b'<h1>413 - Archivo demasiado grande</h1>'
+        else:
+            try:
+                status, response_headers, content = await handler(AsyncRequest(scope, body, sess, path_params))
+            except Exception as e:
+                log.error('Error no controlado', error=str(e))
+                status, response_headers = 500, [('Content-Type', 'text/html; charset=utf-8')]
+                content = b'<h1>500 - Error interno</h1><p><a href="/">Volver al inicio</a></p>'
+            cookie = session_codec.set_cookie_header(sess)
+            if cookie:
+                response_headers.append(('Set-Cookie', cookie))
+                response_headers.append(('Vary', 'Cookie'))
+    finally:
+        HTTP_IN_FLIGHT.dec()
+
+    elapsed = time.perf_counter() - request_start
+    HTTP_LATENCY.observe(elapsed, endpoint=endpoint, status=status)
+    server_timing = ', '.join(f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in timings)
+    response_headers += [
+        ('X-Content-Type-Options', 'nosniff'),
+        ('X-Frame-Options', 'DENY'),
+        ('Cache-Control', 'no-cache, no-store, must-revalidate'),
+        ('X-Request-ID', request_id),
+        ('Server-Timing', f'{server_timing}, total;dur={elapsed * 1000:.1f}' if server_timing else f'total;dur={elapsed * 1000:.1f}'),
+    ]
+    if isinstance(content, bytes):
+        await send_response(send, status, response_headers, content)
+    else:
+        await send_stream(send, receive, status, response_headers, content)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            asyncio.get_running_loop().set_default_executor(blocking_executor)
+            print("✅ Modo ASGI: búsqueda, jobs/SSE y login asíncronos, resto de rutas vía WSGI")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_http_client.aclose()
+            blocking_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http':
+        route = match_route(scope['method'], scope['path'])
+        if route:
+            return await handle_native(scope, receive, send, *route)
+    await wsgi_app(scope, receive, send)
@@ -0,0 +1,132 @@
+# bench_image_index.py - Búsqueda por distancia de Hamming en la caché de imágenes
+"""Compara el índice multi-tabla de ImageQueryCache (MultiIndexHashTable)
+con un BK-tree y con un recorrido lineal sobre dHashes de 64 bits.
+
+Las consultas son hashes guardados con algunos bits cambiados al azar
+(copias re-codificadas de una foto) y hashes nuevos (fallos de caché).
+Reporta el tiempo medio por búsqueda y comprueba que los tres métodos
+devuelven los mismos vecinos.
+
+Uso:
+  python bench/bench_image_index.py
+  python bench/bench_image_index.py --entries 200000 --queries 2000 --max-distance 6
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+# webapp abre su SQLite al importarse: que no toque el archivo del repositorio
+os.environ.setdefault('LOCAL_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='bench-index-'), 'bench.sqlite3'))
+
+from webapp import MultiIndexHashTable  # noqa: E402
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """BK-tree sobre la distancia de Hamming (alternativa descartada)"""
+    def __init__(self):
+        self.root = None
+
+    def add(self, value):
+        if self.root is None:
+            self.root = (value, {})
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (value, {})
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node_value, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                found.append((distance, node_value))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        found.sort()
+        return found
+
+
+def linear_search(values, value, max_distance):
+    return sorted((d, v) for v in values if (d := hamming(value, v)) <= max_distance)
+
+
+def make_queries(values, count, max_distance, rng):
+    queries = []
+    for i in range(count):
+        if i % 2:
+            queries.append(rng.getrandbits(64))
+            continue
+        value = rng.choice(values)
+        for bit in rng.sample(range(64), rng.randint(0, max_distance)):
+            value ^= 1 << bit
+        queries.append(value)
+    return queries
+
+
+def timed_lookups(search, queries):
+    start = time.perf_counter()
+    results = [search(query) for query in queries]
+    return (time.perf_counter() - start) / len(queries) * 1000, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entries', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--max-distance', type=int, default=6)
+    parser.add_argument('--linear-queries', type=int, default=200, help='el recorrido lineal es lento: menos consultas')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    values = [rng.getrandbits(64) for _ in range(args.entries)]
+    queries = make_queries(values, args.queries, args.max_distance, rng)
+
+    index = MultiIndexHashTable(args.max_distance)
+    tree = BKTree()
+    start = time.perf_counter()
+    for value in values:
+        index.add(value)
+    index_build = time.perf_counter() - start
+    start = time.perf_counter()
+    for value in values:
+        tree.add(value)
+    tree_build = time.perf_counter() - start
+
+    index_ms, index_results = timed_lookups(index.search, queries)
+    tree_ms, tree_results = timed_lookups(lambda q: tree.search(q, args.max_distance), queries)
+    linear = queries[:args.linear_queries]
+    linear_ms, linear_results = timed_lookups(lambda q: linear_search(values, q, args.max_distance), linear)
+
+    if index_results != tree_results or index_results[:len(linear)] != linear_results:
+        raise SystemExit('Los métodos no devuelven los mismos vecinos')
+
+    print(f'{args.entries} entradas, distancia <= {args.max_distance}, {args.queries} consultas '
+          f'(mitad vecinos de entradas guardadas, mitad nuevas)')
+    print(f"{'método':<14} {'ms/búsqueda':>12} {'construcción s':>15}")
+    print(f"{'multi-tabla':<14} {index_ms:>12.3f} {index_build:>15.2f}")
+    print(f"{'bk-tree':<14} {tree_ms:>12.3f} {tree_build:>15.2f}")
+    print(f"{'lineal':<14} {linear_ms:>12.3f} {'-':>15}")
+
+
+if __name__ == '__main__':
+    main()
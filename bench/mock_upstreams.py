@@ -0,0 +1,173 @@
+# mock_upstreams.py - Servidor local que simula SerpAPI, Gemini y Firebase Auth
+"""Reproduce respuestas grabadas con latencia y errores configurables.
+
+Rutas:
+  GET  /search                                   SerpAPI (shopping_results u organic_results según engine)
+  POST /v1/accounts:signInWithPassword           Firebase Auth (contraseña válida: --password)
+  POST /v1beta/models/<modelo>:generateContent   Gemini (transporte REST)
+  GET  /__stats                                  Contadores de llamadas por upstream
+  POST /__reset                                  Reinicia los contadores
+
+Uso:
+  python bench/mock_upstreams.py --port 8900 --serpapi-latency 350 --error-rate 0.02
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SHOPPING_ENGINES = ('google_shopping', 'bing_shopping')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+        return json.load(f)
+
+
+class UpstreamProfile:
+    """Latencia log-normal (mediana en ms + sigma) y tasa de errores de un upstream"""
+    def __init__(self, median_ms, sigma, error_rate):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+
+    def delay(self):
+        if self.median_ms <= 0:
+            return 0.0
+        return random.lognormvariate(0, self.sigma) * self.median_ms / 1000.0
+
+    def should_fail(self):
+        return random.random() < self.error_rate
+
+
+class MockState:
+    def __init__(self, profiles, password):
+        self.profiles = profiles
+        self.password = password
+        self.shopping = load_fixture('serpapi_shopping.json')
+        self.organic = load_fixture('serpapi_organic.json')
+        self.gemini = load_fixture('gemini_generate.json')
+        self.firebase = load_fixture('firebase_sign_in.json')
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {'serpapi': 0, 'gemini': 0, 'firebase': 0}
+            self.errors = {'serpapi': 0, 'gemini': 0, 'firebase': 0}
+            self.engines = {}
+
+    def record(self, upstream, failed, engine=None):
+        with self.lock:
+            self.calls[upstream] += 1
+            self.errors[upstream] += failed
+            if engine:
+                self.engines[engine] = self.engines.get(engine, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'errors': dict(self.errors), 'engines': dict(self.engines)}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _simulate(self, upstream, engine=None):
+        profile = self.state.profiles[upstream]
+        time.sleep(profile.delay())
+        failed = profile.should_fail()
+        self.state.record(upstream, failed, engine)
+        if failed:
+            self._send_json(503, {'error': {'code': 503, 'message': 'UNAVAILABLE', 'status': 'UNAVAILABLE'}})
+        return failed
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/__stats':
+            return self._send_json(200, self.state.snapshot())
+        if url.path == '/search':
+            engine = parse_qs(url.query).get('engine', ['google_shopping'])[0]
+            if self._simulate('serpapi', engine):
+                return
+            return self._send_json(200, self.state.shopping if engine in SHOPPING_ENGINES else self.state.organic)
+        self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self._read_body()
+        if url.path == '/__reset':
+            self.state.reset()
+            return self._send_json(200, {'ok': True})
+        if url.path.endswith(':signInWithPassword'):
+            if self._simulate('firebase'):
+                return
+            payload = json.loads(body or b'{}')
+            if payload.get('password') != self.state.password:
+                return self._send_json(400, {'error': {'code': 400, 'message': 'INVALID_PASSWORD'}})
+            response = dict(self.state.firebase, email=payload.get('email', self.state.firebase['email']))
+            return self._send_json(200, response)
+        if url.path.endswith(':generateContent'):
+            if self._simulate('gemini'):
+                return
+            return self._send_json(200, self.state.gemini)
+        self._send_json(404, {'error': 'not found'})
+
+
+def build_server(host='127.0.0.1', port=8900, password='bench-password', serpapi_latency=350,
+                 gemini_latency=1200, firebase_latency=150, sigma=0.35, error_rate=0.0):
+    """Crea el servidor simulado (sin arrancarlo)"""
+    profiles = {
+        'serpapi': UpstreamProfile(serpapi_latency, sigma, error_rate),
+        'gemini': UpstreamProfile(gemini_latency, sigma, error_rate),
+        'firebase': UpstreamProfile(firebase_latency, sigma, error_rate),
+    }
+    handler = type('BoundMockHandler', (MockHandler,), {'state': MockState(profiles, password)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upstreams simulados para benchmarks de Price Finder')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--password', default='bench-password')
+    parser.add_argument('--serpapi-latency', type=float, default=350, help='mediana en ms')
+    parser.add_argument('--gemini-latency', type=float, default=1200, help='mediana en ms')
+    parser.add_argument('--firebase-latency', type=float, default=150, help='mediana en ms')
+    parser.add_argument('--sigma', type=float, default=0.35, help='dispersión log-normal de la latencia')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fracción de respuestas 503')
+    args = parser.parse_args()
+
+    server = build_server(args.host, args.port, args.password, args.serpapi_latency,
+                          args.gemini_latency, args.firebase_latency, args.sigma, args.error_rate)
+    print(f"Mock upstreams escuchando en http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+# run_bench.py - Benchmarks de carga de Price Finder contra upstreams simulados
+"""Levanta los upstreams simulados y la app bajo gunicorn, ejecuta escenarios
+de carga y reporta latencias p50/p95/p99, peticiones por segundo, RSS de los
+workers y llamadas a cada upstream. No consume cuota de servicios reales.
+
+Escenarios: text-cold, text-hot, image-cold, image-hot, login-storm, ui-cold
+
+ui-cold sigue el camino de la página de búsqueda: crea un job en
+/api/search/jobs, lo sigue por SSE si la respuesta trae events_url (o por
+polling del estado cada 800 ms, como el JS) y abre /results. Se mide el
+tiempo total hasta tener la página de resultados.
+
+Con --compare-users se ejecutan los escenarios con un solo worker bajo
+gunicorn (WSGI) y bajo uvicorn (asgi.py) para cada número de usuarios
+concurrentes, y se comparan latencias y errores por worker.
+
+Uso:
+  python bench/run_bench.py                       # todos los escenarios
+  python bench/run_bench.py --scenarios text-cold,text-hot --users 32 --requests 400
+  python bench/run_bench.py --workers 4 --threads 8 --json bench_output.json
+  python bench/run_bench.py --server uvicorn --users 200 --requests 2000
+  python bench/run_bench.py --scenarios text-cold --compare-users 16,64,256 --requests 1000
+  python bench/run_bench.py --scenarios ui-cold --compare-users 16,64,256 --requests 1000
+"""
+import argparse
+import copy
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCENARIOS = ('text-cold', 'text-hot', 'image-cold', 'image-hot', 'login-storm', 'ui-cold')
+# Intervalo de polling del JS de la página de búsqueda
+UI_POLL_INTERVAL = 0.8
+SERVERS = ('gunicorn', 'uvicorn')
+HOT_QUERIES = ['iphone 15 case', 'usb c charger', 'air fryer', 'running shoes', 'lego star wars',
+               'bluetooth speaker', 'coffee grinder', 'yoga mat', 'gaming mouse', 'electric toothbrush']
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def process_tree_rss(pid):
+    """RSS total (bytes) del proceso maestro y sus hijos directos"""
+    total = 0
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            pids.extend(int(p) for p in f.read().split())
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.peak
+
+
+def make_images(count, size=(3024, 4032)):
+    """JPEGs tipo foto de móvil; cada uno con un patrón distinto para que su hash perceptual difiera"""
+    from PIL import Image, ImageDraw
+    images = []
+    for i in range(count):
+        rng = random.Random(i)
+        image = Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(12):
+            x0, y0 = rng.randrange(size[0]), rng.randrange(size[1])
+            draw.rectangle((x0, y0, x0 + rng.randrange(200, 1500), y0 + rng.randrange(200, 1500)),
+                           fill=tuple(rng.randrange(256) for _ in range(3)))
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=92)
+        images.append(buffer.getvalue())
+    return images
+
+
+class BenchTarget:
+    """Procesos del mock y de la app bajo prueba"""
+    def __init__(self, args):
+        self.args = args
+        self.tmpdir = tempfile.mkdtemp(prefix='pf-bench-')
+        self.mock_url = f'http://127.0.0.1:{args.mock_port}'
+        self.app_url = f'http://127.0.0.1:{args.port}'
+        self.mock = None
+        self.app = None
+
+    def app_env(self):
+        env = dict(os.environ)
+        env.update({
+            'SERPAPI_KEY': 'bench-serpapi-key',
+            'SERPAPI_BASE_URL': f'{self.mock_url}/search',
+            'FIREBASE_WEB_API_KEY': 'bench-firebase-key',
+            'FIREBASE_AUTH_URL': self.mock_url,
+            'GEMINI_API_KEY': 'bench-gemini-key',
+            'GEMINI_API_ENDPOINT': self.mock_url,
+            'LOCAL_DB_PATH': os.path.join(self.tmpdir, 'bench.sqlite3'),
+            'SECRET_KEY': 'bench-secret',
+            'SERPAPI_RATE_PER_SEC': str(self.args.serpapi_rate),
+            'SERPAPI_BURST': str(self.args.serpapi_rate),
+            # Todos los usuarios simulados inician sesión desde 127.0.0.1
+            'LOGIN_IP_LIMIT': '1000000',
+            'PYTHONUNBUFFERED': '1',
+        })
+        return env
+
+    def app_command(self):
+        args = self.args
+        if args.server == 'uvicorn':
+            return [sys.executable, '-m', 'uvicorn', 'asgi:app', '--workers', str(args.workers),
+                    '--host', '127.0.0.1', '--port', str(args.port), '--log-level', 'warning']
+        return [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '-k', args.worker_class,
+                '--threads', str(args.threads), '-b', f'127.0.0.1:{args.port}', '--timeout', '60',
+                '--log-level', 'warning', 'webapp:app']
+
+    def start(self):
+        args = self.args
+        self.mock = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, 'mock_upstreams.py'), '--port', str(args.mock_port),
+             '--serpapi-latency', str(args.serpapi_latency), '--gemini-latency', str(args.gemini_latency),
+             '--firebase-latency', str(args.firebase_latency), '--error-rate', str(args.error_rate)],
+            stdout=subprocess.DEVNULL
+        )
+        if not wait_for(f'{self.mock_url}/__stats'):
+            raise RuntimeError('El servidor simulado no arrancó')
+        log = open(os.path.join(self.tmpdir, 'app.log'), 'w')
+        self.app = subprocess.Popen(self.app_command(), cwd=REPO_DIR, env=self.app_env(), stdout=log, stderr=log)
+        if not wait_for(f'{self.app_url}/api/health', timeout=60):
+            raise RuntimeError(f'La app no arrancó (ver {log.name})')
+
+    def stop(self):
+        for proc in (self.app, self.mock):
+            if proc and proc.poll() is None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+        if not self.args.keep_tmp:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def upstream_stats(self):
+        return requests.get(f'{self.mock_url}/__stats', timeout=5).json()
+
+    def health(self):
+        return requests.get(f'{self.app_url}/api/health', timeout=5).json()
+
+
+def login(base_url, password='bench-password'):
+    session = requests.Session()
+    email = f'user-{uuid.uuid4().hex[:8]}@example.com'
+    response = session.post(f'{base_url}/auth/login', data={'email': email, 'password': password},
+                            allow_redirects=False, timeout=30)
+    return session, response
+
+
+def build_scenario(name, target, images):
+    """Devuelve (preparar_usuario, ejecutar_petición) para un escenario"""
+    base = target.app_url
+
+    def search_user():
+        session, _ = login(base)
+        return session
+
+    def text_cold(session, i):
+        r = session.post(f'{base}/api/search', data={'query': f'widget {uuid.uuid4().hex[:10]}'}, timeout=60)
+        return r.status_code == 200 and r.json().get('success')
+
+    def text_hot(session, i):
+        r = session.post(f'{base}/api/search', data={'query': HOT_QUERIES[i % len(HOT_QUERIES)]}, timeout=60)
+        return r.status_code == 200 and r.json().get('success')
+
+    def image_search(session, i, cold):
+        data = images[i % len(images)] if cold else images[0]
+        r = session.post(f'{base}/api/search', files={'image_file': ('photo.jpg', data, 'image/jpeg')}, timeout=60)
+        return r.status_code == 200 and r.json().get('success')
+
+    def follow_events(session, job):
+        with session.get(f"{base}{job['events_url']}", stream=True, timeout=90) as response:
+            if response.status_code != 200:
+                return False
+            for line in response.iter_lines(decode_unicode=True):
+                if line and line.split(': ', 1)[-1] in ('done', 'error', 'timeout') and line.startswith('event:'):
+                    break
+        return True
+
+    def ui_cold(session, i):
+        r = session.post(f'{base}/api/search/jobs', data={'query': f'widget {uuid.uuid4().hex[:10]}'}, timeout=60)
+        if r.status_code != 202:
+            return False
+        job = r.json()
+        if job.get('events_url') and not follow_events(session, job):
+            return False
+        deadline = time.time() + 30
+        while True:
+            status = session.get(f"{base}{job['status_url']}", timeout=60).json()
+            if status.get('done'):
+                break
+            if time.time() > deadline:
+                return False
+            time.sleep(UI_POLL_INTERVAL)
+        return session.get(f'{base}/results', timeout=60).status_code == 200
+
+    def login_storm(_, i):
+        # Mezcla de credenciales válidas e inválidas, una sesión nueva por intento
+        password = 'bench-password' if i % 3 else 'wrong-password'
+        _, response = login(base, password)
+        return response.status_code == 302
+
+    return {
+        'text-cold': (search_user, text_cold),
+        'text-hot': (search_user, text_hot),
+        'image-cold': (search_user, lambda s, i: image_search(s, i, True)),
+        'image-hot': (search_user, lambda s, i: image_search(s, i, False)),
+        'login-storm': (lambda: None, login_storm),
+        'ui-cold': (search_user, ui_cold),
+    }[name]
+
+
+def run_scenario(name, target, args, images):
+    setup_user, do_request = build_scenario(name, target, images)
+    if name == 'text-hot':
+        # Calentar la caché con las consultas populares
+        warm = setup_user()
+        for query in HOT_QUERIES:
+            warm.post(f'{target.app_url}/api/search', data={'query': query}, timeout=60)
+    elif name == 'image-hot' and images:
+        warm = setup_user()
+        warm.post(f'{target.app_url}/api/search', files={'image_file': ('photo.jpg', images[0], 'image/jpeg')}, timeout=60)
+
+    users = [setup_user() for _ in range(args.users)]
+    before = target.upstream_stats()
+    latencies = []
+    errors = [0]
+    counter = iter(range(args.requests))
+    lock = threading.Lock()
+
+    def worker(session):
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                ok = do_request(session, i)
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += not ok
+
+    sampler = RssSampler(target.app.pid)
+    sampler.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(session,)) for session in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+    peak_rss = sampler.stop()
+    after = target.upstream_stats()
+
+    latencies.sort()
+    return {
+        'scenario': name,
+        'server': args.server,
+        'workers': args.workers,
+        'users': args.users,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / duration, 2) if duration else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'peak_rss_mb': round(peak_rss / 1024 / 1024, 1),
+        'upstream_calls': {k: after['calls'][k] - before['calls'][k] for k in after['calls']},
+    }
+
+
+def print_report(results):
+    header = f"{'escenario':<12} {'servidor':<9} {'usr/wk':>6} {'req':>5} {'err':>4} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'RSS MB':>8}  upstream (serpapi/gemini/firebase)"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        calls = r['upstream_calls']
+        users_per_worker = r['users'] // max(1, r['workers'])
+        print(f"{r['scenario']:<12} {r['server']:<9} {users_per_worker:>6} {r['requests']:>5} {r['errors']:>4} {r['rps']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+              f"{r['p99_ms']:>8} {r['peak_rss_mb']:>8}  {calls['serpapi']}/{calls['gemini']}/{calls['firebase']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks offline de Price Finder')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--users', type=int, default=16, help='usuarios concurrentes')
+    parser.add_argument('--requests', type=int, default=200, help='peticiones por escenario')
+    parser.add_argument('--images', type=int, default=20, help='imágenes distintas para image-cold')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--worker-class', default='gthread')
+    parser.add_argument('--server', choices=SERVERS, default='gunicorn', help='gunicorn (webapp:app) o uvicorn (asgi:app)')
+    parser.add_argument('--compare-users', help='usuarios concurrentes a comparar entre servidores con un worker, p. ej. 16,64,256')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--mock-port', type=int, default=8900)
+    parser.add_argument('--serpapi-latency', type=float, default=350)
+    parser.add_argument('--gemini-latency', type=float, default=1200)
+    parser.add_argument('--firebase-latency', type=float, default=150)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--serpapi-rate', type=float, default=1000, help='SERPAPI_RATE_PER_SEC de la app bajo prueba')
+    parser.add_argument('--json', help='guardar resultados en este archivo')
+    parser.add_argument('--keep-tmp', action='store_true', help='conservar base de datos y logs de la app')
+    return parser.parse_args(argv)
+
+
+def run(args, target_factory=BenchTarget):
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Escenarios desconocidos: {', '.join(sorted(unknown))}")
+    if args.compare_users:
+        return run_comparison(args, scenarios, target_factory)
+    return run_target(args, scenarios, target_factory)
+
+def run_target(args, scenarios, target_factory, user_counts=None):
+    target = target_factory(args)
+    results = []
+    try:
+        target.start()
+        health = target.health()
+        images = make_images(args.images) if any(s.startswith('image') for s in scenarios) else []
+        for name in scenarios:
+            if name.startswith('image') and health.get('gemini_vision') != 'enabled':
+                print(f"⚠️ {name}: Gemini no disponible en la app (falta google-generativeai) - omitido")
+                continue
+            for users in user_counts or [args.users]:
+                scenario_args = copy.copy(args)
+                scenario_args.users = users
+                results.append(run_scenario(name, target, scenario_args, images))
+    finally:
+        target.stop()
+    return results
+
+def run_comparison(args, scenarios, target_factory):
+    """Mismos escenarios con un worker WSGI y un worker ASGI, para cada número de usuarios"""
+    user_counts = [int(u) for u in args.compare_users.split(',') if u.strip()]
+    results = []
+    for server in SERVERS:
+        server_args = copy.copy(args)
+        server_args.server = server
+        server_args.workers = 1
+        results.extend(run_target(server_args, scenarios, target_factory, user_counts))
+    return results
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+# conftest.py - Configuración común de las pruebas
+import os
+import sys
+import tempfile
+
+import pytest
+
+# webapp abre su SQLite al importarse: nunca el archivo compartido del sistema
+os.environ.setdefault('LOCAL_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='pricefinder-tests-'), 'webapp.sqlite3'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import webapp  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """SQLite propio de cada prueba"""
+    return webapp.SharedSQLite(str(tmp_path / 'test.sqlite3'))
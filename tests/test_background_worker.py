@@ -0,0 +1,78 @@
+# test_background_worker.py - Hilos de fondo arrancados por proceso (logging, histórico)
+import os
+import queue
+import threading
+
+import pytest
+
+from webapp import BackgroundWorker
+
+
+def test_thread_starts_on_first_put():
+    handled = []
+    worker = BackgroundWorker('test-lazy-worker', handled.extend)
+    assert worker.qsize() == 0
+    assert not any(t.name == 'test-lazy-worker' for t in threading.enumerate())
+    worker.put_nowait('a')
+    worker.put_nowait('b')
+    assert worker.flush(timeout=2)
+    assert handled == ['a', 'b']
+
+
+def test_flush_gives_up_after_timeout():
+    release = threading.Event()
+    worker = BackgroundWorker('test-worker', lambda items: release.wait(5))
+    worker.put_nowait('slow')
+    assert worker.flush(timeout=0.05) is False
+    release.set()
+    assert worker.flush(timeout=2)
+
+
+def test_full_queue_raises_without_blocking():
+    busy, release = threading.Event(), threading.Event()
+    worker = BackgroundWorker('test-worker', lambda items: busy.set() or release.wait(5), maxsize=1)
+    worker.put_nowait(1)
+    assert busy.wait(2)
+    worker.put_nowait(2)
+    with pytest.raises(queue.Full):
+        worker.put_nowait(3)
+    release.set()
+
+
+def test_handler_errors_do_not_kill_the_thread():
+    handled = []
+
+    def handle(items):
+        if 'boom' in items:
+            raise ValueError('boom')
+        handled.extend(items)
+
+    worker = BackgroundWorker('test-worker', handle)
+    worker.put_nowait('boom')
+    assert worker.flush(timeout=2)
+    worker.put_nowait('ok')
+    assert worker.flush(timeout=2)
+    assert handled == ['ok']
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requiere fork')
+def test_forked_child_starts_its_own_thread():
+    read_end, write_end = os.pipe()
+    worker = BackgroundWorker('test-worker', lambda items: os.write(write_end, ''.join(items).encode()))
+    worker.put_nowait('p')
+    assert worker.flush(timeout=2)
+    assert os.read(read_end, 10) == b'p'
+
+    pid = os.fork()
+    if pid == 0:
+        # Como un worker de gunicorn --preload: el hilo del padre no existe aquí
+        try:
+            worker.put_nowait('c')
+            os._exit(0 if worker.flush(timeout=2) else 1)
+        except BaseException:
+            os._exit(2)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert os.read(read_end, 10) == b'c'
+    os.close(read_end)
+    os.close(write_end)
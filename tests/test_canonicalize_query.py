@@ -0,0 +1,64 @@
+# test_canonicalize_query.py - Claves canónicas de consultas (caché y single-flight)
+import pytest
+
+from webapp import canonicalize_query
+
+
+def key(query):
+    return canonicalize_query(query).key
+
+
+@pytest.mark.parametrize('a, b', [
+    ('iPhone 15 case', 'case iphone 15'),
+    ('iPhone 15 case', 'iphone15 case '),
+    ('iphone 15 cases', 'iphone 15 case'),
+    ('Cheap air fryer sale', 'air fryer'),
+    ('the best price on a kettle', 'best on kettle'),
+    ("men's wallets", 'men wallet'),
+    ('Café crème', 'cafe creme'),
+])
+def test_equivalent_queries_share_a_key(a, b):
+    assert key(a) == key(b)
+
+
+@pytest.mark.parametrize('a, b', [
+    ('best buy gift card', 'gift card'),
+    ('slip on shoes', 'slip shoes'),
+    ('usb c to lightning', 'lightning to usb c'),
+    ('usb c to usb c', 'usb c'),
+    ('phone case with stand', 'phone case'),
+    ('funda sin tapa', 'funda con tapa'),
+    ('iphone 15 case', 'iphone 15 pro case'),
+    ('lens', 'len'),
+    ('news', 'new'),
+    ('iphone plus', 'iphone plu'),
+])
+def test_distinct_queries_do_not_collide(a, b):
+    assert key(a) != key(b)
+
+
+@pytest.mark.parametrize('word', ['lens', 'news', 'plus', 'glass', 'tennis', 'nikon', 'adidas'])
+def test_singular_words_ending_in_s_are_kept(word):
+    assert key(word) == word
+
+
+def test_glasses_plural():
+    assert key('reading glasses') == key('reading glass')
+
+
+@pytest.mark.parametrize('query', [
+    'usb c to usb c', 'lightning to usb c cables', 'Best Buy gift cards', 'lenses for canon',
+    'the cheapest iPhone 15 Pro Max cases', 'slip on shoes', 'news', 'prices', 'a',
+])
+def test_canonical_form_is_idempotent(query):
+    assert key(key(query)) == key(query)
+
+
+def test_brand_and_models():
+    canonical = canonicalize_query('Samsung Galaxy S24 and S23 case')
+    assert canonical.brand == 'samsung'
+    assert canonical.models == ('23', '24')
+
+
+def test_stopword_only_query_is_kept():
+    assert key('The Sale') == 'the sale'
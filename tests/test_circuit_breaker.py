@@ -0,0 +1,78 @@
+# test_circuit_breaker.py - CircuitBreaker y su uso en las llamadas a SerpAPI
+import time
+
+import pytest
+
+import webapp
+from webapp import CircuitBreaker, TokenBucket
+
+
+def tripped_breaker(cooldown=0.01):
+    breaker = CircuitBreaker(failure_ratio=0.5, window=30, min_requests=2, cooldown=cooldown)
+    breaker.record(True)
+    breaker.record(True)
+    assert breaker.state == 'open'
+    return breaker
+
+
+def test_stays_closed_below_min_requests():
+    breaker = CircuitBreaker(failure_ratio=0.5, min_requests=3)
+    breaker.record(True)
+    breaker.record(True)
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_opens_when_failure_ratio_reached():
+    breaker = CircuitBreaker(failure_ratio=0.5, min_requests=4)
+    for failed in (False, False, True, True):
+        breaker.record(failed)
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    assert breaker.is_open()
+    assert breaker.rejected == 1
+
+
+def test_half_open_lets_a_single_probe_through():
+    breaker = tripped_breaker()
+    time.sleep(0.02)
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+
+
+@pytest.mark.parametrize('failed, state', [(False, 'closed'), (True, 'open')])
+def test_probe_result_decides_state(failed, state):
+    breaker = tripped_breaker()
+    time.sleep(0.02)
+    assert breaker.allow()
+    breaker.record(failed)
+    assert breaker.state == state
+
+
+def test_release_returns_the_probe():
+    breaker = tripped_breaker()
+    time.sleep(0.02)
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == 'half_open'
+    assert breaker.allow()
+
+
+def test_rate_limited_probe_does_not_lock_the_breaker(monkeypatch):
+    # Breaker disparado, cooldown vencido y bucket vacío: la prueba se rechaza
+    # por el limitador y el breaker debe poder volver a probar después
+    finder = webapp.PriceFinder()
+    finder.api_key = 'test-key'
+    finder.circuit_breaker = tripped_breaker()
+    finder.rate_limiter = TokenBucket(rate=1, burst=1, max_wait=0)
+    assert finder.rate_limiter.reserve() == 0.0
+    calls = []
+    monkeypatch.setattr(webapp.http_client, 'get', lambda *a, **k: calls.append(a))
+    time.sleep(0.02)
+
+    assert finder._make_api_request('google_shopping', 'usb c cable') is None
+    assert calls == []
+    assert finder.rate_limiter.rejected == 1
+    assert finder.circuit_breaker.state == 'half_open'
+    assert finder.circuit_breaker.allow()
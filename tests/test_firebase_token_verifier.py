@@ -0,0 +1,124 @@
+# test_firebase_token_verifier.py - Verificación local de ID tokens de Firebase
+import json
+import time
+
+import pytest
+
+jwt = pytest.importorskip('jwt')
+rsa = pytest.importorskip('cryptography.hazmat.primitives.asymmetric.rsa')
+
+import webapp  # noqa: E402
+from webapp import FirebaseTokenVerifier, InvalidTokenError  # noqa: E402
+
+PROJECT = 'price-finder-test'
+
+
+def new_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+class FakeJwks:
+    """Sustituye http_client.get y sirve las claves públicas dadas"""
+    def __init__(self, keys):
+        self.keys = keys
+        self.fetches = 0
+
+    def get(self, url, timeout=None):
+        self.fetches += 1
+        body = {'keys': [dict(json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(key.public_key())), kid=kid)
+                         for kid, key in self.keys.items()]}
+        return FakeResponse(body)
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {'Cache-Control': 'public, max-age=3600'}
+
+    def __init__(self, body):
+        self._body = body
+        self.content = json.dumps(body).encode()
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        pass
+
+
+def make_token(key, kid='k1', **overrides):
+    now = int(time.time())
+    claims = {'iss': f'https://securetoken.google.com/{PROJECT}', 'aud': PROJECT, 'sub': 'user-1',
+              'iat': now, 'exp': now + 3600, 'auth_time': now}
+    claims.update(overrides)
+    claims = {k: v for k, v in claims.items() if v is not None}
+    return jwt.encode(claims, key, algorithm='RS256', headers={'kid': kid})
+
+
+@pytest.fixture(scope='module')
+def key():
+    return new_key()
+
+
+@pytest.fixture
+def jwks(monkeypatch, key):
+    fake = FakeJwks({'k1': key})
+    monkeypatch.setattr(webapp.http_client, 'get', fake.get)
+    return fake
+
+
+@pytest.fixture
+def verifier(jwks):
+    return FirebaseTokenVerifier(PROJECT, 'https://jwks.example/keys', leeway=0)
+
+
+def test_valid_token_is_verified_and_memoized(verifier, jwks, key):
+    token = make_token(key)
+    assert verifier.verify(token)['sub'] == 'user-1'
+    assert verifier.verify(token)['sub'] == 'user-1'
+    assert jwks.fetches == 1
+    assert verifier.stats()['memoized_tokens'] == 1
+
+
+@pytest.mark.parametrize('overrides', [
+    {'aud': 'other-project'},
+    {'iss': 'https://securetoken.google.com/other-project'},
+    {'exp': int(time.time()) - 10},
+    {'iat': int(time.time()) + 600},
+    {'auth_time': int(time.time()) + 600},
+    {'sub': ''},
+    {'sub': None},
+])
+def test_invalid_claims_are_rejected(verifier, key, overrides):
+    with pytest.raises(InvalidTokenError):
+        verifier.verify(make_token(key, **overrides))
+
+
+def test_signature_from_another_key_is_rejected(verifier):
+    with pytest.raises(InvalidTokenError):
+        verifier.verify(make_token(new_key()))
+
+
+@pytest.mark.parametrize('token', ['', 'not-a-jwt', 'a.b.c'])
+def test_malformed_tokens_are_rejected(verifier, token):
+    with pytest.raises(InvalidTokenError):
+        verifier.verify(token)
+
+
+def test_non_rs256_tokens_are_rejected(verifier):
+    token = jwt.encode({'sub': 'user-1', 'aud': PROJECT}, 'secret', algorithm='HS256', headers={'kid': 'k1'})
+    with pytest.raises(InvalidTokenError, match='algoritmo'):
+        verifier.verify(token)
+
+
+def test_unknown_kid_refetches_keys_once_per_interval(verifier, jwks, key):
+    verifier.verify(make_token(key))
+    rotated = new_key()
+    jwks.keys['k2'] = rotated
+    # Rotación: un kid nuevo fuerza la descarga aunque las claves no hayan caducado
+    verifier._last_fetch = 0.0
+    assert verifier.verify(make_token(rotated, kid='k2'))['sub'] == 'user-1'
+    assert jwks.fetches == 2
+    # Un kid que no existe no provoca otra descarga dentro del intervalo
+    with pytest.raises(InvalidTokenError, match='kid'):
+        verifier.verify(make_token(rotated, kid='missing'))
+    assert jwks.fetches == 2
@@ -0,0 +1,97 @@
+# test_login_throttle.py - Límite de intentos de login por IP y por email
+import pytest
+
+import webapp
+from webapp import LoginThrottle, SQLiteLoginThrottle
+
+WINDOW = 300
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Inicio de una ventana: el recuento deslizante no arrastra la anterior
+    now = [WINDOW * 6_000_000.0]
+    monkeypatch.setattr(webapp.time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_throttle(request, db):
+    def make(**kwargs):
+        kwargs.setdefault('window', WINDOW)
+        if request.param == 'sqlite':
+            return SQLiteLoginThrottle(db, **kwargs)
+        return LoginThrottle(**kwargs)
+    return make
+
+
+def test_email_limit_applies_across_ips(make_throttle, clock):
+    throttle = make_throttle(email_limit=3, ip_limit=100)
+    assert [throttle.attempt(f'10.0.0.{i}', 'victim@example.com') for i in range(3)] == [0.0] * 3
+    assert throttle.attempt('10.0.0.9', 'Victim@Example.com') == WINDOW
+    assert throttle.attempt('10.0.0.9', 'other@example.com') == 0.0
+
+
+def test_ip_limit_applies_across_emails(make_throttle, clock):
+    throttle = make_throttle(ip_limit=2, email_limit=100)
+    assert throttle.attempt('10.0.0.1', 'a@example.com') == 0.0
+    assert throttle.attempt('10.0.0.1', 'b@example.com') == 0.0
+    assert throttle.attempt('10.0.0.1', 'c@example.com') > 0
+    assert throttle.attempt('10.0.0.2', 'c@example.com') == 0.0
+
+
+def test_rejected_attempts_are_not_counted(make_throttle, clock):
+    throttle = make_throttle(ip_limit=3, email_limit=100)
+    for _ in range(3):
+        throttle.attempt('10.0.0.1', 'a@example.com')
+    for _ in range(5):
+        assert throttle.attempt('10.0.0.1', 'a@example.com') > 0
+    # A mitad de la siguiente ventana pesan 3 * 0.5 intentos, no 8 * 0.5
+    clock[0] += WINDOW * 1.5
+    assert throttle.attempt('10.0.0.1', 'a@example.com') == 0.0
+
+
+def test_sliding_window_weights_the_previous_window(make_throttle, clock):
+    throttle = make_throttle(ip_limit=4, email_limit=100)
+    for i in range(4):
+        throttle.attempt('10.0.0.1', f'{i}@example.com')
+    clock[0] += WINDOW * 1.25
+    # 4 * 0.75 de la ventana anterior + 1 nuevo = 4 intentos
+    assert throttle.attempt('10.0.0.1', 'x@example.com') == 0.0
+    assert throttle.attempt('10.0.0.1', 'y@example.com') > 0
+
+
+def test_failures_back_off_exponentially_and_success_resets(make_throttle, clock):
+    throttle = make_throttle(email_free_failures=2, backoff_base=1.0, email_limit=100, ip_limit=100)
+    email = 'user@example.com'
+    waits = []
+    for _ in range(4):
+        assert throttle.attempt('10.0.0.1', email) == 0.0
+        throttle.record_result('10.0.0.1', email, success=False)
+        waits.append(throttle.attempt('10.0.0.1', email))
+        clock[0] += waits[-1]
+    assert waits == [0.0, 1.0, 2.0, 4.0]
+    throttle.record_result('10.0.0.1', email, success=True)
+    assert throttle.attempt('10.0.0.1', email) == 0.0
+
+
+def test_backoff_is_capped(make_throttle, clock):
+    throttle = make_throttle(email_free_failures=0, ip_free_failures=100, backoff_base=1.0, backoff_max=5,
+                             email_limit=100, ip_limit=100)
+    for _ in range(10):
+        throttle.record_result('10.0.0.1', 'user@example.com', success=False)
+    assert throttle.attempt('10.0.0.1', 'user@example.com') == 5.0
+
+
+def test_tracked_keys_are_bounded(make_throttle, clock):
+    throttle = make_throttle(max_keys=10)
+    for i in range(50):
+        throttle.attempt(f'10.0.1.{i}', f'{i}@example.com')
+    assert throttle.stats()['tracked_keys'] <= 10
+
+
+def test_sqlite_state_is_shared_between_workers(db, clock):
+    first = SQLiteLoginThrottle(db, window=WINDOW, email_limit=1)
+    second = SQLiteLoginThrottle(db, window=WINDOW, email_limit=1)
+    assert first.attempt('10.0.0.1', 'user@example.com') == 0.0
+    assert second.attempt('10.0.0.2', 'user@example.com') > 0
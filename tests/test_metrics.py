@@ -0,0 +1,44 @@
+# test_metrics.py - Acceso a /metrics y fases medidas
+import io
+
+import pytest
+
+import webapp
+
+PIL = pytest.importorskip('PIL.Image')
+
+
+@pytest.fixture
+def client():
+    return webapp.app.test_client()
+
+
+def test_metrics_allowed_from_localhost(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert b'pricefinder_http_request_duration_seconds' in response.data
+
+
+def test_metrics_rejected_from_other_addresses(client):
+    response = client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.7'})
+    assert response.status_code == 403
+    assert b'pricefinder' not in response.data
+
+
+def test_metrics_token_allows_remote_scrapers(client, monkeypatch):
+    monkeypatch.setattr(webapp, 'METRICS_TOKEN', 's3cret')
+    remote = {'REMOTE_ADDR': '203.0.113.7'}
+    assert client.get('/metrics', environ_base=remote, headers={'Authorization': 'Bearer s3cret'}).status_code == 200
+    assert client.get('/metrics', environ_base=remote, headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    assert client.get('/metrics', environ_base=remote).status_code == 403
+
+
+def test_compact_image_fallback_is_timed_once(monkeypatch):
+    phases = []
+    monkeypatch.setattr(webapp, 'record_phase', lambda phase, elapsed: phases.append(phase))
+    buffer = io.BytesIO()
+    PIL.new('RGB', (64, 48), 'red').save(buffer, 'PNG')
+    # Un PNG no se envía tal cual: se re-codifica dentro de prepare_compact_image
+    prepared = webapp.prepare_compact_image(buffer.getvalue())
+    assert prepared is not None and prepared.source_format == 'PNG'
+    assert phases == ['prepare_image']
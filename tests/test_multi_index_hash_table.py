@@ -0,0 +1,59 @@
+# test_multi_index_hash_table.py - Vecinos por distancia de Hamming en la caché de imágenes
+import random
+
+import pytest
+
+from webapp import MultiIndexHashTable
+
+
+def flip_bits(value, bits):
+    for bit in bits:
+        value ^= 1 << bit
+    return value
+
+
+def linear_search(values, value, max_distance):
+    return sorted((d, v) for v in values if (d := bin(v ^ value).count('1')) <= max_distance)
+
+
+def test_finds_neighbours_up_to_max_distance():
+    index = MultiIndexHashTable(max_distance=6)
+    base = 0x0123456789ABCDEF
+    index.add(base)
+    # Peor caso: los bits cambiados caen en trozos distintos
+    for distance in range(7):
+        query = flip_bits(base, range(0, 64, 10)[:distance])
+        assert index.search(query) == [(distance, base)]
+    assert index.search(flip_bits(base, range(0, 64, 9))) == []
+
+
+@pytest.mark.parametrize('max_distance', [0, 3, 6, 10])
+def test_matches_a_linear_scan(max_distance):
+    rng = random.Random(max_distance)
+    values = [rng.getrandbits(64) for _ in range(2000)]
+    index = MultiIndexHashTable(max_distance=max_distance)
+    for value in values:
+        index.add(value)
+    for _ in range(200):
+        query = flip_bits(rng.choice(values), rng.sample(range(64), rng.randint(0, max_distance + 2)))
+        assert index.search(query) == linear_search(values, query, max_distance)
+
+
+def test_search_limit_cannot_exceed_the_index_distance():
+    index = MultiIndexHashTable(max_distance=2)
+    index.add(0)
+    assert index.search(0b111, max_distance=10) == []
+    assert index.search(0b11, max_distance=1) == []
+    assert index.search(0b11) == [(2, 0)]
+
+
+def test_add_is_idempotent_and_remove_cleans_buckets():
+    index = MultiIndexHashTable(max_distance=3)
+    index.add(42)
+    index.add(42)
+    assert len(index) == 1 and 42 in index
+    index.remove(42)
+    index.remove(42)
+    assert len(index) == 0 and 42 not in index
+    assert index.search(42) == []
+    assert all(not table for table in index._tables)
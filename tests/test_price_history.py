@@ -0,0 +1,28 @@
+# test_price_history.py - Histórico de precios escrito por lotes en segundo plano
+import threading
+
+from webapp import PriceHistory
+
+
+def product(title, price, source='Store'):
+    return {'title': title, 'price_numeric': price, 'source': source, 'link': 'https://example.com'}
+
+
+def test_rows_are_written_after_flush(db):
+    history = PriceHistory(db)
+    history.record('usb c cable', [product('Anker USB-C Cable', 12.99), product('Anker USB-C Cable', 9.99, 'Other')])
+    assert history.flush(timeout=2)
+    assert history.stats() == {'written': 2, 'dropped': 0, 'queued': 0}
+    [(price, source, _)] = history.lowest(['Anker USB-C Cable']).values()
+    assert (price, source) == (9.99, 'Other')
+    assert [p['price_numeric'] for p in history.recent('usb c cable', max_age=60)] == [9.99, 12.99]
+
+
+def test_flush_is_bounded_when_the_writer_is_stuck(db, monkeypatch):
+    history = PriceHistory(db)
+    release = threading.Event()
+    monkeypatch.setattr(history, '_write', lambda rows: release.wait(5))
+    history.record('mouse', [product('Mouse', 5.0)])
+    assert history.flush(timeout=0.05) is False
+    release.set()
+    assert history.flush(timeout=2)
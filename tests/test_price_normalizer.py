@@ -0,0 +1,70 @@
+# test_price_normalizer.py - Precios de una página de resultados a USD en una pasada
+import pytest
+
+from webapp import PriceNormalizer
+
+RATES = {'USD': 1.0, 'EUR': 2.0, 'GBP': 1.5, 'CAD': 0.5}
+
+
+@pytest.fixture
+def normalizer():
+    return PriceNormalizer(rates=RATES)
+
+
+@pytest.mark.parametrize('text, usd', [
+    ('$1,299.99', 1299.99),
+    ('$1,299', 1299.0),
+    ('$1.299,00', 1299.0),
+    ('€12,50', 25.0),
+    ('12,50 €', 25.0),
+    ('1 234,56 EUR', 2469.12),
+    ('£9', 13.5),
+    ('US$ 5', 5.0),
+    ('C$15', 7.5),
+    ('99¢', 0.99),
+    ('12', 12.0),
+])
+def test_amounts_and_currencies(normalizer, text, usd):
+    assert normalizer.parse(text) == usd
+
+
+@pytest.mark.parametrize('text, usd', [
+    ('From $19.99', 19.99),
+    ('$10 - $20', 10.0),
+    ('$12.99 used', 12.99),
+    ('Now only $3.50 today', 3.5),
+])
+def test_first_priced_amount_wins(normalizer, text, usd):
+    assert normalizer.parse(text) == usd
+
+
+@pytest.mark.parametrize('text', ['', 'Free', '$0', '$99999'])
+def test_missing_or_out_of_range_prices_are_zero(normalizer, text):
+    assert normalizer.parse(text) == 0.0
+
+
+def test_page_results_stay_aligned_with_items(normalizer):
+    items = [
+        {'price': '$5'},
+        {'price': None},
+        {'price': '$7\nper unit'},
+        {'price': '£2'},
+    ]
+    assert normalizer.normalize_page(items) == [
+        ('$5', 5.0, 'USD'),
+        ('', 0.0, 'USD'),
+        ('$7 per unit', 7.0, 'USD'),
+        ('£2', 3.0, 'GBP'),
+    ]
+
+
+def test_extracted_price_overrides_the_text_amount(normalizer):
+    [(text, usd, currency)] = normalizer.normalize_page([{'price': 'EUR 3', 'extracted_price': 4.0}])
+    assert (text, usd, currency) == ('EUR 3', 8.0, 'EUR')
+    # Booleanos y valores no positivos se ignoran
+    assert normalizer.normalize_page([{'price': '$3', 'extracted_price': True}])[0][1] == 3.0
+    assert normalizer.normalize_page([{'price': '$3', 'extracted_price': 0}])[0][1] == 3.0
+
+
+def test_price_without_text_is_shown_in_usd(normalizer):
+    assert normalizer.normalize_page([{'price': '', 'extracted_price': 4.5}]) == [('$4.50', 4.5, 'USD')]
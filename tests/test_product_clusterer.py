@@ -0,0 +1,47 @@
+# test_product_clusterer.py - Agrupación del mismo producto entre tiendas
+import pytest
+
+from webapp import ProductClusterer
+
+
+def offer(title, price, source):
+    return {'title': title, 'price': f'${price:.2f}', 'price_numeric': price, 'source': source,
+            'link': f'https://{source.lower()}.example/item'}
+
+
+def test_same_product_from_several_stores_is_one_cluster():
+    clusters = ProductClusterer().cluster([
+        offer('Sony WH-1000XM5 Wireless Headphones Black', 348.0, 'Amazon'),
+        offer('Sony WH1000XM5 Wireless Headphones, Black', 329.99, 'Walmart'),
+        offer('Sony WH-1000XM5 Wireless Noise Canceling Headphones Black', 339.0, 'Best Buy'),
+    ])
+    assert len(clusters) == 1
+    assert clusters[0]['price_numeric'] == 329.99
+    assert [o['source'] for o in clusters[0]['offers']] == ['Walmart', 'Best Buy', 'Amazon']
+
+
+@pytest.mark.parametrize('title_a, title_b', [
+    ('Apple iPhone 15 Case Clear', 'Apple iPhone 15 Pro Case Clear'),
+    ('Apple iPhone 15 Pro Case Clear', 'Apple iPhone 15 Pro Max Case Clear'),
+    ('Apple iPhone 15 Case Clear', 'Apple iPhone 15 Plus Case Clear'),
+    ('Samsung Galaxy S24 Screen Protector', 'Samsung Galaxy S24 Ultra Screen Protector'),
+    ('Apple AirPods Wireless Earbuds', 'Apple AirPods Pro Wireless Earbuds'),
+    ('Apple iPad Air 128GB Wi-Fi Blue', 'Apple iPad Air 256GB Wi-Fi Blue'),
+    ('Apple iPad Air 11 Wi-Fi Blue', 'Apple iPad Air Wi-Fi Blue'),
+])
+def test_different_models_are_not_merged(title_a, title_b):
+    assert len(ProductClusterer().cluster([offer(title_a, 10.0, 'Amazon'), offer(title_b, 12.0, 'Walmart')])) == 2
+
+
+@pytest.mark.parametrize('title_a, title_b', [
+    ('Apple iPhone 15 Pro Case Clear', 'Apple iPhone 15Pro Case, Clear'),
+    ('Samsung 990 Pro SSD 2TB NVMe', 'Samsung 990 PRO SSD 2 TB NVMe'),
+])
+def test_spacing_of_the_model_does_not_split_a_product(title_a, title_b):
+    assert len(ProductClusterer().cluster([offer(title_a, 10.0, 'Amazon'), offer(title_b, 12.0, 'Walmart')])) == 1
+
+
+def test_model_signature_includes_variant_words():
+    clusterer = ProductClusterer()
+    signature = clusterer._model_signature(clusterer._tokens('iPhone 15 Pro Max 256 GB'))
+    assert signature == {'15', 'pro', 'max', '256', 'gb'}
@@ -0,0 +1,57 @@
+# test_query_suggester.py - Sugerencias por prefijo y su persistencia por lotes
+from webapp import QuerySuggester
+
+
+def record_by_users(suggester, query, users):
+    for user in range(users):
+        suggester.record(query, f'user-{user}')
+
+
+def test_only_queries_from_enough_users_are_suggested():
+    suggester = QuerySuggester(min_users=2)
+    record_by_users(suggester, 'iphone 15', 1)
+    suggester.record('iphone 15', 'user-0')
+    assert suggester.suggest('iph') == []
+    suggester.record('iphone 15', 'user-1')
+    assert suggester.suggest('iph') == ['iphone 15']
+
+
+def test_ranks_the_whole_prefix_range_by_popularity():
+    suggester = QuerySuggester(min_users=1)
+    # Muchas consultas poco populares que ordenan antes que la más buscada
+    for i in range(1000):
+        suggester.record(f'case a{i:04d}', 'user')
+    record_by_users(suggester, 'case zz popular', 5)
+    assert suggester.suggest('case', limit=1) == ['case zz popular']
+    assert suggester.suggest('case z') == ['case zz popular']
+
+
+def test_prefix_range_stops_at_the_prefix():
+    suggester = QuerySuggester(min_users=1)
+    for query in ('ipad', 'iphone', 'iphp', 'ipho', 'iphn'):
+        suggester.record(query, 'user')
+    assert sorted(suggester.suggest('ipho')) == ['ipho', 'iphone']
+
+
+def test_searches_are_persisted_in_batches(db):
+    suggester = QuerySuggester(db, min_users=2)
+    record_by_users(suggester, 'nintendo switch', 3)
+    suggester.record('nintendo switch', 'user-0')
+    assert suggester.flush(timeout=2)
+    assert suggester.suggest('nin') == ['nintendo switch']
+    assert suggester.stats()['queued'] == 0
+
+    # Otro worker arranca con las consultas guardadas
+    restarted = QuerySuggester(db, min_users=2)
+    assert restarted.suggest('nin') == ['nintendo switch']
+    assert (restarted._counts['nintendo switch'], restarted._users['nintendo switch']) == (4, 3)
+
+
+def test_record_does_not_touch_sqlite_on_the_request_path(db, monkeypatch):
+    suggester = QuerySuggester(db, min_users=1)
+    calls = []
+    monkeypatch.setattr(db, 'transaction', lambda: calls.append('transaction'))
+    suggester._writer.handle = lambda searches: None
+    suggester.record('airpods pro', 'user')
+    assert calls == []
+    assert suggester._counts['airpods pro'] == 1
@@ -0,0 +1,110 @@
+# test_single_flight.py - Búsquedas idénticas concurrentes en una sola llamada
+import threading
+import time
+
+import pytest
+
+from webapp import SingleFlight
+
+
+def run_concurrently(count, target):
+    results = [None] * count
+    threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, target())) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'products'
+
+    assert run_concurrently(8, lambda: flight.do('iphone', fetch)) == ['products'] * 8
+    assert len(calls) == 1
+    stats = flight.stats()
+    assert (stats['leaders'], stats['coalesced'], stats['in_flight']) == (1, 7, 0)
+
+
+def test_different_keys_do_not_wait_for_each_other():
+    flight = SingleFlight()
+    assert flight.do('a', lambda: 1) == 1
+    assert flight.do('b', lambda: 2) == 2
+    assert flight.stats()['leaders'] == 2
+
+
+def test_leader_error_reaches_the_waiters():
+    flight = SingleFlight()
+    started = threading.Event()
+
+    def failing():
+        started.set()
+        time.sleep(0.1)
+        raise RuntimeError('upstream down')
+
+    errors = []
+
+    def call():
+        try:
+            flight.do('key', failing)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait(2)
+    run_concurrently(3, call)
+    leader.join(2)
+    assert errors == ['upstream down'] * 4
+    # El fallo no se queda cacheado: la siguiente llamada vuelve a ejecutar
+    assert flight.do('key', lambda: 'ok') == 'ok'
+
+
+def test_waiter_gives_up_after_wait_timeout():
+    flight = SingleFlight(wait_timeout=0.05)
+    release = threading.Event()
+    leader = threading.Thread(target=lambda: flight.do('slow', lambda: release.wait(2)))
+    leader.start()
+    time.sleep(0.02)
+    assert flight.do('slow', lambda: pytest.fail('no debe ejecutarse')) is None
+    assert flight.stats()['timeouts'] == 1
+    release.set()
+    leader.join(2)
+
+
+def test_lease_makes_other_workers_wait_for_the_shared_cache(db):
+    # Dos instancias sobre el mismo SQLite se comportan como dos workers
+    worker_a = SingleFlight(db=db, wait_timeout=2, poll_interval=0.01)
+    worker_b = SingleFlight(db=db, wait_timeout=2, poll_interval=0.01)
+    cache = {}
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.1)
+        cache['key'] = 'products'
+        return 'products'
+
+    leader = threading.Thread(target=lambda: worker_a.do('key', fetch, poll=lambda: cache.get('key')))
+    leader.start()
+    time.sleep(0.02)
+    assert worker_b.do('key', fetch, poll=lambda: cache.get('key')) == 'products'
+    leader.join(2)
+    assert len(calls) == 1
+    assert worker_b.stats()['remote_waits'] >= 1
+    assert db.execute('SELECT COUNT(*) FROM search_leases').fetchone()[0] == 0
+
+
+def test_expired_lease_is_taken_over(db):
+    stale = SingleFlight(db=db, wait_timeout=0.01)
+    assert stale._acquire_lease('key')
+    time.sleep(0.02)
+    fresh = SingleFlight(db=db, wait_timeout=1, poll_interval=0.01)
+    assert fresh.do('key', lambda: 'fetched', poll=lambda: None) == 'fetched'
+    assert fresh.stats()['remote_waits'] == 0
@@ -0,0 +1,68 @@
+# test_token_bucket.py - Limitador de SerpAPI por reservas (memoria y SQLite)
+import pytest
+
+from webapp import SQLiteTokenBucket, TokenBucket
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_bucket(request, db):
+    def make(rate, burst, max_wait=5.0):
+        if request.param == 'sqlite':
+            return SQLiteTokenBucket(db, 'test', rate, burst, max_wait)
+        return TokenBucket(rate, burst, max_wait)
+    return make
+
+
+def test_burst_is_served_without_waiting(make_bucket):
+    bucket = make_bucket(rate=1, burst=3)
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+
+
+def test_reservations_queue_in_fifo_order(make_bucket):
+    bucket = make_bucket(rate=10, burst=1)
+    bucket.reserve()
+    waits = [bucket.reserve() for _ in range(3)]
+    # Cada reserva espera un intervalo más que la anterior
+    assert waits == sorted(waits)
+    assert waits[0] == pytest.approx(0.1, abs=0.02)
+    assert waits[2] == pytest.approx(0.3, abs=0.02)
+
+
+def test_reservation_beyond_max_wait_is_rejected_and_not_charged(make_bucket):
+    bucket = make_bucket(rate=1, burst=1, max_wait=0.5)
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() is None
+    assert bucket.reserve() is None
+    # Las reservas rechazadas no consumen: la siguiente sigue a ~1 s, no a 3 s
+    bucket.max_wait = 2.0
+    assert bucket.reserve() == pytest.approx(1.0, abs=0.05)
+
+
+def test_tokens_refill_over_time(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr('webapp.time.monotonic', lambda: clock[0])
+    bucket = TokenBucket(rate=2, burst=2)
+    bucket.reserve()
+    bucket.reserve()
+    clock[0] += 0.5
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == pytest.approx(0.5)
+
+
+def test_acquire_records_stats():
+    bucket = TokenBucket(rate=100, burst=1, max_wait=0.05)
+    assert bucket.acquire()
+    assert bucket.acquire()
+    bucket.max_wait = 0
+    assert not bucket.acquire()
+    stats = bucket.stats()
+    assert (stats['acquired'], stats['delayed'], stats['rejected']) == (2, 1, 1)
+    assert stats['backend'] == 'memory'
+
+
+def test_sqlite_buckets_share_state(db):
+    first = SQLiteTokenBucket(db, 'serpapi', rate=1, burst=1, max_wait=0)
+    second = SQLiteTokenBucket(db, 'serpapi', rate=1, burst=1, max_wait=0)
+    assert first.reserve() == 0.0
+    assert second.reserve() is None
+    assert second.stats()['backend'] == 'sqlite'
@@ -1,14 +1,38 @@
 # webapp.py - Price Finder USA con Búsqueda por Imagen
-from flask import Flask, request, jsonify, session, redirect, url_for, render_template_string, flash
+from flask import Flask, Response, g, request, jsonify, session, redirect, url_for, flash, get_flashed_messages, stream_template
+from jinja2 import ChoiceLoader, DictLoader
+from werkzeug.middleware.proxy_fix import ProxyFix
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import re
 import html
 import time
 import io
+import json
+import hashlib
+import hmac
+import bisect
+import heapq
+import unicodedata
+import sqlite3
+import tempfile
+import threading
+import contextvars
+import uuid
+import sys
+import random
+import atexit
+import asyncio
+import queue
+import logging
+import logging.handlers
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 from datetime import datetime
 from urllib.parse import urlparse, quote_plus
-from functools import wraps
+from functools import wraps, lru_cache
 
 # Imports para búsqueda por imagen (opcionales)
 try:
@@ -19,6 +43,14 @@ except ImportError:
     PIL_AVAILABLE = False
     print("⚠️ PIL (Pillow) no disponible - búsqueda por imagen limitada")
 
+try:
+    import jwt
+    JWT_AVAILABLE = True
+except ImportError:
+    jwt = None
+    JWT_AVAILABLE = False
+    print("⚠️ PyJWT no disponible - los ID tokens de Firebase no se verifican (pip install PyJWT cryptography)")
+
 try:
     import google.generativeai as genai
     from google.api_core import exceptions as google_exceptions
@@ -36,12 +68,192 @@ app.config['PERMANENT_SESSION_LIFETIME'] = 1800
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SECURE'] = True if os.environ.get('RENDER') else False
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
+# SSE para el progreso de los jobs: solo con un servidor asíncrono delante (asgi.py lo activa)
+app.config['SEARCH_JOB_SSE'] = os.environ.get('SEARCH_JOB_SSE', 'false').lower() in ('1', 'true', 'yes')
+
+# Proxies de confianza delante de la app (Render añade uno): sin esto remote_addr
+# es la IP del proxy y todos los clientes comparten el mismo límite de login
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1 if os.environ.get('RENDER') else 0))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+def forwarded_client_ip(remote_addr, forwarded_for):
+    """IP real del cliente según X-Forwarded-For (misma regla que ProxyFix, para el modo ASGI)"""
+    if TRUSTED_PROXY_HOPS and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(',')]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return remote_addr
+
+# ==============================================================================
+# LOGGING ESTRUCTURADO (JSON, escritura en segundo plano)
+# ==============================================================================
+
+# Contexto de la petición (request_id, user, search_source) enlazado una vez por petición
+log_context_var = contextvars.ContextVar('log_context', default={})
+# Fracción de eventos informativos de alto volumen que se registran
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.1))
+
+def bind_log_context(**fields):
+    """Añade campos al contexto de logging del hilo/petición actual"""
+    context = dict(log_context_var.get())
+    context.update(fields)
+    log_context_var.set(context)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'context', None) or {})
+        entry.update(getattr(record, 'fields', None) or {})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class BackgroundWorker:
+    """Cola con un hilo consumidor que se arranca en el primer uso de cada proceso.
+    
+    Con gunicorn --preload los workers heredan por fork los objetos creados al
+    importar pero no sus hilos: cada proceso crea su propia cola y su hilo la
+    primera vez que encola algo. Imita put_nowait/qsize de queue.Queue y
+    `handle` recibe lotes de hasta batch_size elementos.
+    """
+    def __init__(self, name, handle, maxsize=0, batch_size=1, flush_timeout=5.0):
+        self.name = name
+        self.handle = handle
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self._reset()
+        # En el hijo el cerrojo heredado puede estar tomado y la cola tiene elementos del padre
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush, flush_timeout)
+    
+    def _reset(self):
+        self._start_lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+    
+    def _current_queue(self):
+        if self._pid == os.getpid():
+            return self._queue
+        with self._start_lock:
+            if self._pid != os.getpid():
+                work_queue = queue.Queue(maxsize=self.maxsize)
+                threading.Thread(target=self._run, args=(work_queue,), name=self.name, daemon=True).start()
+                self._queue = work_queue
+                self._pid = os.getpid()
+        return self._queue
+    
+    def put_nowait(self, item):
+        """Encola sin bloquear; lanza queue.Full si el hilo va atrasado"""
+        self._current_queue().put_nowait(item)
+    
+    def qsize(self):
+        return self._queue.qsize() if self._pid == os.getpid() else 0
+    
+    def _run(self, work_queue):
+        while True:
+            items = [work_queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(work_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.handle(items)
+            except Exception as e:
+                # Directo a stderr: este hilo puede ser el del propio logging
+                print(f"⚠️ Error en el hilo {self.name}: {e}", file=sys.stderr)
+            finally:
+                for _ in items:
+                    work_queue.task_done()
+    
+    def flush(self, timeout=5.0):
+        """Espera como mucho `timeout` s a que se procese lo encolado; False si no dio tiempo"""
+        if self._pid != os.getpid():
+            return True
+        work_queue = self._queue
+        deadline = time.monotonic() + timeout
+        with work_queue.all_tasks_done:
+            while work_queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                work_queue.all_tasks_done.wait(remaining)
+        return True
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """Encola el registro sin formatearlo; el JSON se genera en el hilo escritor"""
+    def __init__(self, worker):
+        super().__init__(worker)
+        self.dropped = 0
+    
+    def prepare(self, record):
+        record.context = log_context_var.get()
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Nunca bloquear la petición: si el escritor va atrasado se descarta
+            self.dropped += 1
+
+class StructuredLogger:
+    """Logger con campos estructurados y muestreo opcional por evento"""
+    def __init__(self, logger):
+        self.logger = logger
+    
+    def _log(self, level, message, sample, fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        if sample is not None and random.random() >= sample:
+            return
+        self.logger.log(level, message, extra={'fields': fields})
+    
+    def debug(self, message, sample=None, **fields):
+        self._log(logging.DEBUG, message, sample, fields)
+    
+    def info(self, message, sample=None, **fields):
+        self._log(logging.INFO, message, sample, fields)
+    
+    def warning(self, message, sample=None, **fields):
+        self._log(logging.WARNING, message, sample, fields)
+    
+    def error(self, message, sample=None, **fields):
+        self._log(logging.ERROR, message, sample, fields)
+
+def setup_logging():
+    logger = logging.getLogger('price_finder')
+    logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    logger.propagate = False
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    
+    def write(records):
+        for record in records:
+            output.handle(record)
+    
+    # El hilo escritor se arranca con el primer registro de cada proceso
+    worker = BackgroundWorker('log-writer', write, maxsize=int(os.environ.get('LOG_QUEUE_SIZE', 10000)),
+                              batch_size=100, flush_timeout=2.0)
+    handler = BackgroundQueueHandler(worker)
+    logger.addHandler(handler)
+    return StructuredLogger(logger), handler
+
+log, log_queue_handler = setup_logging()
 
 # Configuración de Gemini
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+# Endpoint alternativo (p. ej. el servidor simulado de bench/) vía transporte REST
+GEMINI_API_ENDPOINT = os.environ.get('GEMINI_API_ENDPOINT')
 if GEMINI_AVAILABLE and GEMINI_API_KEY:
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
+        if GEMINI_API_ENDPOINT:
+            genai.configure(api_key=GEMINI_API_KEY, transport='rest', client_options={'api_endpoint': GEMINI_API_ENDPOINT})
+        else:
+            genai.configure(api_key=GEMINI_API_KEY)
         print("✅ API de Google Gemini configurada correctamente")
         GEMINI_READY = True
     except Exception as e:
@@ -54,25 +266,455 @@ else:
     print("⚠️ Gemini no está disponible - búsqueda por imagen deshabilitada")
     GEMINI_READY = False
 
+# ==============================================================================
+# ALMACENAMIENTO LOCAL COMPARTIDO (SQLite)
+# ==============================================================================
+
+# Archivo SQLite compartido por todos los workers de gunicorn en el mismo host
+LOCAL_DB_PATH = os.environ.get('LOCAL_DB_PATH', os.path.join(tempfile.gettempdir(), 'price_finder_usa.sqlite3'))
+
+class SharedSQLite:
+    """Conexiones SQLite por hilo sobre un archivo compartido entre procesos"""
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+    
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=5000')
+            self._local.conn = conn
+        return conn
+    
+    def execute(self, sql, params=()):
+        return self.connect().execute(sql, params)
+    
+    def transaction(self):
+        """Transacción con bloqueo de escritura inmediato (BEGIN IMMEDIATE)"""
+        return _SQLiteTransaction(self.connect())
+
+class _SQLiteTransaction:
+    def __init__(self, conn):
+        self.conn = conn
+    
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+local_db = SharedSQLite(LOCAL_DB_PATH)
+
+# ==============================================================================
+# MÉTRICAS (formato de exposición Prometheus)
+# ==============================================================================
+
+# ID de la petición en curso y tiempos por fase; se propagan a los hilos del pool
+request_id_var = contextvars.ContextVar('request_id', default=None)
+request_timings_var = contextvars.ContextVar('request_timings', default=None)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+class _Metric:
+    kind = 'untyped'
+    
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def header(self):
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+
+class Counter(_Metric):
+    kind = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def render(self):
+        with self._lock:
+            return [f'{self.name}{_format_labels(k)} {v}' for k, v in sorted(self._values.items())]
+
+class Gauge(Counter):
+    kind = 'gauge'
+    
+    def __init__(self, name, help_text, callback=None):
+        super().__init__(name, help_text)
+        self.callback = callback
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+    
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+    
+    def render(self):
+        if self.callback:
+            # callback() -> {(('label', 'valor'),): valor}
+            try:
+                with self._lock:
+                    self._values = dict(self.callback())
+            except Exception as e:
+                log.error('Error leyendo métrica', metric=self.name, error=str(e))
+        return super().render()
+
+class Histogram(_Metric):
+    kind = 'histogram'
+    
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += 1
+            entry[2] += value
+    
+    def render(self):
+        lines = []
+        with self._lock:
+            for key, (counts, count, total) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{_format_labels(key + (("le", bound),))} {bucket_count}')
+                lines.append(f'{self.name}_bucket{_format_labels(key + (("le", "+Inf"),))} {count}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {round(total, 6)}')
+        return lines
+
+class MetricsRegistry:
+    """Métricas del proceso actual (cada worker de gunicorn expone las suyas)"""
+    def __init__(self):
+        self._metrics = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+PHASE_LATENCY = metrics.register(Histogram('pricefinder_phase_duration_seconds', 'Duración de cada fase del pipeline de búsqueda'))
+HTTP_LATENCY = metrics.register(Histogram('pricefinder_http_request_duration_seconds', 'Duración de las peticiones HTTP atendidas'))
+HTTP_IN_FLIGHT = metrics.register(Gauge('pricefinder_http_requests_in_flight', 'Peticiones HTTP en curso'))
+UPSTREAM_RESPONSES = metrics.register(Counter('pricefinder_upstream_responses_total', 'Respuestas de upstreams por código de estado'))
+UPSTREAM_BYTES = metrics.register(Counter('pricefinder_upstream_received_bytes_total', 'Bytes recibidos de upstreams'))
+
+def record_phase(phase, elapsed):
+    PHASE_LATENCY.observe(elapsed, phase=phase)
+    timings = request_timings_var.get()
+    if timings is not None:
+        timings.append((phase, elapsed))
+
+def timed(phase):
+    """Decorador: mide la fase en el histograma y en los tiempos de la petición"""
+    def decorator(f):
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await f(*args, **kwargs)
+                finally:
+                    record_phase(phase, time.perf_counter() - start)
+            return async_wrapper
+        
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                record_phase(phase, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def record_upstream_response(upstream, response):
+    UPSTREAM_RESPONSES.inc(upstream=upstream, status=response.status_code)
+    UPSTREAM_BYTES.inc(len(response.content), upstream=upstream)
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """executor.submit conservando el contexto (ID de petición, tiempos) del hilo actual"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+# ==============================================================================
+# CLIENTE HTTP COMPARTIDO (keep-alive + pool por host)
+# ==============================================================================
+
+class HttpClient:
+    """Sesión HTTP compartida con pools por host, keep-alive y reintentos en GET"""
+    def __init__(self, pool_hosts=10, pool_maxsize=20, retries=2, backoff=0.3):
+        retry = Retry(
+            total=retries, connect=retries, read=retries, backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+            raise_on_status=False
+        )
+        self.adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.pool_maxsize = pool_maxsize
+    
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        # POST no se reintenta: no es idempotente
+        return self.session.post(url, **kwargs)
+    
+    def stats(self):
+        hosts = {}
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_sent = pool.num_requests
+            connections = pool.num_connections
+            hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                'requests': requests_sent,
+                'connections_opened': connections,
+                'reuse_ratio': round(1 - connections / requests_sent, 4) if requests_sent else 0.0
+            }
+        return {'pool_maxsize': self.pool_maxsize, 'hosts': hosts}
+
+http_client = HttpClient(
+    pool_hosts=int(os.environ.get('HTTP_POOL_HOSTS', 10)),
+    pool_maxsize=int(os.environ.get('HTTP_POOL_MAXSIZE', 20)),
+    retries=int(os.environ.get('HTTP_RETRIES', 2)),
+    backoff=float(os.environ.get('HTTP_RETRY_BACKOFF', 0.3))
+)
+
+# ==============================================================================
+# VERIFICACIÓN LOCAL DE ID TOKENS DE FIREBASE
+# ==============================================================================
+
+AUTH_TOKEN_CHECKS = metrics.register(Counter('pricefinder_auth_token_checks_total', 'Validaciones de ID tokens por resultado'))
+
+class InvalidTokenError(ValueError):
+    pass
+
+class FirebaseTokenVerifier:
+    """Verifica ID tokens de Firebase (RS256, con PyJWT) sin llamar a Google en cada petición.
+    
+    Las claves públicas (JWKS) se descargan una vez y se renuevan al caducar
+    su Cache-Control o al aparecer un kid desconocido (rotación). Los claims
+    verificados se memorizan hasta su exp.
+    """
+    def __init__(self, project_id, jwks_url, leeway=60, max_memo=10000, min_refetch_interval=60):
+        self.project_id = project_id
+        self.issuer = f'https://securetoken.google.com/{project_id}'
+        self.jwks_url = jwks_url
+        self.leeway = leeway
+        self.max_memo = max_memo
+        self.min_refetch_interval = min_refetch_interval
+        self._keys = {}
+        self._keys_expire_at = 0.0
+        self._last_fetch = 0.0
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+    
+    def _fetch_keys(self):
+        response = http_client.get(self.jwks_url, timeout=5)
+        record_upstream_response('google_jwks', response)
+        response.raise_for_status()
+        keys = {}
+        for jwk in response.json().get('keys', []):
+            if jwk.get('kty') == 'RSA' and jwk.get('kid'):
+                try:
+                    keys[jwk['kid']] = jwt.PyJWK(jwk, algorithm='RS256').key
+                except jwt.PyJWKError as e:
+                    log.warning('Clave pública de Firebase no válida', kid=jwk['kid'], error=str(e))
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        self._keys = keys
+        self._keys_expire_at = time.time() + (int(match.group(1)) if match else 3600)
+        log.info('Claves públicas de Firebase actualizadas', keys=len(keys))
+    
+    def _public_key(self, kid):
+        now = time.time()
+        key = self._keys.get(kid)
+        if key is not None and now < self._keys_expire_at:
+            return key
+        with self._fetch_lock:
+            key = self._keys.get(kid)
+            stale = now >= self._keys_expire_at
+            # kid desconocido: refrescar, pero no más de una vez por intervalo
+            if stale or (key is None and now - self._last_fetch >= self.min_refetch_interval):
+                self._last_fetch = now
+                try:
+                    self._fetch_keys()
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    log.error('No se pudieron descargar las claves de Firebase', error=str(e))
+                key = self._keys.get(kid)
+        if key is None:
+            raise InvalidTokenError('kid desconocido')
+        return key
+    
+    def verify(self, token):
+        """Devuelve los claims del token o lanza InvalidTokenError"""
+        now = time.time()
+        with self._lock:
+            memo = self._memo.get(token)
+            if memo is not None and memo['exp'] > now:
+                self._memo.move_to_end(token)
+                AUTH_TOKEN_CHECKS.inc(outcome='memo')
+                return memo
+        try:
+            claims = self._verify(token, now)
+        except InvalidTokenError:
+            AUTH_TOKEN_CHECKS.inc(outcome='invalid')
+            raise
+        AUTH_TOKEN_CHECKS.inc(outcome='verified')
+        with self._lock:
+            self._memo[token] = claims
+            while len(self._memo) > self.max_memo:
+                self._memo.popitem(last=False)
+        return claims
+    
+    def _verify(self, token, now):
+        try:
+            header = jwt.get_unverified_header(str(token))
+        except jwt.InvalidTokenError as e:
+            raise InvalidTokenError(f'token mal formado: {e}')
+        if header.get('alg') != 'RS256':
+            raise InvalidTokenError('algoritmo no soportado')
+        key = self._public_key(header.get('kid'))
+        try:
+            # Firma, exp, aud e iss los comprueba PyJWT
+            claims = jwt.decode(
+                str(token), key, algorithms=['RS256'], audience=self.project_id, issuer=self.issuer,
+                leeway=self.leeway, options={'require': ['exp', 'iat', 'aud', 'iss', 'sub']}
+            )
+        except jwt.InvalidTokenError as e:
+            raise InvalidTokenError(str(e))
+        if not claims.get('sub'):
+            raise InvalidTokenError('sin sub')
+        if claims['iat'] > now + self.leeway or claims.get('auth_time', 0) > now + self.leeway:
+            raise InvalidTokenError('token emitido en el futuro')
+        return claims
+    
+    def stats(self):
+        with self._lock:
+            memo = len(self._memo)
+        return {'project_id': self.project_id, 'keys': len(self._keys), 'memoized_tokens': memo}
+
+class RefreshTokenStore:
+    """Refresh tokens de Firebase en SQLite; la cookie de sesión (firmada, no cifrada) solo lleva un handle opaco"""
+    def __init__(self, db, ttl=7200):
+        self.db = db
+        self.ttl = ttl
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS auth_refresh_tokens ('
+            'handle TEXT PRIMARY KEY, user_id TEXT NOT NULL, refresh_token TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_auth_refresh_tokens_expires ON auth_refresh_tokens(expires_at)')
+    
+    def put(self, user_id, refresh_token):
+        handle = os.urandom(18).hex()
+        now = time.time()
+        self.db.execute('DELETE FROM auth_refresh_tokens WHERE expires_at <= ?', (now,))
+        self.db.execute(
+            'INSERT INTO auth_refresh_tokens (handle, user_id, refresh_token, expires_at) VALUES (?, ?, ?, ?)',
+            (handle, user_id, refresh_token, now + self.ttl)
+        )
+        return handle
+    
+    def get(self, handle, user_id):
+        row = self.db.execute(
+            'SELECT refresh_token FROM auth_refresh_tokens WHERE handle = ? AND user_id = ? AND expires_at > ?',
+            (handle, user_id, time.time())
+        ).fetchone()
+        return row[0] if row else None
+    
+    def update(self, handle, refresh_token):
+        self.db.execute('UPDATE auth_refresh_tokens SET refresh_token = ? WHERE handle = ?', (refresh_token, handle))
+    
+    def delete(self, handle):
+        self.db.execute('DELETE FROM auth_refresh_tokens WHERE handle = ?', (handle,))
+
 # Firebase Auth Class
 class FirebaseAuth:
     def __init__(self):
         self.firebase_web_api_key = os.environ.get("FIREBASE_WEB_API_KEY")
+        self.auth_base_url = os.environ.get("FIREBASE_AUTH_URL", "https://identitytoolkit.googleapis.com").rstrip('/')
+        self.token_url = os.environ.get("FIREBASE_TOKEN_URL", "https://securetoken.googleapis.com").rstrip('/')
+        # Renovar el ID token cuando le quede menos de este margen
+        self.refresh_margin = int(os.environ.get("FIREBASE_TOKEN_REFRESH_MARGIN", 300))
+        self.project_id = os.environ.get("FIREBASE_PROJECT_ID")
+        # Mismo límite que la duración máxima de una sesión (ver is_user_logged_in)
+        self.refresh_tokens = RefreshTokenStore(local_db, ttl=7200)
+        self.token_verifier = None
         if not self.firebase_web_api_key:
             print("WARNING: FIREBASE_WEB_API_KEY no configurada")
         else:
             print("SUCCESS: Firebase Auth configurado")
+        if self.project_id and not JWT_AVAILABLE:
+            print("⚠️ FIREBASE_PROJECT_ID configurado pero falta PyJWT - los ID tokens no se verifican")
+        elif self.project_id:
+            self.token_verifier = FirebaseTokenVerifier(
+                self.project_id,
+                os.environ.get("FIREBASE_JWKS_URL", "https://www.googleapis.com/service_accounts/v1/jwk/securetoken@system.gserviceaccount.com")
+            )
+            print(f"✅ Verificación local de ID tokens activa (proyecto {self.project_id})")
+        else:
+            print("⚠️ FIREBASE_PROJECT_ID no configurado - los ID tokens no se verifican")
     
+    def sign_in_request(self, email, password):
+        """(url, payload) de signInWithPassword; compartido con el modo asíncrono"""
+        url = f"{self.auth_base_url}/v1/accounts:signInWithPassword?key={self.firebase_web_api_key}"
+        return url, {'email': email, 'password': password, 'returnSecureToken': True}
+    
+    @timed('firebase_login')
     def login_user(self, email, password):
         if not self.firebase_web_api_key:
             return {'success': False, 'message': 'Servicio no configurado', 'user_data': None, 'error_code': 'SERVICE_NOT_CONFIGURED'}
         
-        url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={self.firebase_web_api_key}"
-        payload = {'email': email, 'password': password, 'returnSecureToken': True}
-        
+        url, payload = self.sign_in_request(email, password)
         try:
-            response = requests.post(url, json=payload, timeout=8)
-            response.raise_for_status()
+            response = http_client.post(url, json=payload, timeout=8)
+            record_upstream_response('firebase', response)
+        except Exception as e:
+            log.error('Error de Firebase Auth', error=str(e))
+            return {'success': False, 'message': 'Error interno del servidor', 'user_data': None, 'error_code': 'UNEXPECTED_ERROR'}
+        return self.login_result(response, email)
+    
+    def login_result(self, response, email):
+        """Traduce la respuesta de signInWithPassword (requests o httpx) al resultado de login"""
+        try:
+            if response.status_code >= 400:
+                raise requests.exceptions.HTTPError(response=response)
             user_data = response.json()
             
             return {
@@ -82,139 +724,2107 @@ class FirebaseAuth:
                     'user_id': user_data['localId'],
                     'email': user_data['email'],
                     'display_name': user_data.get('displayName', email.split('@')[0]),
-                    'id_token': user_data['idToken']
+                    'id_token': user_data['idToken'],
+                    'refresh_token': user_data.get('refreshToken'),
+                    'expires_in': int(user_data.get('expiresIn', 3600))
                 },
                 'error_code': None
             }
-        except requests.exceptions.HTTPError as e:
+        except requests.exceptions.HTTPError:
+            try:
+                error_msg = response.json().get('error', {}).get('message', 'ERROR')
+                if 'INVALID' in error_msg or 'EMAIL_NOT_FOUND' in error_msg:
+                    return {'success': False, 'message': 'Correo o contraseña incorrectos', 'user_data': None, 'error_code': 'INVALID_CREDENTIALS'}
+                elif 'TOO_MANY_ATTEMPTS' in error_msg:
+                    return {'success': False, 'message': 'Demasiados intentos fallidos', 'user_data': None, 'error_code': 'TOO_MANY_ATTEMPTS'}
+                else:
+                    return {'success': False, 'message': 'Error de autenticacion', 'user_data': None, 'error_code': 'FIREBASE_ERROR'}
+            except:
+                return {'success': False, 'message': 'Error de conexion', 'user_data': None, 'error_code': 'CONNECTION_ERROR'}
+        except Exception as e:
+            log.error('Error de Firebase Auth', error=str(e))
+            return {'success': False, 'message': 'Error interno del servidor', 'user_data': None, 'error_code': 'UNEXPECTED_ERROR'}
+    
+    # Los métodos de sesión aceptan sess para el modo asíncrono (por defecto, la sesión de Flask)
+    
+    def set_user_session(self, user_data, sess=None):
+        sess = session if sess is None else sess
+        sess['user_id'] = user_data['user_id']
+        sess['user_name'] = user_data['display_name']
+        sess['user_email'] = user_data['email']
+        sess['id_token'] = user_data['id_token']
+        if sess.get('refresh_handle'):
+            self.refresh_tokens.delete(sess['refresh_handle'])
+        refresh_token = user_data.get('refresh_token')
+        sess['refresh_handle'] = self.refresh_tokens.put(user_data['user_id'], refresh_token) if refresh_token else None
+        sess['token_expires_at'] = time.time() + user_data.get('expires_in', 3600)
+        sess['login_time'] = datetime.now().isoformat()
+        sess.permanent = True
+    
+    @timed('firebase_refresh')
+    def refresh_id_token(self, sess=None):
+        """Renueva el ID token de la sesión con su refresh token; False si no es posible"""
+        sess = session if sess is None else sess
+        handle = sess.get('refresh_handle')
+        refresh_token = self.refresh_tokens.get(handle, sess.get('user_id')) if handle else None
+        if not refresh_token or not self.firebase_web_api_key:
+            return False
+        try:
+            response = http_client.post(
+                f"{self.token_url}/v1/token?key={self.firebase_web_api_key}",
+                data={'grant_type': 'refresh_token', 'refresh_token': refresh_token},
+                timeout=8
+            )
+            record_upstream_response('firebase', response)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            log.warning('No se pudo renovar el ID token', error=str(e))
+            return False
+        sess['id_token'] = data['id_token']
+        if data.get('refresh_token', refresh_token) != refresh_token:
+            self.refresh_tokens.update(handle, data['refresh_token'])
+        sess['token_expires_at'] = time.time() + int(data.get('expires_in', 3600))
+        AUTH_TOKEN_CHECKS.inc(outcome='refreshed')
+        return True
+    
+    def needs_token_refresh(self, sess=None):
+        sess = session if sess is None else sess
+        return self.token_verifier is not None and time.time() > sess.get('token_expires_at', 0) - self.refresh_margin
+    
+    def _has_valid_token(self, sess):
+        """Verifica localmente el ID token de la sesión, renovándolo si está por caducar"""
+        if self.needs_token_refresh(sess):
+            # Si la renovación falla se sigue con el token actual mientras no caduque
+            self.refresh_id_token(sess)
+        try:
+            claims = self.token_verifier.verify(sess.get('id_token'))
+        except InvalidTokenError as e:
+            log.warning('ID token rechazado', error=str(e))
+            return False
+        return claims['sub'] == sess.get('user_id')
+    
+    def clear_user_session(self):
+        if session.get('refresh_handle'):
+            self.refresh_tokens.delete(session['refresh_handle'])
+        important_data = {key: session.get(key) for key in ['timestamp'] if key in session}
+        session.clear()
+        for key, value in important_data.items():
+            session[key] = value
+    
+    def is_user_logged_in(self, sess=None):
+        sess = session if sess is None else sess
+        if 'user_id' not in sess or sess['user_id'] is None:
+            return False
+        if 'login_time' in sess:
+            try:
+                login_time = datetime.fromisoformat(sess['login_time'])
+                time_diff = (datetime.now() - login_time).total_seconds()
+                if time_diff > 7200:  # 2 horas maximo
+                    return False
+            except:
+                pass
+        if self.token_verifier is not None:
+            return self._has_valid_token(sess)
+        return True
+    
+    def get_current_user(self):
+        if not self.is_user_logged_in():
+            return None
+        return {
+            'user_id': session.get('user_id'),
+            'user_name': session.get('user_name'),
+            'user_email': session.get('user_email'),
+            'id_token': session.get('id_token')
+        }
+
+firebase_auth = FirebaseAuth()
+
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not firebase_auth.is_user_logged_in():
+            flash('Tu sesion ha expirado. Inicia sesion nuevamente.', 'warning')
+            return redirect(url_for('auth_login_page'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+# ==============================================================================
+# LIMITADOR DE INTENTOS DE LOGIN (por IP y por email)
+# ==============================================================================
+
+LOGIN_THROTTLE = metrics.register(Counter('pricefinder_login_throttle_total', 'Intentos de login permitidos o rechazados por el limitador'))
+
+class LoginThrottle:
+    """Ventana deslizante de intentos y backoff exponencial tras fallos.
+    
+    Cada clave (ip:..., email:...) guarda [ventana, intentos_ventana_anterior,
+    intentos_ventana_actual, fallos_seguidos, bloqueado_hasta]. El recuento
+    deslizante pondera la ventana anterior por la fracción que aún solapa.
+    Las claves viven en un LRU acotado para que un ataque con muchas IPs o
+    emails no haga crecer la memoria.
+    """
+    def __init__(self, window=300, ip_limit=20, email_limit=5, ip_free_failures=10, email_free_failures=3,
+                 backoff_base=1.0, backoff_max=900, max_keys=10000):
+        self.window = float(window)
+        self.limits = {'ip': ip_limit, 'email': email_limit}
+        self.free_failures = {'ip': ip_free_failures, 'email': email_free_failures}
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.max_keys = max_keys
+        self._state = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _keys(ip, email):
+        email_hash = hashlib.sha256(email.lower().encode('utf-8')).hexdigest()[:24]
+        return [('ip', f'ip:{ip}'), ('email', f'email:{email_hash}')]
+    
+    def _roll(self, state, now):
+        """Avanza la ventana del estado y devuelve el recuento deslizante"""
+        current = int(now // self.window)
+        if state[0] != current:
+            state[1] = state[2] if state[0] == current - 1 else 0
+            state[2] = 0
+            state[0] = current
+        overlap = 1 - (now % self.window) / self.window
+        return state[1] * overlap + state[2]
+    
+    def _check(self, scope, state, now):
+        """Segundos de espera si la clave está bloqueada o al límite; 0 si puede intentarlo"""
+        if state[4] > now:
+            return state[4] - now, 'backoff'
+        if self._roll(state, now) + 1 > self.limits[scope]:
+            return self.window - now % self.window, 'rate'
+        return 0.0, None
+    
+    def _apply_result(self, scope, state, success, now):
+        if success:
+            state[3] = 0
+            state[4] = 0.0
+            return
+        state[3] += 1
+        excess = state[3] - self.free_failures[scope]
+        if excess >= 0:
+            state[4] = now + min(self.backoff_max, self.backoff_base * 2 ** excess)
+    
+    def _new_state(self, now):
+        return [int(now // self.window), 0, 0, 0, 0.0]
+    
+    def _get(self, key, now):
+        state = self._state.get(key)
+        if state is None:
+            state = self._state[key] = self._new_state(now)
+            while len(self._state) > self.max_keys:
+                self._state.popitem(last=False)
+        self._state.move_to_end(key)
+        return state
+    
+    def attempt(self, ip, email):
+        """Registra un intento; devuelve los segundos que debe esperar (0 si se permite)"""
+        now = time.time()
+        keys = self._keys(ip, email)
+        with self._lock:
+            states = [(scope, self._get(key, now)) for scope, key in keys]
+            retry_after = self._evaluate(states, now)
+        return retry_after
+    
+    def _evaluate(self, states, now):
+        for scope, state in states:
+            wait, reason = self._check(scope, state, now)
+            if wait:
+                LOGIN_THROTTLE.inc(outcome=f'rejected_{reason}', scope=scope)
+                return wait
+        for scope, state in states:
+            state[2] += 1
+        LOGIN_THROTTLE.inc(outcome='allowed')
+        return 0.0
+    
+    def record_result(self, ip, email, success):
+        now = time.time()
+        with self._lock:
+            for scope, key in self._keys(ip, email):
+                self._apply_result(scope, self._get(key, now), success, now)
+    
+    def stats(self):
+        with self._lock:
+            tracked = len(self._state)
+        return {'backend': 'memory', 'tracked_keys': tracked, 'max_keys': self.max_keys, 'window_sec': self.window}
+
+class SQLiteLoginThrottle(LoginThrottle):
+    """Mismo limitador con el estado en SQLite, compartido entre workers"""
+    def __init__(self, db, **kwargs):
+        super().__init__(**kwargs)
+        self.db = db
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS login_throttle ('
+            'key TEXT PRIMARY KEY, window INTEGER NOT NULL, previous INTEGER NOT NULL, current INTEGER NOT NULL, '
+            'failures INTEGER NOT NULL, blocked_until REAL NOT NULL, updated_at REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_login_throttle_updated ON login_throttle(updated_at)')
+    
+    def _load(self, conn, keys, now):
+        states = []
+        for scope, key in keys:
+            row = conn.execute(
+                'SELECT window, previous, current, failures, blocked_until FROM login_throttle WHERE key = ?', (key,)
+            ).fetchone()
+            states.append((scope, key, list(row) if row else self._new_state(now)))
+        return states
+    
+    def _store(self, conn, states, now):
+        conn.executemany(
+            'INSERT OR REPLACE INTO login_throttle VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(key, *state, now) for _, key, state in states]
+        )
+        # LRU acotado: se descartan las claves menos recientes por encima del máximo
+        overflow = conn.execute('SELECT COUNT(*) FROM login_throttle').fetchone()[0] - self.max_keys
+        if overflow > 0:
+            conn.execute(
+                'DELETE FROM login_throttle WHERE key IN '
+                '(SELECT key FROM login_throttle ORDER BY updated_at ASC LIMIT ?)', (overflow,)
+            )
+    
+    def attempt(self, ip, email):
+        now = time.time()
+        with self.db.transaction() as conn:
+            states = self._load(conn, self._keys(ip, email), now)
+            retry_after = self._evaluate([(scope, state) for scope, _, state in states], now)
+            self._store(conn, states, now)
+        return retry_after
+    
+    def record_result(self, ip, email, success):
+        now = time.time()
+        with self.db.transaction() as conn:
+            states = self._load(conn, self._keys(ip, email), now)
+            for scope, _, state in states:
+                self._apply_result(scope, state, success, now)
+            self._store(conn, states, now)
+    
+    def stats(self):
+        tracked = self.db.execute('SELECT COUNT(*) FROM login_throttle').fetchone()[0]
+        return {'backend': 'sqlite', 'tracked_keys': tracked, 'max_keys': self.max_keys, 'window_sec': self.window}
+
+def create_login_throttle():
+    """Limitador de login según LOGIN_* (LOGIN_THROTTLE_SHARED para compartirlo entre workers)"""
+    options = dict(
+        window=float(os.environ.get('LOGIN_WINDOW', 300)),
+        ip_limit=int(os.environ.get('LOGIN_IP_LIMIT', 20)),
+        email_limit=int(os.environ.get('LOGIN_EMAIL_LIMIT', 5)),
+        backoff_base=float(os.environ.get('LOGIN_BACKOFF_BASE', 1)),
+        backoff_max=float(os.environ.get('LOGIN_BACKOFF_MAX', 900)),
+        max_keys=int(os.environ.get('LOGIN_THROTTLE_MAX_KEYS', 10000))
+    )
+    if os.environ.get('LOGIN_THROTTLE_SHARED', '').lower() in ('1', 'true', 'yes'):
+        try:
+            return SQLiteLoginThrottle(local_db, **options)
+        except sqlite3.Error as e:
+            print(f"⚠️ Limitador de login compartido no disponible ({e}) - usando limitador por proceso")
+    return LoginThrottle(**options)
+
+login_throttle = create_login_throttle()
+
+# ==============================================================================
+# FUNCIONES DE BÚSQUEDA POR IMAGEN
+# ==============================================================================
+
+def compute_dhash(image):
+    """Hash perceptual (dHash de 64 bits) de una imagen PIL"""
+    small = image.convert('L').resize((9, 8), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        offset = row * 9
+        for col in range(8):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+class MultiIndexHashTable:
+    """Índice multi-tabla para búsquedas por distancia de Hamming.
+    
+    El hash de 64 bits se divide en max_distance + 1 trozos; dos hashes a
+    distancia <= max_distance coinciden exactamente en al menos un trozo, así
+    que solo se comparan los candidatos que comparten algún trozo.
+    """
+    def __init__(self, max_distance=6, bits=64):
+        chunks = max_distance + 1
+        widths = [bits // chunks + (1 if i < bits % chunks else 0) for i in range(chunks)]
+        self.max_distance = max_distance
+        self._slices = []
+        shift = bits
+        for width in widths:
+            shift -= width
+            self._slices.append((shift, (1 << width) - 1))
+        self._tables = [{} for _ in self._slices]
+        self._values = set()
+    
+    def __len__(self):
+        return len(self._values)
+    
+    def __contains__(self, value):
+        return value in self._values
+    
+    def add(self, value):
+        if value in self._values:
+            return
+        self._values.add(value)
+        for table, (shift, mask) in zip(self._tables, self._slices):
+            table.setdefault((value >> shift) & mask, set()).add(value)
+    
+    def remove(self, value):
+        if value not in self._values:
+            return
+        self._values.discard(value)
+        for table, (shift, mask) in zip(self._tables, self._slices):
+            bucket = table.get((value >> shift) & mask)
+            if bucket is not None:
+                bucket.discard(value)
+                if not bucket:
+                    del table[(value >> shift) & mask]
+    
+    def search(self, value, max_distance=None):
+        """Devuelve [(distancia, valor)] ordenado por distancia"""
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        candidates = set()
+        for table, (shift, mask) in zip(self._tables, self._slices):
+            bucket = table.get((value >> shift) & mask)
+            if bucket:
+                candidates.update(bucket)
+        found = []
+        for candidate in candidates:
+            distance = bin(candidate ^ value).count('1')
+            if distance <= max_distance:
+                found.append((distance, candidate))
+        found.sort()
+        return found
+
+class ImageQueryCache:
+    """Caché de consultas generadas por Gemini indexada por hash perceptual.
+    
+    Las entradas viven en SQLite (compartidas entre workers) con TTL y
+    expulsión LRU; cada worker mantiene un índice multi-tabla en memoria que se
+    sincroniza de forma incremental para buscar vecinos por distancia de Hamming.
+    """
+    def __init__(self, db, max_entries=200000, ttl=7 * 86400, max_distance=6, sync_interval=1.0):
+        self.db = db
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.sync_interval = sync_interval
+        self._index = MultiIndexHashTable(max_distance)
+        self._last_rowid = 0
+        self._last_sync = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        with self.db.transaction() as conn:
+            # Archivos creados con el nombre anterior de la columna
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(image_query_cache)')]
+            if 'phash' in columns:
+                conn.execute('ALTER TABLE image_query_cache RENAME COLUMN phash TO dhash')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS image_query_cache ('
+                'dhash TEXT PRIMARY KEY, query TEXT NOT NULL, '
+                'created_at REAL NOT NULL, last_access REAL NOT NULL)'
+            )
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_image_query_access ON image_query_cache(last_access)')
+    
+    def _sync(self):
+        """Incorpora al índice las entradas añadidas por cualquier worker"""
+        now = time.time()
+        if now - self._last_sync < self.sync_interval:
+            return
+        self._last_sync = now
+        rows = self.db.execute(
+            'SELECT rowid, dhash FROM image_query_cache WHERE rowid > ? ORDER BY rowid', (self._last_rowid,)
+        ).fetchall()
+        for rowid, dhash in rows:
+            self._index.add(int(dhash, 16))
+            self._last_rowid = rowid
+    
+    def lookup(self, dhash):
+        with self._lock:
+            self._sync()
+            candidates = self._index.search(dhash)
+        now = time.time()
+        for distance, value in candidates:
+            # Las entradas expulsadas por otros workers se descartan al verificarlas
+            row = self.db.execute(
+                'SELECT query, created_at FROM image_query_cache WHERE dhash = ?', (f'{value:016x}',)
+            ).fetchone()
+            if row is None or row[1] + self.ttl <= now:
+                with self._lock:
+                    self._index.remove(value)
+                continue
+            self.db.execute('UPDATE image_query_cache SET last_access = ? WHERE dhash = ?', (now, f'{value:016x}'))
+            with self._lock:
+                self.hits += 1
+                self.near_hits += distance > 0
+            return row[0]
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def store(self, dhash, query):
+        now = time.time()
+        with self.db.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO image_query_cache (dhash, query, created_at, last_access) VALUES (?, ?, ?, ?)',
+                (f'{dhash:016x}', query, now, now)
+            )
+            expired = conn.execute('DELETE FROM image_query_cache WHERE created_at <= ?', (now - self.ttl,)).rowcount
+            overflow = conn.execute('SELECT COUNT(*) FROM image_query_cache').fetchone()[0] - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    'DELETE FROM image_query_cache WHERE dhash IN '
+                    '(SELECT dhash FROM image_query_cache ORDER BY last_access ASC LIMIT ?)', (overflow,)
+                )
+        with self._lock:
+            self.evictions += expired + max(overflow, 0)
+            self._index.add(dhash)
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries_indexed': len(self._index),
+            'max_entries': self.max_entries,
+            'max_distance': self.max_distance,
+            'hits': self.hits,
+            'near_hits': self.near_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / total, 4) if total else 0.0
+        }
+
+image_query_cache = None
+if PIL_AVAILABLE:
+    try:
+        image_query_cache = ImageQueryCache(
+            local_db,
+            max_entries=int(os.environ.get('IMAGE_CACHE_MAX_ENTRIES', 200000)),
+            ttl=int(os.environ.get('IMAGE_CACHE_TTL', 7 * 86400)),
+            max_distance=int(os.environ.get('IMAGE_CACHE_MAX_DISTANCE', 6))
+        )
+    except sqlite3.Error as e:
+        print(f"⚠️ Caché de imágenes no disponible: {e}")
+
+# Límites de la etapa de preprocesado de imágenes
+IMAGE_MAX_SIDE = int(os.environ.get('IMAGE_MAX_SIDE', 1024))
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 40_000_000))
+IMAGE_MAX_BYTES = 10 * 1024 * 1024
+# Imágenes ya reducidas en el navegador (campo image_compact)
+IMAGE_COMPACT_MAX_BYTES = int(os.environ.get('IMAGE_COMPACT_MAX_BYTES', 1536 * 1024))
+ALLOWED_IMAGE_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+class PreparedImage:
+    """Imagen decodificada una sola vez, reducida y re-codificada como JPEG compacto"""
+    def __init__(self, jpeg_bytes, size, source_format, original_size, dhash):
+        self.jpeg_bytes = jpeg_bytes
+        self.size = size
+        self.source_format = source_format
+        self.original_size = original_size
+        self.dhash = dhash
+    
+    def __len__(self):
+        return len(self.jpeg_bytes)
+
+def _open_image_header(source):
+    """Abre la imagen leyendo solo la cabecera y valida formato y dimensiones"""
+    stream = io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+    image = Image.open(stream)
+    width, height = image.size
+    if image.format not in ALLOWED_IMAGE_FORMATS:
+        return None
+    if width < 10 or height < 10 or width * height > IMAGE_MAX_PIXELS:
+        return None
+    return image
+
+@timed('prepare_image')
+def prepare_image(source, max_side=None):
+    """Valida, decodifica (con reducción en JPEG vía draft) y re-codifica una imagen.
+    
+    Acepta bytes o un stream (p. ej. el de la subida) y devuelve un
+    PreparedImage o None si la imagen no es válida.
+    """
+    return _reencode_image(source, max_side)
+
+def _reencode_image(source, max_side=None):
+    """prepare_image sin medir, para quien ya mide la fase"""
+    if not PIL_AVAILABLE or not source:
+        return None
+    max_side = max_side or IMAGE_MAX_SIDE
+    try:
+        image = _open_image_header(source)
+        if image is None:
+            return None
+        source_format = image.format
+        original_size = image.size
+        if source_format == 'JPEG':
+            # El decodificador JPEG reduce en potencias de 2 sin decodificar a tamaño completo
+            image.draft('RGB', (max_side, max_side))
+        image.thumbnail((max_side, max_side), Image.Resampling.BILINEAR, reducing_gap=2.0)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=85)
+        return PreparedImage(buffer.getvalue(), image.size, source_format, original_size, compute_dhash(image))
+    except Exception as e:
+        log.warning('Error preprocesando imagen', error=str(e))
+        return None
+
+@timed('prepare_image')
+def prepare_compact_image(data):
+    """Imagen reducida en el navegador: un JPEG dentro de IMAGE_MAX_SIDE se envía a
+    Gemini tal cual y solo se decodifica a baja resolución para el dHash"""
+    if not PIL_AVAILABLE or not data:
+        return None
+    try:
+        image = _open_image_header(data)
+        if image is None:
+            return None
+        if image.format != 'JPEG' or max(image.size) > IMAGE_MAX_SIDE:
+            # WebP (o un JPEG mayor de lo esperado): re-codificar como cualquier subida
+            return _reencode_image(data)
+        size = image.size
+        image.draft('L', (64, 64))
+        return PreparedImage(data, size, 'JPEG', size, compute_dhash(image))
+    except Exception as e:
+        log.warning('Error preprocesando imagen', error=str(e))
+        return None
+
+def prepare_uploaded_image(image_file, compact=False):
+    """Preprocesa una subida leyendo directamente su stream; devuelve (imagen, error)"""
+    stream = image_file.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    log.info('Imagen recibida', sample=LOG_SAMPLE_RATE, bytes=size, compact=compact)
+    if compact:
+        if size > IMAGE_COMPACT_MAX_BYTES:
+            return None, 'La imagen es demasiado grande'
+        prepared = prepare_compact_image(stream.read())
+    elif size > IMAGE_MAX_BYTES:
+        return None, 'La imagen es demasiado grande (máximo 10MB)'
+    else:
+        prepared = prepare_image(stream)
+    if prepared is None:
+        return None, 'Imagen no válida (usa JPG, PNG o WEBP)'
+    return prepared, None
+
+GEMINI_MODEL = 'gemini-1.5-flash-latest'
+GEMINI_PROMPT = """
+Analiza esta imagen de producto y genera una consulta de búsqueda específica en inglés para encontrarlo en tiendas online.
+
+Incluye:
+- Nombre exacto del producto
+- Marca (si es visible)
+- Modelo o características distintivas
+- Color, tamaño
+- Categoría del producto
+
+Responde SOLO con la consulta de búsqueda optimizada para e-commerce.
+Ejemplo: "blue tape painter's tape 2 inch width"
+"""
+
+def _prepare_gemini_request(image_content):
+    """(imagen preparada, dhash, consulta ya cacheada) o None si la imagen no es válida"""
+    # Decodificar una sola vez (si no viene ya preprocesada)
+    prepared = image_content if isinstance(image_content, PreparedImage) else prepare_image(image_content)
+    if prepared is None:
+        return None
+    
+    # Imágenes iguales o casi iguales reutilizan la consulta ya generada
+    dhash = prepared.dhash if image_query_cache else None
+    if dhash is not None:
+        cached_query = image_query_cache.lookup(dhash)
+        if cached_query:
+            log.info('Consulta desde caché de imagen', sample=LOG_SAMPLE_RATE, query=cached_query)
+            return prepared, dhash, cached_query
+    return prepared, dhash, None
+
+def _gemini_contents(prepared):
+    return [GEMINI_PROMPT, {'mime_type': 'image/jpeg', 'data': prepared.jpeg_bytes}]
+
+def _query_from_gemini_response(response, dhash):
+    if response.text:
+        search_query = response.text.strip()
+        log.info('Consulta generada desde imagen', query=search_query)
+        if dhash is not None:
+            image_query_cache.store(dhash, search_query)
+        return search_query
+    return None
+
+# ==============================================================================
+# CLIENTE DE GEMINI (concurrencia acotada, plazo y reintentos)
+# ==============================================================================
+
+GEMINI_CALLS = metrics.register(Counter('pricefinder_gemini_calls_total', 'Llamadas a Gemini por resultado'))
+GEMINI_CALL_LATENCY = metrics.register(Histogram('pricefinder_gemini_call_duration_seconds', 'Duración de cada intento de llamada a Gemini'))
+
+# Errores de Gemini que justifican reintentar (sobrecarga o fallo temporal del servicio)
+GEMINI_TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+if google_exceptions:
+    GEMINI_TRANSIENT_ERRORS += (
+        google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError, google_exceptions.DeadlineExceeded
+    )
+
+class GeminiClient:
+    """Modelo de Gemini compartido con llamadas en curso limitadas y cola acotada.
+    
+    Si la cola está llena (o la espera supera queue_timeout) la llamada se
+    rechaza y la búsqueda sigue solo con el texto. Cada llamada tiene un
+    plazo total (timeout) que incluye los reintentos con backoff y jitter.
+    """
+    def __init__(self, model, max_concurrent=4, max_queue=16, queue_timeout=2.0, timeout=12.0, retries=2, backoff=0.5):
+        self.model = model
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._in_flight = 0
+        self.calls = 0
+        self.rejected = 0
+        self.retried = 0
+        self.timeouts = 0
+        self.errors = 0
+    
+    def _enter_queue(self):
+        with self._lock:
+            if self._queued >= self.max_queue:
+                return False
+            self._queued += 1
+            return True
+    
+    def _wait_slot(self):
+        try:
+            return self._slots.acquire(timeout=self.queue_timeout)
+        finally:
+            with self._lock:
+                self._queued -= 1
+    
+    def _admitted(self, acquired):
+        with self._lock:
+            if acquired:
+                self._in_flight += 1
+            else:
+                self.rejected += 1
+        if not acquired:
+            GEMINI_CALLS.inc(outcome='rejected')
+            log.warning('Gemini saturado - se continúa sin análisis de imagen', queued=self._queued, in_flight=self._in_flight)
+        return acquired
+    
+    def _admit(self):
+        if self._slots.acquire(blocking=False):
+            return self._admitted(True)
+        return self._admitted(self._enter_queue() and self._wait_slot())
+    
+    async def _admit_async(self):
+        if self._slots.acquire(blocking=False):
+            return self._admitted(True)
+        if not self._enter_queue():
+            return self._admitted(False)
+        # La espera por un hueco bloquea un hilo, nunca el event loop
+        wait = asyncio.ensure_future(asyncio.to_thread(self._wait_slot))
+        try:
+            acquired = await asyncio.shield(wait)
+        except asyncio.CancelledError:
+            # El hilo sigue esperando: si obtiene el hueco, nadie lo usará
+            wait.add_done_callback(self._release_abandoned)
+            raise
+        return self._admitted(acquired)
+    
+    def _release_abandoned(self, wait):
+        """Devuelve el hueco obtenido por un llamante asíncrono ya cancelado"""
+        if not wait.cancelled() and wait.exception() is None and wait.result():
+            self._slots.release()
+    
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+    
+    def _record(self, outcome, elapsed):
+        GEMINI_CALL_LATENCY.observe(elapsed, outcome=outcome)
+        GEMINI_CALLS.inc(outcome=outcome)
+        with self._lock:
+            self.calls += 1
+            if outcome == 'timeout':
+                self.timeouts += 1
+            elif outcome in ('error', 'transient_error'):
+                self.errors += 1
+    
+    def _retry_delay(self, attempt, deadline):
+        """Espera antes del siguiente intento (full jitter) o None si no hay más intentos o tiempo"""
+        if attempt >= self.retries:
+            return None
+        delay = random.uniform(0, self.backoff * (2 ** attempt))
+        if time.monotonic() + delay >= deadline:
+            return None
+        with self._lock:
+            self.retried += 1
+        return delay
+    
+    @staticmethod
+    def _outcome(error):
+        if isinstance(error, (asyncio.TimeoutError, requests.exceptions.Timeout)) or (
+                google_exceptions and isinstance(error, google_exceptions.DeadlineExceeded)):
+            return 'timeout'
+        return 'transient_error' if isinstance(error, GEMINI_TRANSIENT_ERRORS) else 'error'
+    
+    def generate(self, contents):
+        """Respuesta de Gemini, o None si se rechaza, vence el plazo o falla"""
+        if not self._admit():
+            return None
+        try:
+            deadline = time.monotonic() + self.timeout
+            attempt = 0
+            while True:
+                start = time.perf_counter()
+                try:
+                    response = self.model.generate_content(
+                        contents, request_options={'timeout': max(0.1, deadline - time.monotonic())}
+                    )
+                    self._record('ok', time.perf_counter() - start)
+                    return response
+                except Exception as e:
+                    outcome = self._outcome(e)
+                    self._record(outcome, time.perf_counter() - start)
+                    delay = self._retry_delay(attempt, deadline) if outcome != 'error' else None
+                    if delay is None:
+                        log.error('Error en llamada a Gemini', outcome=outcome, attempts=attempt + 1, error=str(e))
+                        return None
+                    time.sleep(delay)
+                    attempt += 1
+        finally:
+            self._release()
+    
+    async def generate_async(self, contents):
+        """Versión asíncrona de generate (modo ASGI)"""
+        if not await self._admit_async():
+            return None
+        try:
+            deadline = time.monotonic() + self.timeout
+            attempt = 0
+            while True:
+                start = time.perf_counter()
+                remaining = max(0.1, deadline - time.monotonic())
+                try:
+                    if GEMINI_API_ENDPOINT:
+                        # El transporte REST no tiene cliente asíncrono
+                        call = asyncio.to_thread(self.model.generate_content, contents, request_options={'timeout': remaining})
+                    else:
+                        call = self.model.generate_content_async(contents, request_options={'timeout': remaining})
+                    response = await asyncio.wait_for(call, remaining)
+                    self._record('ok', time.perf_counter() - start)
+                    return response
+                except Exception as e:
+                    outcome = self._outcome(e)
+                    self._record(outcome, time.perf_counter() - start)
+                    delay = self._retry_delay(attempt, deadline) if outcome != 'error' else None
+                    if delay is None:
+                        log.error('Error en llamada a Gemini', outcome=outcome, attempts=attempt + 1, error=str(e))
+                        return None
+                    await asyncio.sleep(delay)
+                    attempt += 1
+        finally:
+            self._release()
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'in_flight': self._in_flight,
+                'queued': self._queued,
+                'calls': self.calls,
+                'rejected': self.rejected,
+                'retried': self.retried,
+                'timeouts': self.timeouts,
+                'errors': self.errors
+            }
+
+gemini_client = None
+if GEMINI_READY:
+    # Un solo handle del modelo para todo el proceso
+    gemini_client = GeminiClient(
+        genai.GenerativeModel(GEMINI_MODEL),
+        max_concurrent=int(os.environ.get('GEMINI_MAX_CONCURRENT', 4)),
+        max_queue=int(os.environ.get('GEMINI_MAX_QUEUE', 16)),
+        queue_timeout=float(os.environ.get('GEMINI_QUEUE_TIMEOUT', 2)),
+        timeout=float(os.environ.get('GEMINI_TIMEOUT', 12)),
+        retries=int(os.environ.get('GEMINI_RETRIES', 2)),
+        backoff=float(os.environ.get('GEMINI_RETRY_BACKOFF', 0.5))
+    )
+
+@timed('gemini')
+def analyze_image_with_gemini(image_content):
+    """Analiza imagen con Gemini Vision"""
+    if not GEMINI_READY or not PIL_AVAILABLE or not image_content:
+        log.warning('Gemini o PIL no disponible para análisis de imagen')
+        return None
+    
+    try:
+        request_data = _prepare_gemini_request(image_content)
+        if request_data is None:
+            return None
+        prepared, dhash, cached_query = request_data
+        if cached_query:
+            return cached_query
+        
+        log.debug('Analizando imagen con Gemini Vision')
+        response = gemini_client.generate(_gemini_contents(prepared))
+        return _query_from_gemini_response(response, dhash) if response is not None else None
+            
+    except Exception as e:
+        log.error('Error analizando imagen', error=str(e))
+        return None
+
+@timed('gemini')
+async def analyze_image_with_gemini_async(image_content):
+    """Versión asíncrona de analyze_image_with_gemini (modo ASGI)"""
+    if not GEMINI_READY or not PIL_AVAILABLE or not image_content:
+        log.warning('Gemini o PIL no disponible para análisis de imagen')
+        return None
+    
+    try:
+        # Decodificar y calcular el dHash es CPU: fuera del event loop
+        request_data = await asyncio.to_thread(_prepare_gemini_request, image_content)
+        if request_data is None:
+            return None
+        prepared, dhash, cached_query = request_data
+        if cached_query:
+            return cached_query
+        
+        log.debug('Analizando imagen con Gemini Vision')
+        response = await gemini_client.generate_async(_gemini_contents(prepared))
+        return _query_from_gemini_response(response, dhash) if response is not None else None
+            
+    except Exception as e:
+        log.error('Error analizando imagen', error=str(e))
+        return None
+
+@timed('validate_image')
+def validate_image(image_content):
+    """Valida imagen"""
+    if not PIL_AVAILABLE or not image_content:
+        return False
+    if isinstance(image_content, PreparedImage):
+        return True
+    
+    try:
+        # Solo cabecera: no decodifica los píxeles
+        return _open_image_header(image_content) is not None
+    except:
+        return False
+
+# ==============================================================================
+# CANONICALIZACIÓN DE CONSULTAS
+# ==============================================================================
+
+# Solo artículos y ruido comercial. La clave decide qué resultados se sirven:
+# preposiciones ("slip on", "usb c to lightning"), "con"/"sin", "new" o
+# tiendas ("best buy") cambian lo que se busca y se conservan
+QUERY_STOPWORDS = frozenset(
+    'a an the cheap cheapest sale deal deals price prices online '
+    'el la los las un una unos unas barato barata baratos baratas oferta ofertas precio precios'.split()
+)
+# Palabras que separan partes con dirección: el orden entre partes se conserva
+QUERY_DIRECTION_WORDS = frozenset('to from into vs versus'.split())
+# Terminaciones en -s que no son plurales ("lens", "news", "plus", "glass", "tennis")
+_QUERY_SINGULAR_ENDINGS = ('ss', 'us', 'ns', 'ws', 'is')
+KNOWN_BRANDS = frozenset(
+    'apple samsung sony lg bose jbl beats nike adidas puma reebok dell hp lenovo asus acer msi microsoft '
+    'google nintendo playstation xbox canon nikon gopro dyson xiaomi motorola oneplus logitech razer '
+    'garmin fitbit kitchenaid ninja keurig philips panasonic toshiba lego hasbro anker'.split()
+)
+_QUERY_POSSESSIVE_RE = re.compile(r"(?<=\w)['’]s\b")
+_QUERY_PUNCT_RE = re.compile(r'[\W_]+')
+_QUERY_ALNUM_SPLIT_RE = re.compile(r'(?<=[^\W\d_])(?=\d)|(?<=\d)(?=[^\W\d_])')
+
+CanonicalQuery = namedtuple('CanonicalQuery', ['key', 'brand', 'models'])
+
+def _singular(token):
+    """Plural simple ("cases" -> "case", "glasses" -> "glass"); no toca marcas,
+    números ni palabras como "lens", "news" o "plus"."""
+    if len(token) <= 3 or not token.endswith('s') or token in KNOWN_BRANDS:
+        return token
+    if token.endswith('sses'):
+        return token[:-2]
+    if token.endswith(_QUERY_SINGULAR_ENDINGS):
+        return token
+    return token[:-1]
+
+@lru_cache(maxsize=4096)
+def canonicalize_query(query):
+    """Forma canónica de una consulta: "iPhone 15 case", "iphone15 case " y
+    "case iphone 15" dan la misma clave. Devuelve CanonicalQuery(clave, marca, modelos).
+    
+    Las palabras se ordenan dentro de cada parte separada por "to"/"from"/...,
+    así que "usb c to lightning" y "lightning to usb c" son claves distintas;
+    las repeticiones se conservan ("usb c to usb c").
+    """
+    text = unicodedata.normalize('NFKD', unicodedata.normalize('NFKC', str(query or '')).casefold())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = _QUERY_POSSESSIVE_RE.sub('', text)
+    text = _QUERY_ALNUM_SPLIT_RE.sub(' ', _QUERY_PUNCT_RE.sub(' ', text))
+    parts = [[]]
+    for token in text.split():
+        token = _singular(token)
+        # Después del plural, para que la forma canónica sea idempotente ("prices" -> "price")
+        if token in QUERY_STOPWORDS:
+            continue
+        if token in QUERY_DIRECTION_WORDS:
+            parts.append([token])
+            parts.append([])
+            continue
+        parts[-1].append(token)
+    tokens = [token for part in parts for token in part]
+    if not tokens:
+        # Consulta formada solo por stopwords: se usa tal cual
+        return CanonicalQuery(' '.join(text.split()), None, ())
+    brand = next((t for t in sorted(tokens) if t in KNOWN_BRANDS), None)
+    models = tuple(sorted(t for t in set(tokens) if t.isdigit()))
+    return CanonicalQuery(' '.join(token for part in parts for token in sorted(part)), brand, models)
+
+def _within_one_edit(a, b):
+    """True si a y b difieren como mucho en una inserción, borrado o sustitución"""
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    # Tras el primer carácter distinto el resto debe coincidir
+    return a[i + 1:] == b[i + 1:] if len(a) == len(b) else a[i:] == b[i + 1:]
+
+def _spelling_variants(tokens, other_tokens, min_length=4):
+    """True si los dos conjuntos de tokens se emparejan uno a uno con a lo sumo una edición
+    por token; los tokens cortos deben coincidir exactamente ("xs" no es "xl")"""
+    if len(tokens) != len(other_tokens):
+        return False
+    pending = [t for t in other_tokens if t not in tokens]
+    for token in tokens:
+        if token in other_tokens:
+            continue
+        match = next((o for o in pending if min(len(token), len(o)) >= min_length and _within_one_edit(token, o)), None)
+        if match is None:
+            return False
+        pending.remove(match)
+    return True
+
+class QueryIndex:
+    """Índice de trigramas sobre consultas canónicas ya cacheadas.
+    
+    Permite servir "samsung galaxy s24 ultra" con la entrada de "samsung
+    galaxi s24 ultra": los trigramas solo proponen candidatos, y se acepta
+    uno si tiene los mismos tokens salvo variantes ortográficas (una
+    edición por token). Un token de más ("... ultra case") nunca coincide.
+    """
+    def __init__(self, max_entries=5000, threshold=0.75, max_posting=500):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.max_posting = max_posting
+        self._entries = OrderedDict()
+        self._postings = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def _trigrams(key):
+        padded = f' {key} '
+        return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+    
+    def add(self, canonical):
+        with self._lock:
+            if canonical.key in self._entries:
+                self._entries.move_to_end(canonical.key)
+                return
+            trigrams = self._trigrams(canonical.key)
+            self._entries[canonical.key] = (trigrams, canonical.brand, canonical.models, frozenset(canonical.key.split()))
+            for trigram in trigrams:
+                self._postings.setdefault(trigram, set()).add(canonical.key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+    
+    def _remove(self, key):
+        trigrams = self._entries.pop(key)[0]
+        for trigram in trigrams:
+            posting = self._postings.get(trigram)
+            if posting is not None:
+                posting.discard(key)
+                if not posting:
+                    del self._postings[trigram]
+    
+    def discard(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+    
+    def lookup(self, canonical):
+        """Clave canónica equivalente ya indexada, o None"""
+        trigrams = self._trigrams(canonical.key)
+        tokens = frozenset(canonical.key.split())
+        counts = {}
+        with self._lock:
+            for trigram in trigrams:
+                posting = self._postings.get(trigram, ())
+                # Trigramas muy comunes no discriminan y encarecen la búsqueda
+                if len(posting) > self.max_posting:
+                    continue
+                for key in posting:
+                    counts[key] = counts.get(key, 0) + 1
+            best, best_score = None, self.threshold
+            for key, common in counts.items():
+                other, brand, models, other_tokens = self._entries[key]
+                if key == canonical.key or brand != canonical.brand or models != canonical.models:
+                    continue
+                if not _spelling_variants(tokens, other_tokens):
+                    continue
+                score = common / (len(trigrams) + len(other) - common)
+                if score >= best_score:
+                    best, best_score = key, score
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(best)
+        return best
+    
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'threshold': self.threshold}
+
+# ==============================================================================
+# CACHÉ DE BÚSQUEDAS
+# ==============================================================================
+
+def make_cache_key(query, engine='google_shopping', location='United States'):
+    """Clave estable (independiente del proceso) para una búsqueda, sobre la consulta canónica"""
+    normalized = canonicalize_query(query).key
+    raw = json.dumps([normalized, engine, location], ensure_ascii=False)
+    return 'search_' + hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+# Entrada de caché: fresh=False significa caducada pero aún servible (stale)
+CacheEntry = namedtuple('CacheEntry', ['value', 'fresh', 'negative'])
+
+class MemorySearchCache:
+    """Caché LRU+TTL en memoria (solo para el proceso actual)"""
+    def __init__(self, max_entries=500, default_ttl=180, max_stale=900):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.max_stale = max_stale
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get_entry(self, key, record=True):
+        """Devuelve CacheEntry (fresca o stale dentro de max_stale) o None"""
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[2] <= now:
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += record
+                return None
+            value, expires_at, stale_until, negative = item
+            self._data.move_to_end(key)
+            entry = CacheEntry(value, expires_at > now, negative)
+            if record:
+                if negative:
+                    self.negative_hits += 1
+                elif entry.fresh:
+                    self.hits += 1
+                else:
+                    self.stale_hits += 1
+            return entry
+    
+    def get(self, key, record=True):
+        """Solo valores frescos y positivos"""
+        entry = self.get_entry(key, record)
+        return entry.value if entry and entry.fresh and not entry.negative else None
+    
+    def set(self, key, value, ttl=None, negative=False):
+        expires_at = time.time() + (ttl if ttl is not None else self.default_ttl)
+        # Las entradas negativas no se sirven caducadas
+        stale_until = expires_at if negative else expires_at + self.max_stale
+        with self._lock:
+            self._data[key] = (value, expires_at, stale_until, negative)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+    
+    def size(self):
+        with self._lock:
+            return len(self._data)
+    
+    def stats(self):
+        hits = self.hits + self.stale_hits + self.negative_hits
+        total = hits + self.misses
+        return {
+            'backend': 'memory',
+            'entries': self.size(),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(hits / total, 4) if total else 0.0
+        }
+
+class SQLiteSearchCache:
+    """Caché LRU+TTL compartida entre workers mediante un archivo SQLite local"""
+    def __init__(self, db, max_entries=5000, default_ttl=180, max_stale=900):
+        self.db = db
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.max_stale = max_stale
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS search_cache ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+            'expires_at REAL NOT NULL, last_access REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_search_cache_access ON search_cache(last_access)')
+        # Columnas añadidas para stale-while-revalidate y caché negativa
+        columns = {row[1] for row in self.db.execute('PRAGMA table_info(search_cache)')}
+        if 'stale_until' not in columns:
+            self.db.execute('ALTER TABLE search_cache ADD COLUMN stale_until REAL')
+        if 'negative' not in columns:
+            self.db.execute('ALTER TABLE search_cache ADD COLUMN negative INTEGER NOT NULL DEFAULT 0')
+    
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+    
+    def get_entry(self, key, record=True):
+        """Devuelve CacheEntry (fresca o stale dentro de max_stale) o None"""
+        now = time.time()
+        row = self.db.execute(
+            'SELECT value, expires_at, COALESCE(stale_until, expires_at), negative FROM search_cache WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or row[2] <= now:
+            if record:
+                self._count('misses')
+            return None
+        self.db.execute('UPDATE search_cache SET last_access = ? WHERE key = ?', (now, key))
+        entry = CacheEntry(json.loads(row[0]), row[1] > now, bool(row[3]))
+        if record:
+            self._count('negative_hits' if entry.negative else 'hits' if entry.fresh else 'stale_hits')
+        return entry
+    
+    def get(self, key, record=True):
+        """Solo valores frescos y positivos"""
+        entry = self.get_entry(key, record)
+        return entry.value if entry and entry.fresh and not entry.negative else None
+    
+    def set(self, key, value, ttl=None, negative=False):
+        now = time.time()
+        expires_at = now + (ttl if ttl is not None else self.default_ttl)
+        # Las entradas negativas no se sirven caducadas
+        stale_until = expires_at if negative else expires_at + self.max_stale
+        with self.db.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO search_cache (key, value, expires_at, last_access, stale_until, negative) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), expires_at, now, stale_until, int(negative))
+            )
+            conn.execute('DELETE FROM search_cache WHERE COALESCE(stale_until, expires_at) <= ?', (now,))
+            overflow = conn.execute('SELECT COUNT(*) FROM search_cache').fetchone()[0] - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    'DELETE FROM search_cache WHERE key IN '
+                    '(SELECT key FROM search_cache ORDER BY last_access ASC LIMIT ?)', (overflow,)
+                )
+        if overflow > 0:
+            with self._lock:
+                self.evictions += overflow
+    
+    def size(self):
+        return self.db.execute('SELECT COUNT(*) FROM search_cache').fetchone()[0]
+    
+    def stats(self):
+        hits = self.hits + self.stale_hits + self.negative_hits
+        total = hits + self.misses
+        return {
+            'backend': 'sqlite',
+            'path': self.db.path,
+            'entries': self.size(),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(hits / total, 4) if total else 0.0
+        }
+
+def create_search_cache():
+    """Crea el backend de caché según SEARCH_CACHE_BACKEND (sqlite | memory)"""
+    backend = os.environ.get('SEARCH_CACHE_BACKEND', 'sqlite').lower()
+    max_entries = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', 5000))
+    ttl = int(os.environ.get('SEARCH_CACHE_TTL', 180))
+    max_stale = int(os.environ.get('SEARCH_CACHE_MAX_STALE', 900))
+    if backend == 'sqlite':
+        try:
+            cache = SQLiteSearchCache(local_db, max_entries=max_entries, default_ttl=ttl, max_stale=max_stale)
+            print(f"✅ Caché de búsquedas compartida en {local_db.path}")
+            return cache
+        except sqlite3.Error as e:
+            print(f"⚠️ No se pudo abrir la caché SQLite ({e}) - usando caché en memoria")
+    return MemorySearchCache(max_entries=max_entries, default_ttl=ttl, max_stale=max_stale)
+
+# ==============================================================================
+# BÚSQUEDA MULTI-MOTOR EN PARALELO
+# ==============================================================================
+
+# Clave de resultados y parámetro de consulta de cada motor de SerpAPI
+ENGINE_RESULT_KEYS = {
+    'google_shopping': 'shopping_results',
+    'bing_shopping': 'shopping_results',
+    'google': 'organic_results',
+    'bing': 'organic_results',
+    'walmart': 'organic_results',
+    'ebay': 'organic_results',
+}
+ENGINE_QUERY_PARAMS = {'walmart': 'query', 'ebay': '_nkw'}
+GOOGLE_ENGINES = ('google_shopping', 'google')
+
+# Pool compartido para las peticiones a SerpAPI de todas las búsquedas del worker
+search_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('SEARCH_POOL_SIZE', 16)),
+    thread_name_prefix='serpapi'
+)
+
+# ==============================================================================
+# LIMITADOR DE TASA (TOKEN BUCKET) PARA SERPAPI
+# ==============================================================================
+
+class TokenBucket:
+    """Token bucket por reservas: cada petición reserva su turno en orden FIFO"""
+    def __init__(self, rate, burst, max_wait=5.0):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_wait = float(max_wait)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.acquired = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+    
+    def _take(self, tokens, updated, now):
+        """Calcula (tokens, espera) tras reservar un token; espera None si supera max_wait"""
+        tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+        wait = -tokens / self.rate if tokens < 0 else 0.0
+        if wait > self.max_wait:
+            return tokens + 1, None
+        return tokens, wait
+    
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens, wait = self._take(self._tokens, self._updated, now)
+            self._updated = now
+        return wait
+    
+    def _record(self, wait):
+        with self._stats_lock:
+            if wait is None:
+                self.rejected += 1
+                return
+            self.acquired += 1
+            if wait > 0:
+                self.delayed += 1
+                self.total_wait += wait
+                self.max_wait_seen = max(self.max_wait_seen, wait)
+    
+    def acquire(self):
+        """Bloquea solo si no hay tokens; devuelve False si la espera sería excesiva"""
+        wait = self.reserve()
+        self._record(wait)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+    
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'backend': 'memory',
+                'rate_per_sec': self.rate,
+                'burst': self.burst,
+                'acquired': self.acquired,
+                'delayed': self.delayed,
+                'rejected': self.rejected,
+                'avg_wait_ms': round(self.total_wait / self.acquired * 1000, 2) if self.acquired else 0.0,
+                'max_wait_ms': round(self.max_wait_seen * 1000, 2)
+            }
+
+class SQLiteTokenBucket(TokenBucket):
+    """Token bucket compartido entre workers: el estado vive en SQLite"""
+    def __init__(self, db, name, rate, burst, max_wait=5.0):
+        super().__init__(rate, burst, max_wait)
+        self.db = db
+        self.name = name
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS rate_limiter ('
+            'name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)'
+        )
+    
+    def reserve(self):
+        # time.time() porque el reloj debe ser comparable entre procesos
+        now = time.time()
+        with self.db.transaction() as conn:
+            row = conn.execute('SELECT tokens, updated_at FROM rate_limiter WHERE name = ?', (self.name,)).fetchone()
+            tokens, updated = row if row else (self.burst, now)
+            tokens, wait = self._take(tokens, updated, now)
+            conn.execute(
+                'INSERT OR REPLACE INTO rate_limiter (name, tokens, updated_at) VALUES (?, ?, ?)',
+                (self.name, tokens, now)
+            )
+        return wait
+    
+    def stats(self):
+        stats = super().stats()
+        stats['backend'] = 'sqlite'
+        return stats
+
+def create_rate_limiter():
+    """Limitador de SerpAPI según SERPAPI_RATE_PER_SEC, SERPAPI_BURST y SERPAPI_RATE_SHARED"""
+    rate = float(os.environ.get('SERPAPI_RATE_PER_SEC', 5))
+    burst = float(os.environ.get('SERPAPI_BURST', 10))
+    max_wait = float(os.environ.get('SERPAPI_MAX_WAIT', 5))
+    if os.environ.get('SERPAPI_RATE_SHARED', '').lower() in ('1', 'true', 'yes'):
+        try:
+            return SQLiteTokenBucket(local_db, 'serpapi', rate, burst, max_wait)
+        except sqlite3.Error as e:
+            print(f"⚠️ Limitador compartido no disponible ({e}) - usando limitador por proceso")
+    return TokenBucket(rate, burst, max_wait)
+
+# ==============================================================================
+# CIRCUIT BREAKER PARA SERPAPI
+# ==============================================================================
+
+class CircuitBreaker:
+    """Corta las llamadas a un upstream cuando su tasa de errores se dispara.
+    
+    closed: todo pasa y se mide la ratio de fallos en una ventana deslizante.
+    open: se rechaza todo hasta que pase el cooldown.
+    half_open: una única petición de prueba decide si se vuelve a cerrar.
+    """
+    def __init__(self, failure_ratio=0.5, window=30.0, min_requests=10, cooldown=30.0):
+        self.failure_ratio = float(failure_ratio)
+        self.window = float(window)
+        self.min_requests = int(min_requests)
+        self.cooldown = float(cooldown)
+        self.state = 'closed'
+        self._outcomes = deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+    
+    def _prune(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._failures -= self._outcomes.popleft()[1]
+    
+    def allow(self):
+        """True si la petición puede salir; en half_open solo deja pasar una"""
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = 'half_open'
+                self._probing = False
+            if self.state == 'closed' or (self.state == 'half_open' and not self._probing):
+                self._probing = self.state == 'half_open'
+                return True
+            self.rejected += 1
+            return False
+    
+    def release(self):
+        """Devuelve la petición de prueba de half_open cuando no llegó a salir"""
+        with self._lock:
+            if self.state == 'half_open':
+                self._probing = False
+    
+    def is_open(self):
+        """Consulta sin consumir la petición de prueba de half_open"""
+        with self._lock:
+            if self.state == 'open':
+                return time.monotonic() - self._opened_at < self.cooldown
+            return self.state == 'half_open' and self._probing
+    
+    def record(self, failed):
+        now = time.monotonic()
+        with self._lock:
+            if self.state == 'half_open':
+                self._probing = False
+                self._outcomes.clear()
+                self._failures = 0
+                if failed:
+                    self._open(now)
+                else:
+                    self.state = 'closed'
+                    log.info('Circuit breaker cerrado')
+                return
+            self._outcomes.append((now, int(failed)))
+            self._failures += int(failed)
+            self._prune(now)
+            total = len(self._outcomes)
+            if self.state == 'closed' and total >= self.min_requests and self._failures / total >= self.failure_ratio:
+                self._open(now)
+    
+    def _open(self, now):
+        self.state = 'open'
+        self._opened_at = now
+        self.opened += 1
+        log.warning('Circuit breaker abierto', cooldown=self.cooldown)
+    
+    def stats(self):
+        with self._lock:
+            self._prune(time.monotonic())
+            total = len(self._outcomes)
+            return {
+                'state': self.state,
+                'window_requests': total,
+                'window_failure_ratio': round(self._failures / total, 4) if total else 0.0,
+                'opened': self.opened,
+                'rejected': self.rejected
+            }
+
+def create_circuit_breaker():
+    return CircuitBreaker(
+        failure_ratio=float(os.environ.get('SERPAPI_BREAKER_FAILURE_RATIO', 0.5)),
+        window=float(os.environ.get('SERPAPI_BREAKER_WINDOW', 30)),
+        min_requests=int(os.environ.get('SERPAPI_BREAKER_MIN_REQUESTS', 10)),
+        cooldown=float(os.environ.get('SERPAPI_BREAKER_COOLDOWN', 30))
+    )
+
+# Refrescos en segundo plano de entradas caducadas (stale-while-revalidate)
+refresh_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('SEARCH_REFRESH_WORKERS', 2)),
+    thread_name_prefix='refresh'
+)
+
+# ==============================================================================
+# COALESCENCIA DE BÚSQUEDAS IDÉNTICAS (SINGLE-FLIGHT)
+# ==============================================================================
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Una sola petición en curso por clave; el resto espera su resultado.
+    
+    Entre hilos del mismo worker se comparte el resultado en memoria. Entre
+    workers, el líder toma un lease en SQLite y los demás esperan a que el
+    resultado aparezca en la caché compartida.
+    """
+    def __init__(self, db=None, wait_timeout=10.0, poll_interval=0.1):
+        self.db = db
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.remote_waits = 0
+        self.timeouts = 0
+        self._owner = f"{os.getpid()}-{id(self)}"
+        if self.db is not None:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS search_leases ('
+                'key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+    
+    def do(self, key, fn, poll=None):
+        """Ejecuta fn() una vez por clave; devuelve None si la espera agota el tiempo"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            if not flight.event.wait(self.wait_timeout):
+                self.timeouts += 1
+                return None
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        
+        try:
+            flight.result = self._run_leader(key, fn, poll)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+    
+    def _run_leader(self, key, fn, poll):
+        if self.db is None or poll is None:
+            return fn()
+        deadline = time.time() + self.wait_timeout
+        while not self._acquire_lease(key):
+            # Otro worker ya está consultando: esperar a que publique en la caché
+            self.remote_waits += 1
+            time.sleep(self.poll_interval)
+            result = poll()
+            if result is not None:
+                return result
+            if time.time() >= deadline:
+                self.timeouts += 1
+                return fn()
+        try:
+            # Otro worker pudo publicar justo antes de soltar su lease
+            result = poll()
+            return result if result is not None else fn()
+        finally:
+            self._release_lease(key)
+    
+    def _acquire_lease(self, key):
+        now = time.time()
+        try:
+            with self.db.transaction() as conn:
+                conn.execute('DELETE FROM search_leases WHERE key = ? AND expires_at <= ?', (key, now))
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO search_leases (key, owner, expires_at) VALUES (?, ?, ?)',
+                    (key, self._owner, now + self.wait_timeout)
+                )
+                return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            log.warning('Lease no disponible', error=str(e))
+            return True
+    
+    def _release_lease(self, key):
+        try:
+            self.db.execute('DELETE FROM search_leases WHERE key = ? AND owner = ?', (key, self._owner))
+        except sqlite3.Error:
+            pass
+    
+    def stats(self):
+        return {
+            'in_flight': len(self._flights),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+            'remote_waits': self.remote_waits,
+            'timeouts': self.timeouts
+        }
+
+# ==============================================================================
+# NORMALIZACIÓN DE PRECIOS
+# ==============================================================================
+
+# Tipos de cambio aproximados a USD; se pueden ajustar con PRICE_FX_RATES='{"EUR": 1.1}'
+CURRENCY_RATES_USD = {'USD': 1.0, 'EUR': 1.08, 'GBP': 1.27, 'CAD': 0.73, 'AUD': 0.66, 'MXN': 0.055, 'JPY': 0.0067, 'INR': 0.012}
+CURRENCY_RATES_USD.update({k.upper(): float(v) for k, v in json.loads(os.environ.get('PRICE_FX_RATES') or '{}').items()})
+CURRENCY_SYMBOLS = {
+    '$': 'USD', 'US$': 'USD', 'USD': 'USD', '€': 'EUR', 'EUR': 'EUR', '£': 'GBP', 'GBP': 'GBP',
+    'C$': 'CAD', 'CA$': 'CAD', 'CAD': 'CAD', 'A$': 'AUD', 'AU$': 'AUD', 'AUD': 'AUD',
+    'MX$': 'MXN', 'MXN': 'MXN', '¥': 'JPY', 'JPY': 'JPY', '₹': 'INR', 'INR': 'INR'
+}
+_CURRENCY = '|'.join(re.escape(symbol) for symbol in sorted(CURRENCY_SYMBOLS, key=len, reverse=True))
+_AMOUNT = r'\d+(?:[,.\u00a0 ]\d{3})*(?:[.,]\d{1,2})?(?!\d)'
+# Una coincidencia por línea (una línea por item). Grupos: símbolo previo,
+# importe tras símbolo, importe antes de sufijo, sufijo (¢/cents/moneda),
+# importe sin moneda. Primero se busca un importe con moneda en toda la
+# línea; si no hay, el primer número. En rangos y "From $X" gana el primero.
+# Sufijos de céntimos; se comparan enteros ("15 CAD" son dólares canadienses)
+CENT_SUFFIXES = frozenset(['¢', 'c', 'cent', 'cents'])
+PRICE_LINE_RE = re.compile(
+    rf'^(?:.*?(?:({_CURRENCY})[^\S\n]?({_AMOUNT})|({_AMOUNT})[^\S\n]?(¢|cents?\b|{_CURRENCY}|c\b))|.*?({_AMOUNT}))?.*$',
+    re.MULTILINE | re.IGNORECASE
+)
+
+class PriceNormalizer:
+    """Convierte los precios de una página de resultados a USD en una sola pasada"""
+    def __init__(self, min_price=0.01, max_price=50000, rates=CURRENCY_RATES_USD):
+        self.min_price = min_price
+        self.max_price = max_price
+        self.rates = rates
+    
+    @staticmethod
+    def _to_float(amount):
+        amount = amount.replace('\u00a0', '').replace(' ', '')
+        # El último separador es decimal solo si le siguen 1-2 dígitos ("12,50", "1.299,00")
+        last = max(amount.rfind('.'), amount.rfind(','))
+        if last != -1 and len(amount) - last - 1 <= 2:
+            return float(amount[:last].replace('.', '').replace(',', '') + '.' + amount[last + 1:])
+        return float(amount.replace('.', '').replace(',', ''))
+    
+    def _from_groups(self, groups):
+        """(importe, moneda) a partir de los grupos de PRICE_LINE_RE"""
+        prefix, amount_after, amount_before, suffix, bare = groups
+        if amount_after:
+            return self._to_float(amount_after), CURRENCY_SYMBOLS[prefix.upper()]
+        if amount_before:
+            if suffix.lower() in CENT_SUFFIXES:
+                return self._to_float(amount_before) / 100, 'USD'
+            return self._to_float(amount_before), CURRENCY_SYMBOLS[suffix.upper()]
+        if bare:
+            return self._to_float(bare), 'USD'
+        return 0.0, 'USD'
+    
+    def normalize_page(self, items):
+        """Lista de (precio_mostrado, precio_usd, moneda) alineada con items; 0.0 si no hay precio válido"""
+        texts = [str(item.get('price') or '').replace('\n', ' ') for item in items]
+        results = []
+        for item, text, groups in zip(items, texts, PRICE_LINE_RE.findall('\n'.join(texts))):
+            value, currency = self._from_groups(groups)
+            # extracted_price de SerpAPI ya viene parseado (en la moneda del texto)
+            extracted = item.get('extracted_price')
+            if isinstance(extracted, (int, float)) and not isinstance(extracted, bool) and extracted > 0:
+                value = float(extracted)
+            usd = value * self.rates.get(currency, 0.0)
+            if not self.min_price <= usd <= self.max_price:
+                results.append((text, 0.0, currency))
+                continue
+            results.append((text.strip() or f'${usd:.2f}', round(usd, 2), currency))
+        return results
+    
+    def parse(self, price_str):
+        """Precio en USD de un único texto (0.0 si no es válido)
+        
+        >>> n = PriceNormalizer(rates={'USD': 1.0, 'CAD': 0.5, 'EUR': 2.0})
+        >>> [n.parse(p) for p in ('15 CAD', '15 cad', '15 C$', 'C$15', '15 EUR', '99¢', '99c', '99 cents', '1 cent')]
+        [7.5, 7.5, 7.5, 7.5, 30.0, 0.99, 0.99, 0.99, 0.01]
+        """
+        return self.normalize_page([{'price': price_str}])[0][1]
+
+# ==============================================================================
+# HISTÓRICO DE PRECIOS
+# ==============================================================================
+
+_TITLE_NORM_RE = re.compile(r'[\W_]+')
+
+def normalize_title(title):
+    """Título comparable entre búsquedas: sin HTML, mayúsculas ni puntuación"""
+    return ' '.join(_TITLE_NORM_RE.sub(' ', html.unescape(str(title)).casefold()).split())
+
+def normalize_history_query(query):
+    return canonicalize_query(query).key
+
+class PriceHistory:
+    """Serie temporal de precios observados, en SQLite.
+    
+    Las inserciones se encolan y un hilo de cada proceso las escribe por
+    lotes (una transacción por lote) fuera del camino de la petición; si la
+    cola se llena se descartan filas en lugar de bloquear.
+    """
+    def __init__(self, db, retention_days=90, batch_size=500, max_queue=20000):
+        self.db = db
+        self.retention = retention_days * 86400
+        self._queue = BackgroundWorker('price-history', self._write_batch, maxsize=max_queue, batch_size=batch_size)
+        self._stats_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self._last_purge = 0.0
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS price_history ('
+            'query_key TEXT NOT NULL, title_norm TEXT NOT NULL, title TEXT NOT NULL, '
+            'source TEXT NOT NULL, price REAL NOT NULL, link TEXT, ts REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_price_history_title_ts ON price_history(title_norm, ts)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_price_history_query_ts ON price_history(query_key, ts)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_price_history_ts ON price_history(ts)')
+    
+    def record(self, query, products):
+        """Encola (consulta, título, tienda, precio, enlace, instante) de cada producto"""
+        now = time.time()
+        query_key = normalize_history_query(query)
+        for product in products:
+            row = (query_key, normalize_title(product['title']), product['title'], product['source'],
+                   product['price_numeric'], product['link'], now)
             try:
-                error_msg = e.response.json().get('error', {}).get('message', 'ERROR')
-                if 'INVALID' in error_msg or 'EMAIL_NOT_FOUND' in error_msg:
-                    return {'success': False, 'message': 'Correo o contraseña incorrectos', 'user_data': None, 'error_code': 'INVALID_CREDENTIALS'}
-                elif 'TOO_MANY_ATTEMPTS' in error_msg:
-                    return {'success': False, 'message': 'Demasiados intentos fallidos', 'user_data': None, 'error_code': 'TOO_MANY_ATTEMPTS'}
-                else:
-                    return {'success': False, 'message': 'Error de autenticacion', 'user_data': None, 'error_code': 'FIREBASE_ERROR'}
-            except:
-                return {'success': False, 'message': 'Error de conexion', 'user_data': None, 'error_code': 'CONNECTION_ERROR'}
-        except Exception as e:
-            print(f"Firebase auth error: {e}")
-            return {'success': False, 'message': 'Error interno del servidor', 'user_data': None, 'error_code': 'UNEXPECTED_ERROR'}
+                self._queue.put_nowait(row)
+            except queue.Full:
+                with self._stats_lock:
+                    self.dropped += 1
     
-    def set_user_session(self, user_data):
-        session['user_id'] = user_data['user_id']
-        session['user_name'] = user_data['display_name']
-        session['user_email'] = user_data['email']
-        session['id_token'] = user_data['id_token']
-        session['login_time'] = datetime.now().isoformat()
-        session.permanent = True
+    def _write_batch(self, rows):
+        try:
+            self._write(rows)
+        except sqlite3.Error as e:
+            log.error('Error guardando histórico de precios', rows=len(rows), error=str(e))
     
-    def clear_user_session(self):
-        important_data = {key: session.get(key) for key in ['timestamp'] if key in session}
-        session.clear()
-        for key, value in important_data.items():
-            session[key] = value
+    def _write(self, rows):
+        now = time.time()
+        with self.db.transaction() as conn:
+            conn.executemany('INSERT INTO price_history VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            if now - self._last_purge > 3600:
+                conn.execute('DELETE FROM price_history WHERE ts < ?', (now - self.retention,))
+                self._last_purge = now
+        with self._stats_lock:
+            self.written += len(rows)
     
-    def is_user_logged_in(self):
-        if 'user_id' not in session or session['user_id'] is None:
-            return False
-        if 'login_time' in session:
+    def flush(self, timeout=5.0):
+        """Espera como mucho `timeout` s a que se escriban las filas pendientes"""
+        return self._queue.flush(timeout)
+    
+    def lowest(self, titles, days=30):
+        """{title_norm: (precio, tienda, ts)} con el mínimo de cada título en los últimos días"""
+        norms = list({normalize_title(t) for t in titles})
+        if not norms:
+            return {}
+        placeholders = ','.join('?' * len(norms))
+        # SQLite devuelve las columnas de la fila que da el MIN()
+        rows = self.db.execute(
+            f'SELECT title_norm, MIN(price), source, ts FROM price_history '
+            f'WHERE title_norm IN ({placeholders}) AND ts >= ? GROUP BY title_norm',
+            (*norms, time.time() - days * 86400)
+        ).fetchall()
+        return {row[0]: (row[1], row[2], row[3]) for row in rows}
+    
+    def recent(self, query, max_age):
+        """Últimos precios vistos para la consulta (uno por título y tienda), de menor a mayor"""
+        rows = self.db.execute(
+            'SELECT title_norm, title, source, price, link FROM price_history '
+            'WHERE query_key = ? AND ts >= ? ORDER BY ts DESC',
+            (normalize_history_query(query), time.time() - max_age)
+        ).fetchall()
+        latest = {}
+        for title_norm, title, source, price, link in rows:
+            latest.setdefault((title_norm, source), {
+                'title': title,
+                'price': f'${price:.2f}',
+                'price_numeric': price,
+                'source': source,
+                'link': link or '#',
+                'rating': '',
+                'reviews': '',
+                'image': ''
+            })
+        return sorted(latest.values(), key=lambda x: x['price_numeric'])
+    
+    def stats(self):
+        with self._stats_lock:
+            return {'written': self.written, 'dropped': self.dropped, 'queued': self._queue.qsize()}
+
+price_history = None
+if os.environ.get('PRICE_HISTORY_ENABLED', 'true').lower() not in ('0', 'false', 'no'):
+    try:
+        price_history = PriceHistory(local_db, retention_days=int(os.environ.get('PRICE_HISTORY_RETENTION_DAYS', 90)))
+    except sqlite3.Error as e:
+        print(f"⚠️ Histórico de precios no disponible: {e}")
+
+# ==============================================================================
+# AUTOCOMPLETADO DE CONSULTAS
+# ==============================================================================
+
+def normalize_suggestion(query):
+    """Forma mostrada en las sugerencias: NFKC, minúsculas y espacios simples"""
+    return ' '.join(unicodedata.normalize('NFKC', str(query)).casefold().split())[:80]
+
+class QuerySuggester:
+    """Sugerencias por prefijo sobre un array ordenado de consultas pasadas.
+    
+    La búsqueda son dos bisect que delimitan las consultas que empiezan por
+    el prefijo; de ese rango se eligen las `limit` más populares, así que el
+    coste es O(log n + m log limit), con m las consultas guardadas con ese
+    prefijo (como mucho max_entries). El tamaño está limitado: al superarlo
+    se descartan las consultas menos populares. Las consultas se persisten en
+    SQLite por lotes desde un hilo de fondo, para que los workers arranquen
+    con ellas sin escribir en el camino de la petición.
+    
+    Las sugerencias se comparten entre cuentas, así que una consulta solo se
+    sugiere cuando la han buscado al menos min_users usuarios distintos: lo
+    que escribe un único usuario nunca aparece a los demás.
+    """
+    def __init__(self, db=None, max_entries=20000, min_users=3, batch_size=200, max_queue=10000):
+        self.db = db
+        self.max_entries = max_entries
+        self.min_users = max(1, min_users)
+        self.dropped = 0
+        self._keys = []
+        self._counts = {}
+        self._users = {}
+        # Sin SQLite: pares (consulta, usuario) ya contados
+        self._seen = set()
+        self._lock = threading.Lock()
+        if self.db is not None:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS search_queries ('
+                'query TEXT PRIMARY KEY, count INTEGER NOT NULL, last_seen REAL NOT NULL, '
+                'users INTEGER NOT NULL DEFAULT 0)'
+            )
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(search_queries)')]
+            if 'users' not in columns:
+                # Las consultas previas no saben de quién son: empiezan sin usuarios y no se sugieren
+                self.db.execute('ALTER TABLE search_queries ADD COLUMN users INTEGER NOT NULL DEFAULT 0')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS search_query_users ('
+                'query TEXT NOT NULL, user_hash TEXT NOT NULL, PRIMARY KEY (query, user_hash)) WITHOUT ROWID'
+            )
+            rows = self.db.execute(
+                'SELECT query, count, users FROM search_queries ORDER BY count DESC LIMIT ?', (max_entries,)
+            ).fetchall()
+            self._counts = {key: count for key, count, _ in rows}
+            self._users = {key: users for key, _, users in rows}
+            self._keys = sorted(self._counts)
+            self._writer = BackgroundWorker('query-suggester', self._store_batch, maxsize=max_queue,
+                                            batch_size=batch_size)
+    
+    def record(self, query, user_id):
+        key = normalize_suggestion(query)
+        if len(key) < 2 or not user_id:
+            return
+        user_hash = hashlib.sha256(str(user_id).encode('utf-8')).hexdigest()[:16]
+        with self._lock:
+            if key not in self._counts:
+                self._counts[key] = 0
+                self._users[key] = 0
+                bisect.insort(self._keys, key)
+            self._counts[key] += 1
+            # Con SQLite los usuarios distintos llegan al escribir el lote
+            if self.db is None and (key, user_hash) not in self._seen:
+                self._seen.add((key, user_hash))
+                self._users[key] += 1
+            if len(self._keys) > self.max_entries:
+                self._prune()
+        if self.db is not None:
             try:
-                login_time = datetime.fromisoformat(session['login_time'])
-                time_diff = (datetime.now() - login_time).total_seconds()
-                if time_diff > 7200:  # 2 horas maximo
-                    return False
-            except:
-                pass
-        return True
+                self._writer.put_nowait((key, user_hash, time.time()))
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
     
-    def get_current_user(self):
-        if not self.is_user_logged_in():
-            return None
-        return {
-            'user_id': session.get('user_id'),
-            'user_name': session.get('user_name'),
-            'user_email': session.get('user_email'),
-            'id_token': session.get('id_token')
-        }
+    def _store_batch(self, searches):
+        try:
+            stored = self._store(searches)
+        except sqlite3.Error as e:
+            log.warning('No se pudieron guardar las consultas para sugerencias', searches=len(searches), error=str(e))
+            return
+        with self._lock:
+            for key, (count, users) in stored.items():
+                # Los contadores de SQLite incluyen lo registrado por los demás workers
+                if key in self._counts:
+                    self._counts[key], self._users[key] = count, users
+    
+    def _store(self, searches):
+        """{consulta: (búsquedas, usuarios distintos)} tras registrar el lote en una transacción"""
+        with self.db.transaction() as conn:
+            for key, user_hash, ts in searches:
+                new_user = conn.execute(
+                    'INSERT OR IGNORE INTO search_query_users (query, user_hash) VALUES (?, ?)', (key, user_hash)
+                ).rowcount == 1
+                conn.execute(
+                    'INSERT INTO search_queries (query, count, last_seen, users) VALUES (?, 1, ?, ?) '
+                    'ON CONFLICT(query) DO UPDATE SET count = count + 1, last_seen = excluded.last_seen, '
+                    'users = users + excluded.users',
+                    (key, ts, int(new_user))
+                )
+            keys = list({key for key, _, _ in searches})
+            rows = conn.execute(
+                f'SELECT query, count, users FROM search_queries WHERE query IN ({",".join("?" * len(keys))})', keys
+            ).fetchall()
+        return {key: (count, users) for key, count, users in rows}
+    
+    def flush(self, timeout=5.0):
+        """Espera como mucho `timeout` s a que se guarden las búsquedas pendientes"""
+        return self._writer.flush(timeout) if self.db is not None else True
+    
+    def _prune(self):
+        # Se libera un 10% de golpe para no reordenar en cada inserción
+        keep = sorted(self._counts, key=self._counts.get, reverse=True)[:int(self.max_entries * 0.9)]
+        self._counts = {key: self._counts[key] for key in keep}
+        self._users = {key: self._users[key] for key in keep}
+        self._seen = {pair for pair in self._seen if pair[0] in self._counts}
+        self._keys = sorted(self._counts)
+    
+    def suggest(self, prefix, limit=8):
+        prefix = normalize_suggestion(prefix)
+        if len(prefix) < 2 or ord(prefix[-1]) == sys.maxunicode:
+            return []
+        # Las cadenas que empiezan por el prefijo son menores que el prefijo con su último carácter incrementado
+        end_prefix = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        with self._lock:
+            start = bisect.bisect_left(self._keys, prefix)
+            end = bisect.bisect_left(self._keys, end_prefix, start)
+            matches = heapq.nsmallest(limit, (
+                (-self._counts[key], key) for key in self._keys[start:end]
+                if self._users[key] >= self.min_users
+            ))
+        return [key for _, key in matches]
+    
+    def stats(self):
+        with self._lock:
+            stats = {'entries': len(self._keys), 'max_entries': self.max_entries, 'min_users': self.min_users,
+                     'dropped': self.dropped}
+        if self.db is not None:
+            stats['queued'] = self._writer.qsize()
+        return stats
 
-firebase_auth = FirebaseAuth()
+SUGGEST_MAX_ENTRIES = int(os.environ.get('SUGGEST_MAX_ENTRIES', 20000))
+SUGGEST_MIN_USERS = int(os.environ.get('SUGGEST_MIN_USERS', 3))
 
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if not firebase_auth.is_user_logged_in():
-            flash('Tu sesion ha expirado. Inicia sesion nuevamente.', 'warning')
-            return redirect(url_for('auth_login_page'))
-        return f(*args, **kwargs)
-    return decorated_function
+query_suggester = None
+try:
+    query_suggester = QuerySuggester(local_db, max_entries=SUGGEST_MAX_ENTRIES, min_users=SUGGEST_MIN_USERS)
+except sqlite3.Error as e:
+    print(f"⚠️ Sugerencias persistentes no disponibles ({e}) - solo en memoria")
+    query_suggester = QuerySuggester(None, max_entries=SUGGEST_MAX_ENTRIES, min_users=SUGGEST_MIN_USERS)
 
 # ==============================================================================
-# FUNCIONES DE BÚSQUEDA POR IMAGEN
+# AGRUPACIÓN DE PRODUCTOS ENTRE TIENDAS (MinHash + LSH)
 # ==============================================================================
 
-def analyze_image_with_gemini(image_content):
-    """Analiza imagen con Gemini Vision"""
-    if not GEMINI_READY or not PIL_AVAILABLE or not image_content:
-        print("❌ Gemini o PIL no disponible para análisis de imagen")
-        return None
+_MERSENNE_61 = (1 << 61) - 1
+_MODEL_PART_RE = re.compile(r'\d+|[^\W\d_]+')
+# Palabras que separan variantes del mismo modelo (iPhone 15 / 15 Pro / 15 Pro Max)
+PRODUCT_VARIANT_WORDS = frozenset('pro max plus mini ultra'.split())
+
+class ProductClusterer:
+    """Agrupa anuncios del mismo producto en uno solo con ofertas por tienda.
     
-    try:
-        # Convertir bytes a PIL Image
-        image = Image.open(io.BytesIO(image_content))
-        
-        # Optimizar imagen
-        max_size = (1024, 1024)
-        if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
-            image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        print("🖼️ Analizando imagen con Gemini Vision...")
-        
-        prompt = """
-        Analiza esta imagen de producto y genera una consulta de búsqueda específica en inglés para encontrarlo en tiendas online.
-        
-        Incluye:
-        - Nombre exacto del producto
-        - Marca (si es visible)
-        - Modelo o características distintivas
-        - Color, tamaño
-        - Categoría del producto
+    Cada título se reduce a una firma MinHash de sus tokens; LSH por bandas
+    propone candidatos y solo esos pares se verifican con Jaccard exacto,
+    así que el coste es casi lineal en el número de resultados. Dos títulos
+    solo se agrupan si además tienen la misma firma de modelo.
+    """
+    def __init__(self, num_hashes=48, bands=16, threshold=0.5, max_candidates=20):
+        assert num_hashes % bands == 0
+        self.bands = bands
+        self.rows = num_hashes // bands
+        self.threshold = threshold
+        self.max_candidates = max_candidates
+        rng = random.Random(1234)
+        self._perms = [(rng.randrange(1, _MERSENNE_61), rng.randrange(0, _MERSENNE_61)) for _ in range(num_hashes)]
+        self._token_hashes = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _tokens(title):
+        tokens = normalize_title(title).split()
+        # "wh 1000xm5" / "wh1000xm5" y "128 gb" / "128gb" deben coincidir
+        joined = [
+            a + b for a, b in zip(tokens, tokens[1:])
+            if (a.isalpha() and len(a) <= 3 and b[0].isdigit()) or (a[-1].isdigit() and b.isalpha() and len(b) <= 3)
+        ]
+        return frozenset(tokens + joined)
+    
+    def _token_hash(self, token):
+        vector = self._token_hashes.get(token)
+        if vector is None:
+            x = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'big')
+            vector = tuple((a * x + b) % _MERSENNE_61 for a, b in self._perms)
+            with self._lock:
+                if len(self._token_hashes) > 50000:
+                    self._token_hashes.clear()
+                self._token_hashes[token] = vector
+        return vector
+    
+    def _signature(self, tokens):
+        return tuple(map(min, zip(*[self._token_hash(t) for t in tokens])))
+    
+    @staticmethod
+    def _model_signature(tokens):
+        """Cifras y letras de los tokens con números, más las palabras de variante.
         
-        Responde SOLO con la consulta de búsqueda optimizada para e-commerce.
-        Ejemplo: "blue tape painter's tape 2 inch width"
+        Se parte cada token en tramos para que "wh 1000xm5" y "wh1000xm5" o
+        "15 pro" y "15pro" den la misma firma.
         """
+        parts = set()
+        for token in tokens:
+            if not token.isalpha():
+                parts.update(_MODEL_PART_RE.findall(token))
+            elif token in PRODUCT_VARIANT_WORDS:
+                parts.add(token)
+        return frozenset(parts)
+    
+    def _similar(self, a, b, models_a, models_b):
+        # Variantes distintas (128gb/256gb, 15/15 pro) no se agrupan aunque el resto coincida
+        if models_a != models_b:
+            return False
+        return len(a & b) / len(a | b) >= self.threshold
+    
+    def cluster(self, products):
+        """Productos agrupados: el más barato de cada grupo con 'offers' (una por tienda)"""
+        token_sets = [self._tokens(p['title']) for p in products]
+        model_sets = [self._model_signature(tokens) for tokens in token_sets]
+        parent = list(range(len(products)))
         
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        response = model.generate_content([prompt, image])
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
         
-        if response.text:
-            search_query = response.text.strip()
-            print(f"🧠 Consulta generada desde imagen: '{search_query}'")
-            return search_query
+        buckets = {}
+        for i, tokens in enumerate(token_sets):
+            if not tokens:
+                continue
+            signature = self._signature(tokens)
+            candidates = set()
+            for band in range(self.bands):
+                key = (band, signature[band * self.rows:(band + 1) * self.rows])
+                members = buckets.setdefault(key, [])
+                candidates.update(members)
+                if len(members) < self.max_candidates:
+                    members.append(i)
+            for j in candidates:
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j and self._similar(tokens, token_sets[j], model_sets[i], model_sets[j]):
+                    parent[root_i] = root_j
         
-        return None
-            
-    except Exception as e:
-        print(f"❌ Error analizando imagen: {e}")
-        return None
-
-def validate_image(image_content):
-    """Valida imagen"""
-    if not PIL_AVAILABLE or not image_content:
-        return False
-    
-    try:
-        image = Image.open(io.BytesIO(image_content))
-        if image.size[0] < 10 or image.size[1] < 10:
-            return False
-        if image.format not in ['JPEG', 'PNG', 'WEBP']:
-            return False
-        return True
-    except:
-        return False
+        groups = {}
+        for i, product in enumerate(products):
+            groups.setdefault(find(i), []).append(product)
+        
+        clusters = []
+        for members in groups.values():
+            members.sort(key=lambda x: x['price_numeric'])
+            offers = {}
+            for product in members:
+                offers.setdefault(product['source'].lower(), {
+                    'source': product['source'],
+                    'price': product['price'],
+                    'price_numeric': product['price_numeric'],
+                    'link': product['link']
+                })
+            cluster = dict(members[0])
+            cluster['offers'] = list(offers.values())
+            cluster['offer_count'] = len(cluster['offers'])
+            clusters.append(cluster)
+        # Ranking por grupo: mejor precio y, a igualdad, más tiendas
+        clusters.sort(key=lambda x: (x['price_numeric'], -x['offer_count']))
+        return clusters
 
 # Price Finder Class - MODIFICADO para búsqueda por imagen
 class PriceFinder:
@@ -228,10 +2838,38 @@ class PriceFinder:
             os.environ.get('SERPAPI')
         )
         
-        self.base_url = "https://serpapi.com/search"
-        self.cache = {}
-        self.cache_ttl = 180
+        self.base_url = os.environ.get('SERPAPI_BASE_URL', "https://serpapi.com/search")
+        self.location = 'United States'
+        self.cache = create_search_cache()
+        self.cache_ttl = self.cache.default_ttl
+        self.rate_limiter = create_rate_limiter()
+        self.normalizer = PriceNormalizer()
+        # Índice difuso de consultas cacheadas (desactivado por defecto; QUERY_FUZZY_MATCH=true lo activa)
+        self.query_index = None
+        if os.environ.get('QUERY_FUZZY_MATCH', 'false').lower() in ('1', 'true', 'yes'):
+            self.query_index = QueryIndex(
+                max_entries=int(os.environ.get('QUERY_INDEX_MAX_ENTRIES', 5000)),
+                threshold=float(os.environ.get('QUERY_FUZZY_THRESHOLD', 0.75))
+            )
+        self.clusterer = ProductClusterer(threshold=float(os.environ.get('PRODUCT_CLUSTER_THRESHOLD', 0.5)))
+        self.history = price_history
+        # Antigüedad máxima del histórico usado como respaldo si SerpAPI falla
+        self.history_fallback_age = int(os.environ.get('PRICE_HISTORY_FALLBACK_AGE', 86400))
+        self.circuit_breaker = create_circuit_breaker()
+        # Búsquedas vacías o fallidas se cachean poco tiempo para no repetirlas
+        self.negative_ttl = int(os.environ.get('NEGATIVE_CACHE_TTL', 30))
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
         self.timeouts = {'connect': 3, 'read': 8}
+        # Motores consultados en paralelo y tiempo máximo total de la búsqueda
+        self.engines = [e.strip() for e in os.environ.get('SEARCH_ENGINES', 'google_shopping').split(',') if e.strip()]
+        self.search_deadline = float(os.environ.get('SEARCH_DEADLINE', 8))
+        self.max_results = int(os.environ.get('SEARCH_MAX_RESULTS', 12))
+        shared_cache = isinstance(self.cache, SQLiteSearchCache)
+        self.single_flight = SingleFlight(
+            db=self.cache.db if shared_cache else None,
+            wait_timeout=float(os.environ.get('SINGLE_FLIGHT_TIMEOUT', self.search_deadline + 2))
+        )
         self.blacklisted_stores = ['alibaba', 'aliexpress', 'temu', 'wish', 'banggood', 'dhgate', 'falabella', 'ripley', 'linio', 'mercadolibre']
         
         if not self.api_key:
@@ -243,18 +2881,6 @@ class PriceFinder:
     def is_api_configured(self):
         return bool(self.api_key)
     
-    def _extract_price(self, price_str):
-        if not price_str:
-            return 0.0
-        try:
-            match = re.search(r'\$\s*(\d{1,4}(?:,\d{3})*(?:\.\d{2})?)', str(price_str))
-            if match:
-                price_value = float(match.group(1).replace(',', ''))
-                return price_value if 0.01 <= price_value <= 50000 else 0.0
-        except:
-            pass
-        return 0.0
-    
     def _generate_realistic_price(self, query, index=0):
         query_lower = query.lower()
         if any(word in query_lower for word in ['phone', 'laptop']):
@@ -281,7 +2907,7 @@ class PriceFinder:
         product_link = item.get('product_link', '')
         if product_link:
             return product_link
-        general_link = item.get('link', '')
+        general_link = item.get('link', '') or item.get('product_page_url', '')
         if general_link:
             return general_link
         title = item.get('title', '')
@@ -290,139 +2916,323 @@ class PriceFinder:
             return f"https://www.google.com/search?tbm=shop&q={search_query}"
         return "#"
     
+    def _build_params(self, engine, query):
+        params = {'engine': engine, ENGINE_QUERY_PARAMS.get(engine, 'q'): query, 'api_key': self.api_key}
+        if engine in GOOGLE_ENGINES:
+            params.update({'num': 5, 'location': self.location, 'gl': 'us'})
+        return params
+    
+    @timed('serpapi')
     def _make_api_request(self, engine, query):
         if not self.api_key:
             return None
         
-        params = {'engine': engine, 'q': query, 'api_key': self.api_key, 'num': 5, 'location': 'United States', 'gl': 'us'}
+        params = self._build_params(engine, query)
+        wait = self._admit_request(engine)
+        if wait is None:
+            return None
+        if wait > 0:
+            time.sleep(wait)
+        failed = True
         try:
-            time.sleep(0.3)
-            response = requests.get(self.base_url, params=params, timeout=(self.timeouts['connect'], self.timeouts['read']))
+            response = http_client.get(self.base_url, params=params, timeout=(self.timeouts['connect'], self.timeouts['read']))
+            failed = self._upstream_failed(response)
             if response.status_code != 200:
                 return None
             return response.json()
         except Exception as e:
-            print(f"Error en request: {e}")
+            log.error('Error en request a SerpAPI', engine=engine, error=str(e))
             return None
+        finally:
+            self.circuit_breaker.record(failed)
     
-    def _process_results(self, data, engine):
+    def _admit_request(self, engine):
+        """Segundos a esperar antes de llamar a SerpAPI, o None si el circuit
+        breaker o el limitador lo impiden. Si devuelve una espera, el llamante
+        debe cerrar con circuit_breaker.record()."""
+        if not self.circuit_breaker.allow():
+            log.warning('Circuit breaker abierto - omitiendo motor', sample=LOG_SAMPLE_RATE, engine=engine)
+            return None
+        wait = self.rate_limiter.reserve()
+        self.rate_limiter._record(wait)
+        if wait is None:
+            # Si era la petición de prueba de half_open, sin devolverla el breaker no se cerraría nunca
+            self.circuit_breaker.release()
+            log.warning('Límite de tasa de SerpAPI alcanzado - omitiendo motor', engine=engine)
+        return wait
+    
+    @staticmethod
+    def _upstream_failed(response):
+        """True si la respuesta cuenta como fallo de SerpAPI para el circuit breaker"""
+        record_upstream_response('serpapi', response)
+        # 4xx distintos de 429 son errores de la petición, no del upstream
+        return response.status_code == 429 or response.status_code >= 500
+    
+    @timed('process_results')
+    def _process_results(self, data, engine, query=None):
         if not data:
             return []
         products = []
-        results_key = 'shopping_results' if engine == 'google_shopping' else 'organic_results'
+        results_key = ENGINE_RESULT_KEYS.get(engine, 'organic_results')
         if results_key not in data:
             return []
         
-        for item in data[results_key][:3]:
-            try:
-                if not item or self._is_blacklisted_store(item.get('source', '')):
-                    continue
-                title = item.get('title', '')
-                if not title or len(title) < 3:
-                    continue
-                
-                price_str = item.get('price', '')
-                price_num = self._extract_price(price_str)
-                if price_num == 0:
-                    price_num = self._generate_realistic_price(title, len(products))
-                    price_str = f"${price_num:.2f}"
-                
-                products.append({
-                    'title': self._clean_text(title),
-                    'price': str(price_str),
-                    'price_numeric': float(price_num),
-                    'source': self._clean_text(item.get('source', 'Tienda')),
-                    'link': self._get_valid_link(item),
-                    'rating': str(item.get('rating', '')),
-                    'reviews': str(item.get('reviews', '')),
-                    'image': ''
-                })
-                if len(products) >= 3:
-                    break
-            except Exception as e:
-                print(f"Error procesando item: {e}")
-                continue
+        items = [
+            item for item in data[results_key]
+            if isinstance(item, dict) and len(str(item.get('title') or '')) >= 3
+            and not self._is_blacklisted_store(item.get('source', ''))
+        ]
+        observed = []
+        # Todos los precios de la página se normalizan de una vez
+        for item, (price_str, price_num, _) in zip(items, self.normalizer.normalize_page(items)):
+            title = item['title']
+            estimated = price_num == 0
+            if estimated:
+                price_num = self._generate_realistic_price(title, len(products))
+                price_str = f"${price_num:.2f}"
+            
+            products.append({
+                'title': self._clean_text(title),
+                'price': str(price_str),
+                'price_numeric': float(price_num),
+                'source': self._clean_text(item.get('source', 'Tienda')),
+                'link': self._get_valid_link(item),
+                'rating': str(item.get('rating', '')),
+                'reviews': str(item.get('reviews', '')),
+                'image': ''
+            })
+            if not estimated:
+                observed.append(products[-1])
+        # Solo se guardan precios reales, no los estimados
+        if self.history and query and observed:
+            self.history.record(query, observed)
         return products
     
-    def search_products(self, query=None, image_content=None):
-        """Búsqueda mejorada con soporte para imagen"""
-        # Determinar consulta final
-        final_query = None
-        search_source = "text"
-        
-        if image_content and GEMINI_READY and PIL_AVAILABLE:
-            if validate_image(image_content):
-                if query:
-                    # Texto + imagen
-                    image_query = analyze_image_with_gemini(image_content)
-                    if image_query:
-                        final_query = f"{query} {image_query}"
-                        search_source = "combined"
-                        print(f"🔗 Búsqueda combinada: texto + imagen")
-                    else:
-                        final_query = query
-                        search_source = "text_fallback"
-                        print(f"📝 Imagen falló, usando solo texto")
-                else:
-                    # Solo imagen
-                    final_query = analyze_image_with_gemini(image_content)
-                    search_source = "image"
-                    print(f"🖼️ Búsqueda basada en imagen")
-            else:
-                print("❌ Imagen inválida")
-                final_query = query or "producto"
-                search_source = "text"
-        else:
-            # Solo texto o imagen no disponible
-            final_query = query or "producto"
-            search_source = "text"
-            if image_content and not GEMINI_READY:
-                print("⚠️ Imagen proporcionada pero Gemini no está configurado")
+    def _engine_query(self, engine, final_query):
+        return f'"{final_query}" buy online' if engine in GOOGLE_ENGINES else final_query
+    
+    def _query_engine(self, engine, final_query):
+        data = self._make_api_request(engine, self._engine_query(engine, final_query))
+        return self._process_results(data, engine, final_query)
+    
+    def _dedupe_products(self, products):
+        seen = set()
+        unique = []
+        for product in products:
+            key = (product['title'].lower(), product['source'].lower())
+            if key in seen or (product['link'] != '#' and product['link'] in seen):
+                continue
+            seen.add(key)
+            seen.add(product['link'])
+            unique.append(product)
+        return unique
+    
+    def _search_engines(self, final_query, engines, progress=None):
+        """Consulta varios motores en paralelo y devuelve lo que llegue antes del límite"""
+        futures = {submit_with_context(search_executor, self._query_engine, engine, final_query): engine for engine in engines}
+        all_products = []
+        try:
+            for future in as_completed(futures, timeout=self.search_deadline):
+                try:
+                    all_products.extend(future.result())
+                    if progress and all_products:
+                        progress('partial_results', self.clusterer.cluster(self._dedupe_products(all_products)))
+                except Exception as e:
+                    log.error('Error en motor', engine=futures[future], error=str(e))
+        except FuturesTimeoutError:
+            pending = [futures[f] for f in futures if not f.done()]
+            log.warning('Límite de tiempo alcanzado - resultados parciales', deadline=self.search_deadline, pending=pending)
+            for future in futures:
+                future.cancel()
+        return self._dedupe_products(all_products)
+    
+    def search_products(self, query=None, image_content=None, engines=None, progress=None, user_id=None):
+        """Búsqueda mejorada con soporte para imagen.
+        
+        progress(fase, productos) se invoca opcionalmente al cambiar de fase
+        ('analyzing_image', 'querying_engines', 'partial_results'). user_id
+        cuenta la consulta para las sugerencias compartidas.
+        """
+        analyzed = self._needs_image_analysis(image_content)
+        image_query = None
+        if analyzed:
+            if progress:
+                progress('analyzing_image', None)
+            image_query = analyze_image_with_gemini(image_content)
+        final_query, search_source = self._resolve_query(query, analyzed, image_query)
         
         if not final_query or len(final_query.strip()) < 2:
             return self._get_examples("producto")
         
         final_query = final_query.strip()
-        print(f"📝 Búsqueda final: '{final_query}' (fuente: {search_source})")
+        bind_log_context(search_source=search_source)
+        log.info('Búsqueda final', sample=LOG_SAMPLE_RATE, query=final_query)
         
         # Continuar con lógica de búsqueda existente
         if not self.api_key:
-            print("Sin API key - usando ejemplos")
+            log.warning('Sin API key - usando ejemplos')
             return self._get_examples(final_query)
         
-        cache_key = f"search_{hash(final_query.lower())}"
-        if cache_key in self.cache:
-            cache_data, timestamp = self.cache[cache_key]
-            if (time.time() - timestamp) < self.cache_ttl:
-                return cache_data
-        
-        start_time = time.time()
-        all_products = []
-        
-        if time.time() - start_time < 8:
-            query_optimized = f'"{final_query}" buy online'
-            data = self._make_api_request('google_shopping', query_optimized)
-            products = self._process_results(data, 'google_shopping')
-            all_products.extend(products)
-        
-        if not all_products:
-            all_products = self._get_examples(final_query)
+        engines = engines or self.engines
+        cache_key, products = self._cached_products(final_query, engines)
+        if products is None:
+            if progress:
+                progress('querying_engines', None)
+            # Búsquedas idénticas simultáneas comparten una sola llamada a SerpAPI
+            products = self.single_flight.do(
+                cache_key,
+                lambda: self._fetch_products(cache_key, final_query, engines, progress),
+                poll=lambda: self._poll_fresh(cache_key)
+            )
+            if products is None:
+                products = self._get_examples(final_query)
         
-        all_products.sort(key=lambda x: x['price_numeric'])
-        final_products = all_products[:6]
+        return self._annotate(products, query, search_source, user_id)
+    
+    # Pasos compartidos con el modo asíncrono (asgi.py): solo la E/S cambia
+    
+    def _needs_image_analysis(self, image_content):
+        """True si la imagen debe analizarse con Gemini"""
+        if not image_content:
+            return False
+        if not (GEMINI_READY and PIL_AVAILABLE):
+            if not GEMINI_READY:
+                log.warning('Imagen proporcionada pero Gemini no está configurado')
+            return False
+        if not validate_image(image_content):
+            log.warning('Imagen inválida')
+            return False
+        return True
+    
+    def _resolve_query(self, query, analyzed, image_query):
+        """(consulta final, origen) a partir del texto y de la consulta generada desde la imagen"""
+        if not analyzed:
+            # Solo texto o imagen no disponible
+            return query or "producto", "text"
+        if not query:
+            return image_query, "image"
+        if image_query:
+            return f"{query} {image_query}", "combined"
+        log.info('Imagen falló, usando solo texto')
+        return query, "text_fallback"
+    
+    def _cached_products(self, final_query, engines):
+        """(clave, productos) desde la caché o el respaldo; productos None si hay que consultar SerpAPI"""
+        cache_key = self._cache_key(final_query, engines)
+        entry = self.cache.get_entry(cache_key)
+        if entry is None and self.query_index:
+            # Consulta equivalente ya cacheada (p. ej. variaciones de Gemini)
+            match = self.query_index.lookup(canonicalize_query(final_query))
+            if match:
+                match_key = self._cache_key(match, engines)
+                entry = self.cache.get_entry(match_key, record=False)
+                if entry is None:
+                    self.query_index.discard(match)
+                else:
+                    log.info('Consulta servida por equivalencia', sample=LOG_SAMPLE_RATE, match=match)
+                    cache_key = match_key
+        if entry is not None:
+            # Stale-while-revalidate: se sirve ya y se refresca en segundo plano
+            if not entry.fresh:
+                self._schedule_refresh(cache_key, final_query, engines)
+            return cache_key, entry.value
+        if self.circuit_breaker.is_open():
+            log.warning('SerpAPI no disponible (circuit breaker) - usando histórico o ejemplos')
+            return cache_key, self._get_fallback(final_query)
+        return cache_key, None
+    
+    def _annotate(self, products, query, search_source, user_id=None):
+        # Solo las consultas escritas que dieron resultados reales alimentan las sugerencias
+        if query and products and products[0].get('search_source') != 'example':
+            query_suggester.record(query, user_id)
         
-        # Añadir metadata
-        for product in final_products:
+        # Añadir metadata (por petición, sin modificar la copia compartida)
+        final_products = []
+        for product in products:
+            product = dict(product)
             product['search_source'] = search_source
             product['original_query'] = query if query else "imagen"
+            final_products.append(product)
         
-        self.cache[cache_key] = (final_products, time.time())
-        if len(self.cache) > 10:
-            oldest_key = min(self.cache.keys(), key=lambda k: self.cache[k][1])
-            del self.cache[oldest_key]
+        return final_products
+    
+    def _cache_key(self, final_query, engines):
+        return make_cache_key(final_query, ','.join(sorted(engines)), self.location)
+    
+    def is_cached(self, query, engines=None):
+        """True si una consulta de texto se resuelve sin llamar a SerpAPI (caché fresca o stale, o ejemplos)"""
+        final_query = (query or '').strip()
+        if not self.api_key or len(final_query) < 2:
+            return True
+        return self.cache.get_entry(self._cache_key(final_query, engines or self.engines), record=False) is not None
+    
+    def _fetch_products(self, cache_key, final_query, engines, progress=None):
+        return self._store_results(cache_key, final_query, self._search_engines(final_query, engines, progress))
+    
+    def _store_results(self, cache_key, final_query, all_products):
+        """Agrupa, cachea y devuelve los productos de una consulta a SerpAPI (o el respaldo si vino vacía)"""
+        if not all_products:
+            # Si había una entrada válida (aunque caducada) se conserva en lugar de pisarla
+            entry = self.cache.get_entry(cache_key, record=False)
+            if entry is not None and not entry.negative:
+                return entry.value
+            fallback = self._get_fallback(final_query)
+            self.cache.set(cache_key, fallback, ttl=self.negative_ttl, negative=True)
+            return fallback
         
+        # Un hueco por producto: los anuncios del mismo artículo pasan a ser ofertas
+        final_products = self.clusterer.cluster(all_products)[:self.max_results]
+        self.cache.set(cache_key, final_products)
+        if self.query_index:
+            self.query_index.add(canonicalize_query(final_query))
         return final_products
     
+    def _poll_fresh(self, cache_key):
+        """Resultado publicado por otro worker (incluidas entradas negativas)"""
+        entry = self.cache.get_entry(cache_key, record=False)
+        return entry.value if entry is not None and entry.fresh else None
+    
+    def _schedule_refresh(self, cache_key, final_query, engines):
+        """Lanza un refresco en segundo plano (uno por clave) salvo con el breaker abierto"""
+        if self.circuit_breaker.is_open():
+            return
+        with self._refreshing_lock:
+            if cache_key in self._refreshing:
+                return
+            self._refreshing.add(cache_key)
+        try:
+            submit_with_context(refresh_executor, self._refresh, cache_key, final_query, engines)
+        except RuntimeError:
+            # Executor cerrado (apagado del proceso)
+            with self._refreshing_lock:
+                self._refreshing.discard(cache_key)
+    
+    def _refresh(self, cache_key, final_query, engines):
+        try:
+            self.single_flight.do(
+                cache_key,
+                lambda: self._fetch_products(cache_key, final_query, engines),
+                poll=lambda: self._poll_fresh(cache_key)
+            )
+        except Exception as e:
+            log.error('Error refrescando caché', error=str(e))
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(cache_key)
+    
+    def _get_fallback(self, final_query):
+        """Precios recientes del histórico para la consulta; si no hay, ejemplos"""
+        if self.history:
+            try:
+                recent = self.history.recent(final_query, self.history_fallback_age)
+            except sqlite3.Error as e:
+                log.warning('Histórico de precios no disponible', error=str(e))
+                recent = []
+            if recent:
+                log.info('Respondiendo desde el histórico de precios', results=len(recent))
+                return recent[:self.max_results]
+        return self._get_examples(final_query)
+    
     def _get_examples(self, query):
         stores = ['Amazon', 'Walmart', 'Target']
         examples = []
@@ -453,173 +3263,245 @@ class PriceFinder:
 # Instancia global de PriceFinder
 price_finder = PriceFinder()
 
-# Templates
-def render_page(title, content):
-    template = '''<!DOCTYPE html>
-<html lang="es">
-<head>
-    <title>''' + title + '''</title>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        body { font-family: -apple-system, sans-serif; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; padding: 15px; }
-        .container { max-width: 650px; margin: 0 auto; background: white; padding: 25px; border-radius: 12px; box-shadow: 0 8px 25px rgba(0,0,0,0.15); }
-        h1 { color: #1a73e8; text-align: center; margin-bottom: 8px; font-size: 1.8em; }
-        .subtitle { text-align: center; color: #666; margin-bottom: 25px; }
-        input { width: 100%; padding: 12px; margin: 8px 0; border: 2px solid #e1e5e9; border-radius: 6px; font-size: 16px; }
-        input:focus { outline: none; border-color: #1a73e8; }
-        button { width: 100%; padding: 12px; background: #1a73e8; color: white; border: none; border-radius: 6px; cursor: pointer; font-size: 16px; font-weight: 600; }
-        button:hover { background: #1557b0; }
-        .search-bar { display: flex; gap: 8px; margin-bottom: 20px; }
-        .search-bar input { flex: 1; }
-        .search-bar button { width: auto; padding: 12px 20px; }
-        .tips { background: #e8f5e8; border: 1px solid #4caf50; padding: 15px; border-radius: 6px; margin-bottom: 15px; font-size: 14px; }
-        .error { background: #ffebee; color: #c62828; padding: 12px; border-radius: 6px; margin: 12px 0; display: none; }
-        .loading { text-align: center; padding: 30px; display: none; }
-        .spinner { border: 3px solid #f3f3f3; border-top: 3px solid #1a73e8; border-radius: 50%; width: 40px; height: 40px; animation: spin 1s linear infinite; margin: 0 auto 15px; }
-        @keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }
-        .user-info { background: #e3f2fd; padding: 12px; border-radius: 6px; margin-bottom: 15px; text-align: center; font-size: 14px; display: flex; align-items: center; justify-content: center; }
-        .user-info a { color: #1976d2; text-decoration: none; font-weight: 600; }
-        .flash { padding: 12px; margin-bottom: 8px; border-radius: 6px; font-size: 14px; }
-        .flash.success { background-color: #d4edda; color: #155724; }
-        .flash.danger { background-color: #f8d7da; color: #721c24; }
-        .flash.warning { background-color: #fff3cd; color: #856404; }
-        .image-upload { background: #f8f9fa; border: 2px dashed #dee2e6; border-radius: 8px; padding: 20px; text-align: center; margin: 15px 0; transition: all 0.3s ease; }
-        .image-upload input[type="file"] { display: none; }
-        .image-upload label { cursor: pointer; color: #1a73e8; font-weight: 600; }
-        .image-upload:hover { border-color: #1a73e8; background: #e3f2fd; }
-        .image-preview { max-width: 150px; max-height: 150px; margin: 10px auto; border-radius: 8px; display: none; }
-        .or-divider { text-align: center; margin: 20px 0; color: #666; font-weight: 600; position: relative; }
-        .or-divider:before { content: ''; position: absolute; top: 50%; left: 0; right: 0; height: 1px; background: #dee2e6; z-index: 1; }
-        .or-divider span { background: white; padding: 0 15px; position: relative; z-index: 2; }
-    </style>
-</head>
-<body>''' + content + '''</body>
-</html>'''
-    return template
-
-AUTH_LOGIN_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="es">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Iniciar Sesion | Price Finder USA</title>
-    <style>
-        body { font-family: -apple-system, sans-serif; background: linear-gradient(135deg, #4A90E2 0%, #50E3C2 100%); min-height: 100vh; display: flex; justify-content: center; align-items: center; padding: 20px; }
-        .auth-container { max-width: 420px; width: 100%; background: white; border-radius: 15px; box-shadow: 0 20px 40px rgba(0,0,0,0.1); overflow: hidden; }
-        .form-header { text-align: center; padding: 30px 25px 15px; background: linear-gradient(45deg, #2C3E50, #4A90E2); color: white; }
-        .form-header h1 { font-size: 1.8em; margin-bottom: 8px; }
-        .form-header p { opacity: 0.9; font-size: 1em; }
-        .form-body { padding: 25px; }
-        form { display: flex; flex-direction: column; gap: 18px; }
-        .input-group { display: flex; flex-direction: column; gap: 6px; }
-        .input-group label { font-weight: 600; color: #2C3E50; font-size: 14px; }
-        .input-group input { padding: 14px 16px; border: 2px solid #e0e0e0; border-radius: 8px; font-size: 16px; transition: border-color 0.3s ease; }
-        .input-group input:focus { outline: 0; border-color: #4A90E2; }
-        .submit-btn { background: linear-gradient(45deg, #4A90E2, #2980b9); color: white; border: none; padding: 14px 25px; font-size: 16px; font-weight: 600; border-radius: 8px; cursor: pointer; transition: transform 0.2s ease; }
-        .submit-btn:hover { transform: translateY(-2px); }
-        .flash-messages { list-style: none; padding: 0 25px 15px; }
-        .flash { padding: 12px; margin-bottom: 10px; border-radius: 6px; text-align: center; font-size: 14px; }
-        .flash.success { background-color: #d4edda; color: #155724; }
-        .flash.danger { background-color: #f8d7da; color: #721c24; }
-        .flash.warning { background-color: #fff3cd; color: #856404; }
-    </style>
-</head>
-<body>
-    <div class="auth-container">
-        <div class="form-header">
-            <h1>Price Finder USA</h1>
-            <p>Iniciar Sesion</p>
-        </div>
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                <ul class="flash-messages">
-                    {% for category, message in messages %}
-                        <li class="flash {{ category }}">{{ message }}</li>
-                    {% endfor %}
-                </ul>
-            {% endif %}
-        {% endwith %}
-        <div class="form-body">
-            <form action="{{ url_for('auth_login') }}" method="post">
-                <div class="input-group">
-                    <label for="email">Correo Electronico</label>
-                    <input type="email" name="email" id="email" required>
-                </div>
-                <div class="input-group">
-                    <label for="password">Contraseña</label>
-                    <input type="password" name="password" id="password" required>
-                </div>
-                <button type="submit" class="submit-btn">Entrar</button>
-            </form>
-        </div>
-    </div>
-</body>
-</html>
-"""
-
-# Routes
-@app.route('/auth/login-page')
-def auth_login_page():
-    return render_template_string(AUTH_LOGIN_TEMPLATE)
+# ==============================================================================
+# BÚSQUEDAS ASÍNCRONAS (JOBS)
+# ==============================================================================
 
-@app.route('/auth/login', methods=['POST'])
-def auth_login():
-    email = request.form.get('email', '').strip()
-    password = request.form.get('password', '').strip()
+class SearchJobManager:
+    """Ejecuta búsquedas en un pool acotado y publica su progreso en SQLite.
     
-    if not email or not password:
-        flash('Por favor completa todos los campos.', 'danger')
-        return redirect(url_for('auth_login_page'))
+    El estado se guarda en el archivo compartido para que cualquier worker
+    pueda responder al polling o al stream SSE de un job.
+    """
+    FINISHED = ('done', 'error')
     
-    print(f"Login attempt for {email}")
-    result = firebase_auth.login_user(email, password)
+    def __init__(self, db, finder, max_workers=4, max_pending=32, ttl=600):
+        self.db = db
+        self.finder = finder
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='search-job')
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS search_jobs ('
+            'id TEXT PRIMARY KEY, user_id TEXT, status TEXT NOT NULL, '
+            'products TEXT, meta TEXT, error TEXT, '
+            'created_at REAL NOT NULL, updated_at REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_search_jobs_created ON search_jobs(created_at)')
+    
+    def submit(self, user_id, query, image_content, meta):
+        """Encola una búsqueda; devuelve el ID del job o None si la cola está llena"""
+        if not self._reserve():
+            return None
+        try:
+            job_id = self._create(user_id, meta)
+        except Exception:
+            self._release()
+            raise
+        submit_with_context(self.executor, self._run, job_id, user_id, query, image_content)
+        return job_id
+    
+    # Pasos compartidos con el modo asíncrono (asgi.py), que ejecuta el job como tarea
+    
+    def _reserve(self, max_pending=None):
+        """Ocupa un hueco de la cola; False si está llena"""
+        with self._lock:
+            if self._pending >= (max_pending or self.max_pending):
+                self.rejected += 1
+                return False
+            self._pending += 1
+            self.submitted += 1
+            return True
+    
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+    
+    def _create(self, user_id, meta):
+        """Registra el job en estado 'queued' y devuelve su ID"""
+        job_id = os.urandom(12).hex()
+        now = time.time()
+        self.db.execute('DELETE FROM search_jobs WHERE created_at <= ?', (now - self.ttl,))
+        self.db.execute(
+            'INSERT INTO search_jobs (id, user_id, status, meta, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (job_id, user_id, 'queued', json.dumps(meta, ensure_ascii=False), now, now)
+        )
+        return job_id
+    
+    def _update(self, job_id, status, products=None, error=None):
+        self.db.execute(
+            'UPDATE search_jobs SET status = ?, products = COALESCE(?, products), error = ?, updated_at = ? WHERE id = ?',
+            (status, json.dumps(products, ensure_ascii=False) if products is not None else None, error, time.time(), job_id)
+        )
+    
+    def _run(self, job_id, user_id, query, image_content):
+        try:
+            progress = lambda phase, products: self._update(job_id, phase, products)
+            products = self.finder.search_products(query=query, image_content=image_content, progress=progress, user_id=user_id)
+            self._update(job_id, 'done', products)
+        except Exception as e:
+            log.error('Error en job de búsqueda', job_id=job_id, error=str(e))
+            self._update(job_id, 'error', self.finder._get_examples(query or 'producto'), 'Error en la búsqueda')
+        finally:
+            self._release()
+    
+    def get(self, job_id):
+        row = self.db.execute(
+            'SELECT user_id, status, products, meta, error, updated_at FROM search_jobs WHERE id = ?', (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'user_id': row[0],
+            'status': row[1],
+            'products': json.loads(row[2]) if row[2] else [],
+            'meta': json.loads(row[3]) if row[3] else {},
+            'error': row[4],
+            'updated_at': row[5]
+        }
     
-    if result['success']:
-        firebase_auth.set_user_session(result['user_data'])
-        flash(result['message'], 'success')
-        print(f"Successful login for {email}")
-        return redirect(url_for('index'))
-    else:
-        flash(result['message'], 'danger')
-        print(f"Failed login for {email}")
-        return redirect(url_for('auth_login_page'))
-
-@app.route('/auth/logout')
-def auth_logout():
-    firebase_auth.clear_user_session()
-    flash('Has cerrado la sesion correctamente.', 'success')
-    return redirect(url_for('auth_login_page'))
+    def stats(self):
+        return {'pending': self._pending, 'max_pending': self.max_pending, 'submitted': self.submitted, 'rejected': self.rejected}
 
-@app.route('/')
-def index():
-    if not firebase_auth.is_user_logged_in():
-        return redirect(url_for('auth_login_page'))
-    return redirect(url_for('search_page'))
+# ==============================================================================
+# RESULTADOS EN EL SERVIDOR (la sesión solo guarda el ID)
+# ==============================================================================
 
-@app.route('/search')
-@login_required
-def search_page():
-    current_user = firebase_auth.get_current_user()
-    user_name = current_user['user_name'] if current_user else 'Usuario'
-    user_name_escaped = html.escape(user_name)
+class ResultStore:
+    """Resultados de búsqueda con TTL guardados en SQLite bajo un ID opaco"""
+    def __init__(self, db, ttl=1800):
+        self.db = db
+        self.ttl = ttl
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS search_results ('
+            'id TEXT PRIMARY KEY, user_id TEXT, data TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_search_results_expires ON search_results(expires_at)')
     
-    # Verificar si búsqueda por imagen está disponible
-    image_search_available = GEMINI_READY and PIL_AVAILABLE
+    def put(self, user_id, data, result_id=None):
+        result_id = result_id or os.urandom(12).hex()
+        now = time.time()
+        self.db.execute('DELETE FROM search_results WHERE expires_at <= ?', (now,))
+        self.db.execute(
+            'INSERT OR REPLACE INTO search_results (id, user_id, data, expires_at) VALUES (?, ?, ?, ?)',
+            (result_id, user_id, json.dumps(data, ensure_ascii=False), now + self.ttl)
+        )
+        return result_id
     
-    content = '''
+    def get(self, result_id, user_id):
+        row = self.db.execute(
+            'SELECT data FROM search_results WHERE id = ? AND user_id = ? AND expires_at > ?',
+            (result_id, user_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+result_store = ResultStore(local_db, ttl=app.config['PERMANENT_SESSION_LIFETIME'])
+
+search_jobs = SearchJobManager(
+    local_db, price_finder,
+    max_workers=int(os.environ.get('SEARCH_JOB_WORKERS', 4)),
+    max_pending=int(os.environ.get('SEARCH_JOB_QUEUE_MAX', 32)),
+    ttl=int(os.environ.get('SEARCH_JOB_TTL', 600))
+)
+
+# Búsquedas por lotes: los fallos de caché se resuelven en paralelo (el
+# limitador de SerpAPI sigue aplicando dentro de cada búsqueda)
+batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('SEARCH_BATCH_WORKERS', 8)),
+    thread_name_prefix='search-batch'
+)
+SEARCH_BATCH_MAX_ITEMS = int(os.environ.get('SEARCH_BATCH_MAX_ITEMS', 500))
+
+# Templates (compilados una sola vez al arrancar; ver TEMPLATES más abajo)
+APP_CSS = """
+    * { margin: 0; padding: 0; box-sizing: border-box; }
+    body { font-family: -apple-system, sans-serif; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; padding: 15px; }
+    .container { max-width: 650px; margin: 0 auto; background: white; padding: 25px; border-radius: 12px; box-shadow: 0 8px 25px rgba(0,0,0,0.15); }
+    h1 { color: #1a73e8; text-align: center; margin-bottom: 8px; font-size: 1.8em; }
+    .subtitle { text-align: center; color: #666; margin-bottom: 25px; }
+    input { width: 100%; padding: 12px; margin: 8px 0; border: 2px solid #e1e5e9; border-radius: 6px; font-size: 16px; }
+    input:focus { outline: none; border-color: #1a73e8; }
+    button { width: 100%; padding: 12px; background: #1a73e8; color: white; border: none; border-radius: 6px; cursor: pointer; font-size: 16px; font-weight: 600; }
+    button:hover { background: #1557b0; }
+    .search-bar { display: flex; gap: 8px; margin-bottom: 20px; }
+    .search-bar input { flex: 1; }
+    .search-bar button { width: auto; padding: 12px 20px; }
+    .tips { background: #e8f5e8; border: 1px solid #4caf50; padding: 15px; border-radius: 6px; margin-bottom: 15px; font-size: 14px; }
+    .error { background: #ffebee; color: #c62828; padding: 12px; border-radius: 6px; margin: 12px 0; display: none; }
+    .loading { text-align: center; padding: 30px; display: none; }
+    .spinner { border: 3px solid #f3f3f3; border-top: 3px solid #1a73e8; border-radius: 50%; width: 40px; height: 40px; animation: spin 1s linear infinite; margin: 0 auto 15px; }
+    @keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }
+    .user-info { background: #e3f2fd; padding: 12px; border-radius: 6px; margin-bottom: 15px; text-align: center; font-size: 14px; display: flex; align-items: center; justify-content: center; }
+    .user-info a { color: #1976d2; text-decoration: none; font-weight: 600; }
+    .flash { padding: 12px; margin-bottom: 8px; border-radius: 6px; font-size: 14px; }
+    .flash.success { background-color: #d4edda; color: #155724; }
+    .flash.danger { background-color: #f8d7da; color: #721c24; }
+    .flash.warning { background-color: #fff3cd; color: #856404; }
+    .image-upload { background: #f8f9fa; border: 2px dashed #dee2e6; border-radius: 8px; padding: 20px; text-align: center; margin: 15px 0; transition: all 0.3s ease; }
+    .image-upload input[type="file"] { display: none; }
+    .image-upload label { cursor: pointer; color: #1a73e8; font-weight: 600; }
+    .image-upload:hover { border-color: #1a73e8; background: #e3f2fd; }
+    .image-preview { max-width: 150px; max-height: 150px; margin: 10px auto; border-radius: 8px; display: none; }
+    .or-divider { text-align: center; margin: 20px 0; color: #666; font-weight: 600; position: relative; }
+    .or-divider:before { content: ''; position: absolute; top: 50%; left: 0; right: 0; height: 1px; background: #dee2e6; z-index: 1; }
+    .or-divider span { background: white; padding: 0 15px; position: relative; z-index: 2; }
+"""
+
+AUTH_CSS = """
+    body { font-family: -apple-system, sans-serif; background: linear-gradient(135deg, #4A90E2 0%, #50E3C2 100%); min-height: 100vh; display: flex; justify-content: center; align-items: center; padding: 20px; }
+    .auth-container { max-width: 420px; width: 100%; background: white; border-radius: 15px; box-shadow: 0 20px 40px rgba(0,0,0,0.1); overflow: hidden; }
+    .form-header { text-align: center; padding: 30px 25px 15px; background: linear-gradient(45deg, #2C3E50, #4A90E2); color: white; }
+    .form-header h1 { font-size: 1.8em; margin-bottom: 8px; }
+    .form-header p { opacity: 0.9; font-size: 1em; }
+    .form-body { padding: 25px; }
+    form { display: flex; flex-direction: column; gap: 18px; }
+    .input-group { display: flex; flex-direction: column; gap: 6px; }
+    .input-group label { font-weight: 600; color: #2C3E50; font-size: 14px; }
+    .input-group input { padding: 14px 16px; border: 2px solid #e0e0e0; border-radius: 8px; font-size: 16px; transition: border-color 0.3s ease; }
+    .input-group input:focus { outline: 0; border-color: #4A90E2; }
+    .submit-btn { background: linear-gradient(45deg, #4A90E2, #2980b9); color: white; border: none; padding: 14px 25px; font-size: 16px; font-weight: 600; border-radius: 8px; cursor: pointer; transition: transform 0.2s ease; }
+    .submit-btn:hover { transform: translateY(-2px); }
+    .flash-messages { list-style: none; padding: 0 25px 15px; }
+    .flash { padding: 12px; margin-bottom: 10px; border-radius: 6px; text-align: center; font-size: 14px; }
+    .flash.success { background-color: #d4edda; color: #155724; }
+    .flash.danger { background-color: #f8d7da; color: #721c24; }
+    .flash.warning { background-color: #fff3cd; color: #856404; }
+"""
+
+# CSS servido como recurso estático versionado (ETag + cache inmutable)
+STATIC_ASSETS = {
+    'app.css': APP_CSS.encode('utf-8'),
+    'auth.css': AUTH_CSS.encode('utf-8'),
+}
+ASSET_VERSIONS = {name: hashlib.sha256(body).hexdigest()[:16] for name, body in STATIC_ASSETS.items()}
+
+BASE_TEMPLATE = """<!DOCTYPE html>
+<html lang="es">
+<head>
+    <title>{{ title }}</title>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <link rel="stylesheet" href="{{ asset_url('app.css') }}">
+</head>
+<body>{% block content %}{% endblock %}</body>
+</html>"""
+
+SEARCH_TEMPLATE = """{% extends 'base.html' %}
+{% block content %}
     <div class="container">
         <div class="user-info">
-            <span><strong>''' + user_name_escaped + '''</strong></span>
+            <span><strong>{{ user_name }}</strong></span>
             <div style="display: inline-block; margin-left: 15px;">
-                <a href="''' + url_for('auth_logout') + '''" style="background: #dc3545; color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px; margin-right: 8px;">Salir</a>
-                <a href="''' + url_for('index') + '''" style="background: #28a745; color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px;">Inicio</a>
+                <a href="{{ url_for('auth_logout') }}" style="background: #dc3545; color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px; margin-right: 8px;">Salir</a>
+                <a href="{{ url_for('index') }}" style="background: #28a745; color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px;">Inicio</a>
             </div>
         </div>
         
-        {% with messages = get_flashed_messages(with_categories=true) %}
+        {% with messages = flashes %}
             {% if messages %}
                 {% for category, message in messages %}
                     <div class="flash {{ category }}">{{ message }}</div>
@@ -628,26 +3510,27 @@ def search_page():
         {% endwith %}
         
         <h1>Buscar Productos</h1>
-        <p class="subtitle">''' + ('Búsqueda por texto o imagen' if image_search_available else 'Búsqueda por texto') + ''' - Resultados en 15 segundos</p>
+        <p class="subtitle">{{ 'Búsqueda por texto o imagen' if image_search_available else 'Búsqueda por texto' }} - Resultados en 15 segundos</p>
         
         <form id="searchForm" enctype="multipart/form-data">
             <div class="search-bar">
-                <input type="text" id="searchQuery" name="query" placeholder="Busca cualquier producto...">
+                <input type="text" id="searchQuery" name="query" placeholder="Busca cualquier producto..." list="querySuggestions" autocomplete="off">
+                <datalist id="querySuggestions"></datalist>
                 <button type="submit">Buscar</button>
             </div>
             
-            ''' + ('<div class="or-divider"><span>O sube una imagen</span></div>' if image_search_available else '') + '''
+            {% if image_search_available %}<div class="or-divider"><span>O sube una imagen</span></div>{% endif %}
             
-            ''' + ('<div class="image-upload" id="imageUpload"><input type="file" id="imageFile" name="image_file" accept="image/*"><label for="imageFile">📷 Buscar por imagen<br><small>JPG o PNG hasta 10MB</small></label><img id="imagePreview" class="image-preview" src="#" alt="Vista previa"></div>' if image_search_available else '') + '''
+            {% if image_search_available %}<div class="image-upload" id="imageUpload"><input type="file" id="imageFile" name="image_file" accept="image/*"><label for="imageFile">📷 Buscar por imagen<br><small>JPG o PNG hasta 10MB</small></label><img id="imagePreview" class="image-preview" src="#" alt="Vista previa"></div>{% endif %}
         </form>
         
         <div class="tips">
-            <h4>Sistema optimizado''' + (' + Búsqueda por Imagen:' if image_search_available else ':') + '''</h4>
+            <h4>Sistema optimizado{{ ' + Búsqueda por Imagen:' if image_search_available else ':' }}</h4>
             <ul style="margin: 8px 0 0 15px; font-size: 13px;">
                 <li><strong>Velocidad:</strong> Resultados en menos de 15 segundos</li>
                 <li><strong>USA:</strong> Amazon, Walmart, Target, Best Buy</li>
                 <li><strong>Filtrado:</strong> Sin Alibaba, Temu, AliExpress</li>
-                ''' + ('<li><strong>🖼️ IA:</strong> Identifica productos en imágenes automáticamente</li>' if image_search_available else '<li><strong>⚠️ Imagen:</strong> Configura GEMINI_API_KEY para activar</li>') + '''
+                {% if image_search_available %}<li><strong>🖼️ IA:</strong> Identifica productos en imágenes automáticamente</li>{% else %}<li><strong>⚠️ Imagen:</strong> Configura GEMINI_API_KEY para activar</li>{% endif %}
             </ul>
         </div>
         
@@ -661,7 +3544,8 @@ def search_page():
     
     <script>
         let searching = false;
-        const imageSearchAvailable = ''' + str(image_search_available).lower() + ''';
+        const imageSearchAvailable = {{ 'true' if image_search_available else 'false' }};
+        const imageMaxSide = {{ image_max_side }};
         
         // Manejo de vista previa de imagen
         if (imageSearchAvailable) {
@@ -689,6 +3573,48 @@ def search_page():
             });
         }
         
+        // Sugerencias mientras se escribe (con debounce y cancelando la petición anterior)
+        let suggestTimer = null;
+        let suggestController = null;
+        document.getElementById('searchQuery').addEventListener('input', function() {
+            clearTimeout(suggestTimer);
+            const prefix = this.value.trim();
+            if (prefix.length < 2) return;
+            suggestTimer = setTimeout(() => {
+                if (suggestController) suggestController.abort();
+                suggestController = new AbortController();
+                fetch('{{ url_for('api_suggest') }}?q=' + encodeURIComponent(prefix), {signal: suggestController.signal})
+                .then(response => response.json())
+                .then(data => {
+                    const list = document.getElementById('querySuggestions');
+                    list.replaceChildren(...(data.suggestions || []).map(text => {
+                        const option = document.createElement('option');
+                        option.value = text;
+                        return option;
+                    }));
+                })
+                .catch(() => {});
+            }, 200);
+        });
+        
+        // Reduce la imagen en el navegador (WebP o JPEG, lado mayor imageMaxSide); null si no es posible
+        function compactImage(file) {
+            if (!window.createImageBitmap || !HTMLCanvasElement.prototype.toBlob) return Promise.resolve(null);
+            return createImageBitmap(file).then(bitmap => {
+                const scale = Math.min(1, imageMaxSide / Math.max(bitmap.width, bitmap.height));
+                const canvas = document.createElement('canvas');
+                canvas.width = Math.max(1, Math.round(bitmap.width * scale));
+                canvas.height = Math.max(1, Math.round(bitmap.height * scale));
+                canvas.getContext('2d').drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+                bitmap.close();
+                const encode = type => new Promise(resolve => canvas.toBlob(resolve, type, 0.85));
+                // Si el navegador no codifica WebP, toBlob devuelve PNG: se usa JPEG
+                return encode('image/webp').then(blob => blob && blob.type === 'image/webp' ? blob : encode('image/jpeg'));
+            })
+            .then(blob => blob && blob.size < file.size ? blob : null)
+            .catch(() => null);
+        }
+        
         document.getElementById('searchForm').addEventListener('submit', function(e) {
             e.preventDefault();
             if (searching) return;
@@ -703,41 +3629,80 @@ def search_page():
             searching = true;
             showLoading(imageFile ? '🖼️ Analizando imagen con IA...' : 'Buscando productos...');
             
-            const timeoutId = setTimeout(() => { 
-                searching = false; 
-                hideLoading(); 
-                showError('Búsqueda muy lenta - Intenta de nuevo'); 
-            }, 20000);
-            
             const formData = new FormData();
             if (query) formData.append('query', query);
-            if (imageFile) formData.append('image_file', imageFile);
             
-            fetch('/api/search', {
-                method: 'POST',
-                body: formData
-            })
-            .then(response => { 
-                clearTimeout(timeoutId); 
-                searching = false; 
-                return response.json(); 
+            (imageFile ? compactImage(imageFile) : Promise.resolve(null))
+            .then(compact => {
+                if (compact) {
+                    formData.append('image_compact', compact, compact.type === 'image/webp' ? 'image.webp' : 'image.jpg');
+                } else if (imageFile) {
+                    formData.append('image_file', imageFile);
+                }
+                return fetch('/api/search/jobs', {
+                    method: 'POST',
+                    body: formData
+                });
             })
+            .then(response => response.json())
             .then(data => { 
-                hideLoading(); 
                 if (data.success) {
-                    window.location.href = '/results';
+                    followJob(data);
                 } else {
+                    searching = false;
                     showError(data.error || 'Error en la búsqueda');
                 }
             })
             .catch(error => { 
-                clearTimeout(timeoutId); 
                 searching = false; 
                 hideLoading(); 
                 showError('Error de conexión'); 
             });
         });
         
+        const phaseText = {
+            queued: 'En cola...',
+            analyzing_image: '🖼️ Analizando imagen con IA...',
+            querying_engines: 'Consultando tiendas...',
+            partial_results: 'Recibiendo resultados...'
+        };
+        
+        // Sigue el job por polling; por SSE solo si el servidor ofrece events_url
+        function followJob(job) {
+            const deadline = Date.now() + 30000;
+            const finish = () => {
+                fetch(job.status_url)
+                .then(response => response.json())
+                .then(data => {
+                    if (data.success && data.done) {
+                        window.location.href = '/results';
+                    } else if (Date.now() > deadline) {
+                        searching = false;
+                        showError('Búsqueda muy lenta - Intenta de nuevo');
+                    } else {
+                        if (data.success) updatePhase(data.status, data.total);
+                        setTimeout(finish, 800);
+                    }
+                })
+                .catch(() => { searching = false; showError('Error de conexión'); });
+            };
+            if (!job.events_url || !window.EventSource) return finish();
+            const events = new EventSource(job.events_url);
+            const onEvent = e => {
+                const data = JSON.parse(e.data || '{}');
+                updatePhase(e.type, data.total);
+                if (e.type === 'done' || e.type === 'error' || e.type === 'timeout') { events.close(); finish(); }
+            };
+            ['queued', 'analyzing_image', 'querying_engines', 'partial_results', 'done', 'error', 'timeout'].forEach(t => events.addEventListener(t, onEvent));
+            events.onerror = () => { events.close(); finish(); };
+        }
+        
+        function updatePhase(status, total) {
+            let text = phaseText[status];
+            if (status === 'partial_results' && total) text = total + ' resultados recibidos...';
+            if (text) document.getElementById('loadingText').textContent = text;
+        }
+        
         function showLoading(text = 'Buscando productos...') { 
             document.getElementById('loadingText').textContent = text;
             document.getElementById('loading').style.display = 'block'; 
@@ -750,156 +3715,532 @@ def search_page():
             e.textContent = msg; 
             e.style.display = 'block'; 
         }
-    </script>'''
+    </script>
+{% endblock %}"""
+
+RESULTS_TEMPLATE = """{% extends 'base.html' %}
+{% set badges = ['MEJOR', '2do', '3ro'] %}
+{% set colors = ['#4caf50', '#ff9800', '#9c27b0'] %}
+{% set search_type_text = {"texto": "texto", "imagen": "imagen IA", "texto+imagen": "texto + imagen IA", "combined": "búsqueda mixta"} %}
+
+{% macro product_card(product, i) %}
+                <div style="border: 1px solid #ddd; border-radius: 8px; padding: 15px; margin-bottom: 15px; background: white; position: relative; box-shadow: 0 2px 4px rgba(0,0,0,0.08);">
+                    {% if i < 3 %}<div style="position: absolute; top: 8px; right: 8px; background: {{ colors[i] }}; color: white; padding: 4px 8px; border-radius: 12px; font-size: 11px; font-weight: bold;">{{ badges[i] }}</div>{% endif %}
+                    {% if product.search_source == 'image' %}<div style="position: absolute; top: 8px; left: 8px; background: #673ab7; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">📷 IMAGEN</div>
+                    {%- elif product.search_source == 'combined' %}<div style="position: absolute; top: 8px; left: 8px; background: #607d8b; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">🔗 MIXTO</div>{% endif %}
+                    <h3 style="color: #1a73e8; margin-bottom: 8px; font-size: 16px; margin-top: {{ '20px' if product.search_source in ('image', 'combined') else '0' }};">{{ product.title or 'Producto' }}</h3>
+                    <div style="font-size: 28px; color: #2e7d32; font-weight: bold; margin: 12px 0;">{{ product.price or '$0.00' }} <span style="font-size: 12px; color: #666;">USD</span></div>
+                    <p style="color: #666; margin-bottom: 12px; font-size: 14px;">Tienda: {{ product.source or 'Tienda' }}</p>
+                    {% if product.offer_count and product.offer_count > 1 %}<p style="color: #666; margin-bottom: 12px; font-size: 13px;">También en:
+                        {%- for offer in product.offers[1:] %} <a href="{{ offer.link or '#' }}" target="_blank" rel="noopener noreferrer" style="color: #1a73e8;">{{ offer.source }} ({{ offer.price }})</a>{{ ',' if not loop.last }}{% endfor %}</p>{% endif %}
+                    {% if product.lowest_30d and product.lowest_30d[0] < product.price_numeric %}<p style="color: #555; margin-bottom: 12px; font-size: 13px;">📉 Mínimo en 30 días: <strong>${{ '%.2f'|format(product.lowest_30d[0]) }}</strong> en {{ product.lowest_30d[1] }}</p>
+                    {%- elif product.lowest_30d %}<p style="color: #2e7d32; margin-bottom: 12px; font-size: 13px;">📉 Precio más bajo de los últimos 30 días</p>{% endif %}
+                    <a href="{{ product.link or '#' }}" target="_blank" rel="noopener noreferrer" style="background: #1a73e8; color: white; padding: 10px 16px; text-decoration: none; border-radius: 6px; font-weight: 600; display: inline-block; font-size: 14px;">Ver Producto</a>
+                </div>
+{%- endmacro %}
+
+{% block content %}
+        <div style="max-width: 800px; margin: 0 auto;">
+            <div style="background: rgba(255,255,255,0.15); padding: 12px; border-radius: 8px; margin-bottom: 15px; text-align: center; display: flex; align-items: center; justify-content: center;">
+                <span style="color: white; font-size: 14px;"><strong>{{ user_name }}</strong></span>
+                <div style="margin-left: 15px;">
+                    <a href="{{ url_for('auth_logout') }}" style="background: rgba(220,53,69,0.9); color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px; margin-right: 8px;">Salir</a>
+                    <a href="{{ url_for('search_page') }}" style="background: rgba(40,167,69,0.9); color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px;">Nueva Busqueda</a>
+                </div>
+            </div>
+            
+            <h1 style="color: white; text-align: center; margin-bottom: 8px;">Resultados: "{{ query }}"</h1>
+            <p style="text-align: center; color: rgba(255,255,255,0.9); margin-bottom: 25px;">Busqueda completada</p>
+            
+            {% if prices %}
+                <div style="background: #e8f5e8; border: 1px solid #4caf50; padding: 15px; border-radius: 8px; margin-bottom: 20px;">
+                    <h3 style="color: #2e7d32; margin-bottom: 8px;">Resultados de búsqueda ({{ search_type_text.get(search_type, search_type) }})</h3>
+                    <p><strong>{{ products|length }} productos encontrados</strong></p>
+                    <p><strong>Mejor precio: ${{ '%.2f'|format(prices|min) }}</strong></p>
+                    <p><strong>Precio promedio: ${{ '%.2f'|format((prices|sum) / (prices|length)) }}</strong></p>
+                </div>
+            {% endif %}
+            {% for product in products if product %}
+            {{ product_card(product, loop.index0) }}
+            {% endfor %}
+        </div>
+{% endblock %}"""
+
+AUTH_LOGIN_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="es">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Iniciar Sesion | Price Finder USA</title>
+    <link rel="stylesheet" href="{{ asset_url('auth.css') }}">
+</head>
+<body>
+    <div class="auth-container">
+        <div class="form-header">
+            <h1>Price Finder USA</h1>
+            <p>Iniciar Sesion</p>
+        </div>
+        {% with messages = flashes %}
+            {% if messages %}
+                <ul class="flash-messages">
+                    {% for category, message in messages %}
+                        <li class="flash {{ category }}">{{ message }}</li>
+                    {% endfor %}
+                </ul>
+            {% endif %}
+        {% endwith %}
+        <div class="form-body">
+            <form action="{{ url_for('auth_login') }}" method="post">
+                <div class="input-group">
+                    <label for="email">Correo Electronico</label>
+                    <input type="email" name="email" id="email" required>
+                </div>
+                <div class="input-group">
+                    <label for="password">Contraseña</label>
+                    <input type="password" name="password" id="password" required>
+                </div>
+                <button type="submit" class="submit-btn">Entrar</button>
+            </form>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+TEMPLATES = {
+    'base.html': BASE_TEMPLATE,
+    'search.html': SEARCH_TEMPLATE,
+    'results.html': RESULTS_TEMPLATE,
+    'auth_login.html': AUTH_LOGIN_TEMPLATE,
+}
+app.jinja_env.loader = ChoiceLoader([app.jinja_env.loader, DictLoader(TEMPLATES)])
+for template_name in TEMPLATES:
+    app.jinja_env.get_template(template_name)
+
+@app.context_processor
+def inject_asset_url():
+    return {'asset_url': lambda name: url_for('static_asset', name=name, v=ASSET_VERSIONS[name])}
+
+def render_streamed(template_name, **context):
+    """Renderiza una plantilla precompilada en streaming.
+    
+    Los mensajes flash se leen antes de empezar a enviar el cuerpo: la cookie
+    de sesión ya está escrita cuando el template se evalúa.
+    """
+    context['flashes'] = get_flashed_messages(with_categories=True)
+    return Response(_timed_stream(stream_template(template_name, **context)), mimetype='text/html')
+
+def _timed_stream(chunks):
+    # El render ocurre mientras se consume el stream: se mide hasta agotarlo
+    start = time.perf_counter()
+    yield from chunks
+    PHASE_LATENCY.observe(time.perf_counter() - start, phase='render_template')
+
+def record_login_result(client_ip, email, result):
+    # Los errores de conexión o configuración no cuentan como credenciales fallidas
+    if result['success'] or result['error_code'] in ('INVALID_CREDENTIALS', 'TOO_MANY_ATTEMPTS'):
+        login_throttle.record_result(client_ip, email, result['success'])
+
+# Routes
+@app.route('/auth/login-page')
+def auth_login_page():
+    return render_streamed('auth_login.html')
+
+@app.route('/auth/login', methods=['POST'])
+def auth_login():
+    email = request.form.get('email', '').strip()
+    password = request.form.get('password', '').strip()
+    
+    if not email or not password:
+        flash('Por favor completa todos los campos.', 'danger')
+        return redirect(url_for('auth_login_page'))
+    
+    email_hash = hashlib.sha256(email.lower().encode('utf-8')).hexdigest()[:12]
+    client_ip = request.remote_addr or 'unknown'
+    # Se rechaza antes de llamar a Firebase para no ocupar el worker ni gastar cuota
+    retry_after = login_throttle.attempt(client_ip, email)
+    if retry_after:
+        log.warning('Login limitado', email_hash=email_hash, retry_after=round(retry_after, 1))
+        flash(f'Demasiados intentos. Intenta de nuevo en {int(retry_after) + 1} segundos.', 'danger')
+        return render_streamed('auth_login.html'), 429, {'Retry-After': str(int(retry_after) + 1)}
+    
+    log.info('Intento de login', email_hash=email_hash)
+    result = firebase_auth.login_user(email, password)
+    record_login_result(client_ip, email, result)
+    
+    if result['success']:
+        firebase_auth.set_user_session(result['user_data'])
+        flash(result['message'], 'success')
+        log.info('Login correcto', user=result['user_data']['user_id'])
+        return redirect(url_for('index'))
+    else:
+        flash(result['message'], 'danger')
+        log.warning('Login fallido', email_hash=email_hash, error_code=result['error_code'])
+        return redirect(url_for('auth_login_page'))
+
+@app.route('/auth/logout')
+def auth_logout():
+    firebase_auth.clear_user_session()
+    flash('Has cerrado la sesion correctamente.', 'success')
+    return redirect(url_for('auth_login_page'))
+
+@app.route('/')
+def index():
+    if not firebase_auth.is_user_logged_in():
+        return redirect(url_for('auth_login_page'))
+    return redirect(url_for('search_page'))
+
+@app.route('/search')
+@login_required
+def search_page():
+    current_user = firebase_auth.get_current_user()
+    user_name = current_user['user_name'] if current_user else 'Usuario'
+    
+    # Verificar si búsqueda por imagen está disponible
+    image_search_available = GEMINI_READY and PIL_AVAILABLE
+    
+    return render_streamed('search.html', title='Busqueda', user_name=user_name, image_search_available=image_search_available,
+                           image_max_side=IMAGE_MAX_SIDE)
+
+def parse_search_input(form, files):
+    """Lee consulta e imagen de un formulario; devuelve (query, imagen, tipo, mensaje_error)"""
+    query = form.get('query', '').strip() if form.get('query') else None
+    # image_compact: imagen reducida en el navegador; image_file: el archivo original (navegadores sin canvas)
+    compact_file = files.get('image_compact')
+    compact = bool(compact_file and compact_file.filename)
+    image_file = compact_file if compact else files.get('image_file')
+    
+    # Procesar imagen si existe (una sola decodificación, desde el stream de subida)
+    image_content = None
+    if image_file and image_file.filename != '':
+        if not (GEMINI_READY and PIL_AVAILABLE):
+            log.warning('Imagen proporcionada pero Gemini no está configurado')
+            if not query:
+                return None, None, None, 'La búsqueda por imagen no está disponible'
+        else:
+            try:
+                image_content, image_error = prepare_uploaded_image(image_file, compact)
+            except Exception as e:
+                log.error('Error al leer imagen', error=str(e))
+                return None, None, None, 'Error al procesar la imagen'
+            if image_error and not query:
+                return None, None, None, image_error
+    
+    # Validar que hay al menos una entrada
+    if not query and not image_content:
+        return None, None, None, 'Debe proporcionar una consulta o una imagen'
+    
+    # Limitar longitud de query
+    if query and len(query) > 80:
+        query = query[:80]
     
-    return render_template_string(render_page('Busqueda', content))
+    search_type = "imagen" if image_content and not query else "texto+imagen" if image_content and query else "texto"
+    return query, image_content, search_type, None
+
+def parse_search_request():
+    """Lee consulta e imagen de la petición; devuelve (query, imagen, tipo, respuesta_error)"""
+    query, image_content, search_type, error = parse_search_input(request.form, request.files)
+    if error:
+        return None, None, None, (jsonify({'success': False, 'error': error}), 400)
+    return query, image_content, search_type, None
+
+def store_last_search(query, products, search_type, result_id=None, sess=None):
+    """Guarda los resultados en el servidor y deja solo su ID en la sesión"""
+    sess = session if sess is None else sess
+    sess['last_search_id'] = result_store.put(sess.get('user_id'), {
+        'query': query or "búsqueda por imagen",
+        'products': products,
+        'timestamp': datetime.now().isoformat(),
+        'user': sess.get('user_email', 'Unknown'),
+        'search_type': search_type
+    }, result_id)
 
 @app.route('/api/search', methods=['POST'])
 @login_required
 def api_search():
     try:
-        # Obtener parámetros
-        query = request.form.get('query', '').strip() if request.form.get('query') else None
-        image_file = request.files.get('image_file')
-        
-        # Procesar imagen si existe
-        image_content = None
-        if image_file and image_file.filename != '':
-            try:
-                image_content = image_file.read()
-                print(f"📷 Imagen recibida: {len(image_content)} bytes")
-                
-                # Validar tamaño (máximo 10MB)
-                if len(image_content) > 10 * 1024 * 1024:
-                    return jsonify({'success': False, 'error': 'La imagen es demasiado grande (máximo 10MB)'}), 400
-                    
-            except Exception as e:
-                print(f"❌ Error al leer imagen: {e}")
-                return jsonify({'success': False, 'error': 'Error al procesar la imagen'}), 400
-        
-        # Validar que hay al menos una entrada
-        if not query and not image_content:
-            return jsonify({'success': False, 'error': 'Debe proporcionar una consulta o una imagen'}), 400
+        query, image_content, search_type, error_response = parse_search_request()
+        if error_response:
+            return error_response
         
-        # Limitar longitud de query
-        if query and len(query) > 80:
-            query = query[:80]
-        
-        user_email = session.get('user_email', 'Unknown')
-        search_type = "imagen" if image_content and not query else "texto+imagen" if image_content and query else "texto"
-        print(f"Search request from {user_email}: {search_type}")
+        log.info('Solicitud de búsqueda', sample=LOG_SAMPLE_RATE, search_type=search_type)
         
         # Realizar búsqueda con soporte para imagen
-        products = price_finder.search_products(query=query, image_content=image_content)
-        
-        session['last_search'] = {
-            'query': query or "búsqueda por imagen",
-            'products': products,
-            'timestamp': datetime.now().isoformat(),
-            'user': user_email,
-            'search_type': search_type
-        }
+        products = price_finder.search_products(query=query, image_content=image_content, user_id=session.get('user_id'))
+        store_last_search(query, products, search_type)
         
-        print(f"Search completed for {user_email}: {len(products)} products found")
+        log.info('Búsqueda completada', sample=LOG_SAMPLE_RATE, results=len(products))
         return jsonify({'success': True, 'products': products, 'total': len(products)})
         
     except Exception as e:
-        print(f"Search error: {e}")
+        log.error('Error en búsqueda', error=str(e))
         try:
             query = request.form.get('query', 'producto') if request.form.get('query') else 'producto'
             fallback = price_finder._get_examples(query)
-            session['last_search'] = {'query': str(query), 'products': fallback, 'timestamp': datetime.now().isoformat()}
+            store_last_search(str(query), fallback, 'texto')
             return jsonify({'success': True, 'products': fallback, 'total': len(fallback)})
         except:
             return jsonify({'success': False, 'error': 'Error interno del servidor'}), 500
 
+def parse_batch_request():
+    """Lee un lote de consultas (JSON o multipart); devuelve (items, respuesta_error).
+    
+    JSON: {"queries": ["a", "b"]}. Multipart: campo queries (array JSON o una
+    consulta por línea) y archivos images. Cada item es (etiqueta, query, imagen).
+    """
+    if request.is_json:
+        queries = (request.get_json(silent=True) or {}).get('queries')
+    else:
+        raw = request.form.get('queries', '')
+        try:
+            queries = json.loads(raw) if raw.lstrip().startswith('[') else raw.splitlines()
+        except ValueError:
+            queries = None
+    if not isinstance(queries, list):
+        return None, (jsonify({'success': False, 'error': 'queries debe ser una lista'}), 400)
+    
+    items = [(str(q)[:80].strip(), str(q)[:80].strip(), None) for q in queries if isinstance(q, (str, int, float))]
+    images = request.files.getlist('images')
+    if len(items) + len(images) > SEARCH_BATCH_MAX_ITEMS:
+        return None, (jsonify({'success': False, 'error': f'Máximo {SEARCH_BATCH_MAX_ITEMS} consultas por lote'}), 413)
+    if images and not (GEMINI_READY and PIL_AVAILABLE):
+        return None, (jsonify({'success': False, 'error': 'La búsqueda por imagen no está disponible'}), 400)
+    for image_file in images:
+        prepared, image_error = prepare_uploaded_image(image_file)
+        if image_error:
+            return None, (jsonify({'success': False, 'error': f'{image_file.filename}: {image_error}'}), 400)
+        items.append((image_file.filename or 'imagen', None, prepared))
+    
+    items = [item for item in items if item[1] or item[2]]
+    if not items:
+        return None, (jsonify({'success': False, 'error': 'Debe proporcionar al menos una consulta'}), 400)
+    return items, None
+
+@app.route('/api/search/batch', methods=['POST'])
+@login_required
+def api_search_batch():
+    """Busca muchas consultas en una sola petición y responde en NDJSON por item.
+    
+    Las consultas repetidas se resuelven una sola vez, los aciertos de caché
+    se envían de inmediato y el resto se emite según va terminando.
+    """
+    items, error_response = parse_batch_request()
+    if error_response:
+        return error_response
+    
+    # Deduplicar: texto sin distinguir mayúsculas/espacios, imágenes por contenido
+    groups = OrderedDict()
+    for index, (label, query, image) in enumerate(items):
+        key = ('image', hashlib.sha256(image.jpeg_bytes).hexdigest()) if image else ('text', ' '.join(query.casefold().split()))
+        groups.setdefault(key, []).append((index, label, query, image))
+    log.info('Solicitud de búsqueda por lotes', items=len(items), unique=len(groups))
+    
+    def lines(members, products, cached, error=None):
+        for index, label, _, _ in members:
+            line = {'index': index, 'query': label, 'success': error is None, 'cached': cached,
+                    'products': products, 'total': len(products)}
+            if error:
+                line['error'] = error
+            yield json.dumps(line, ensure_ascii=False) + '\n'
+    
+    user_id = session.get('user_id')
+    
+    def search(members):
+        _, _, query, image = members[0]
+        return price_finder.search_products(query=query, image_content=image, user_id=user_id)
+    
+    def stream():
+        hits, misses = [], []
+        for members in groups.values():
+            image = members[0][3]
+            (hits if image is None and price_finder.is_cached(members[0][2]) else misses).append(members)
+        for members in hits:
+            yield from lines(members, search(members), True)
+        
+        futures = {submit_with_context(batch_executor, search, members): members for members in misses}
+        try:
+            for future in as_completed(futures):
+                members = futures[future]
+                try:
+                    yield from lines(members, future.result(), False)
+                except Exception as e:
+                    log.error('Error en búsqueda del lote', query=members[0][1], error=str(e))
+                    fallback = price_finder._get_examples(members[0][2] or 'producto')
+                    yield from lines(members, fallback, False, 'Error en la búsqueda')
+            yield json.dumps({'done': True, 'items': len(items), 'unique': len(groups), 'cache_hits': len(hits)}) + '\n'
+        finally:
+            # Cliente desconectado: no seguir gastando cuota en consultas pendientes
+            for future in futures:
+                future.cancel()
+    
+    return app.response_class(stream(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+@app.route('/api/search/jobs', methods=['POST'])
+@login_required
+def api_search_job_create():
+    """Encola la búsqueda y responde de inmediato con el ID del job"""
+    query, image_content, search_type, error_response = parse_search_request()
+    if error_response:
+        return error_response
+    
+    log.info('Solicitud de job de búsqueda', sample=LOG_SAMPLE_RATE, search_type=search_type)
+    job_id = search_jobs.submit(session.get('user_id'), query, image_content, {'query': query, 'search_type': search_type})
+    if job_id is None:
+        return jsonify({'success': False, 'error': 'Servidor ocupado, intenta de nuevo en unos segundos'}), 503
+    payload = {
+        'success': True,
+        'job_id': job_id,
+        'status_url': url_for('api_search_job_status', job_id=job_id)
+    }
+    # Con workers síncronos cada conexión SSE ocupa un worker: solo se ofrece si está activado
+    if app.config['SEARCH_JOB_SSE']:
+        payload['events_url'] = url_for('api_search_job_events', job_id=job_id)
+    return jsonify(payload), 202
+
+def _job_for_current_user(job_id):
+    job = search_jobs.get(job_id)
+    if job is None or job['user_id'] != session.get('user_id'):
+        return None
+    return job
+
+@app.route('/api/search/jobs/<job_id>')
+@login_required
+def api_search_job_status(job_id):
+    """Polling del estado; al terminar guarda los resultados para /results"""
+    job = _job_for_current_user(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Búsqueda no encontrada'}), 404
+    done = job['status'] in SearchJobManager.FINISHED
+    if done:
+        store_last_search(job['meta'].get('query'), job['products'], job['meta'].get('search_type', 'texto'), result_id=job_id)
+    return jsonify({
+        'success': True,
+        'status': job['status'],
+        'done': done,
+        'products': job['products'],
+        'total': len(job['products'])
+    })
+
+@app.route('/api/search/jobs/<job_id>/events')
+@login_required
+def api_search_job_events(job_id):
+    """Progreso por Server-Sent Events; solo se anuncia con SEARCH_JOB_SSE
+    activo porque cada conexión abierta ocupa un worker síncrono"""
+    if _job_for_current_user(job_id) is None:
+        return jsonify({'success': False, 'error': 'Búsqueda no encontrada'}), 404
+    
+    def stream():
+        last_update = None
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            job = search_jobs.get(job_id)
+            if job is None:
+                break
+            if job['updated_at'] != last_update:
+                last_update = job['updated_at']
+                payload = {'status': job['status'], 'total': len(job['products'])}
+                yield f"event: {job['status']}\ndata: {json.dumps(payload)}\n\n"
+                if job['status'] in SearchJobManager.FINISHED:
+                    return
+            time.sleep(0.25)
+        yield "event: timeout\ndata: {}\n\n"
+    
+    return app.response_class(stream(), mimetype='text/event-stream', headers={'X-Accel-Buffering': 'no'})
+
+@app.route('/api/suggest')
+@login_required
+def api_suggest():
+    """Sugerencias de búsqueda por prefijo a partir de consultas anteriores"""
+    limit = min(request.args.get('limit', 8, type=int), 20)
+    suggestions = query_suggester.suggest(request.args.get('q', ''), limit)
+    response = jsonify({'success': True, 'suggestions': suggestions})
+    response.headers['Cache-Control'] = 'private, max-age=30'
+    return response
+
 @app.route('/results')
 @login_required
 def results_page():
     try:
-        if 'last_search' not in session:
+        search_data = None
+        if session.get('last_search_id'):
+            search_data = result_store.get(session['last_search_id'], session.get('user_id'))
+        if search_data is None:
             flash('No hay busquedas recientes.', 'warning')
             return redirect(url_for('search_page'))
         
         current_user = firebase_auth.get_current_user()
         user_name = current_user['user_name'] if current_user else 'Usuario'
-        user_name_escaped = html.escape(user_name)
         
-        search_data = session['last_search']
         products = search_data.get('products', [])
-        query = html.escape(str(search_data.get('query', 'busqueda')))
-        search_type = search_data.get('search_type', 'texto')
-        
-        products_html = ""
-        badges = ['MEJOR', '2do', '3ro']
-        colors = ['#4caf50', '#ff9800', '#9c27b0']
+        prices = [p.get('price_numeric', 0) for p in products if p and p.get('price_numeric', 0) > 0]
+        if price_history:
+            # Mínimo de los últimos 30 días por producto (una sola consulta)
+            lowest = price_history.lowest([p.get('title', '') for p in products if p])
+            products = [
+                dict(p, lowest_30d=lowest.get(normalize_title(p.get('title', '')))) if p else p
+                for p in products
+            ]
         
-        for i, product in enumerate(products[:6]):
-            if not product:
-                continue
-            
-            badge = '<div style="position: absolute; top: 8px; right: 8px; background: ' + colors[min(i, 2)] + '; color: white; padding: 4px 8px; border-radius: 12px; font-size: 11px; font-weight: bold;">' + badges[min(i, 2)] + '</div>' if i < 3 else ''
-            
-            # Badge de fuente de búsqueda
-            search_source_badge = ''
-            source = product.get('search_source', '')
-            if source == 'image':
-                search_source_badge = '<div style="position: absolute; top: 8px; left: 8px; background: #673ab7; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">📷 IMAGEN</div>'
-            elif source == 'combined':
-                search_source_badge = '<div style="position: absolute; top: 8px; left: 8px; background: #607d8b; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">🔗 MIXTO</div>'
-            
-            title = html.escape(str(product.get('title', 'Producto')))
-            price = html.escape(str(product.get('price', '$0.00')))
-            source_store = html.escape(str(product.get('source', 'Tienda')))
-            link = html.escape(str(product.get('link', '#')))
-            
-            products_html += '''
-                <div style="border: 1px solid #ddd; border-radius: 8px; padding: 15px; margin-bottom: 15px; background: white; position: relative; box-shadow: 0 2px 4px rgba(0,0,0,0.08);">
-                    ''' + badge + '''
-                    ''' + search_source_badge + '''
-                    <h3 style="color: #1a73e8; margin-bottom: 8px; font-size: 16px; margin-top: ''' + ('20px' if search_source_badge else '0') + ';">''' + title + '''</h3>
-                    <div style="font-size: 28px; color: #2e7d32; font-weight: bold; margin: 12px 0;">''' + price + ''' <span style="font-size: 12px; color: #666;">USD</span></div>
-                    <p style="color: #666; margin-bottom: 12px; font-size: 14px;">Tienda: ''' + source_store + '''</p>
-                    <a href="''' + link + '''" target="_blank" rel="noopener noreferrer" style="background: #1a73e8; color: white; padding: 10px 16px; text-decoration: none; border-radius: 6px; font-weight: 600; display: inline-block; font-size: 14px;">Ver Producto</a>
-                </div>'''
-        
-        prices = [p.get('price_numeric', 0) for p in products if p.get('price_numeric', 0) > 0]
-        stats = ""
-        if prices:
-            min_price = min(prices)
-            avg_price = sum(prices) / len(prices)
-            search_type_text = {"texto": "texto", "imagen": "imagen IA", "texto+imagen": "texto + imagen IA", "combined": "búsqueda mixta"}.get(search_type, search_type)
-            stats = '''
-                <div style="background: #e8f5e8; border: 1px solid #4caf50; padding: 15px; border-radius: 8px; margin-bottom: 20px;">
-                    <h3 style="color: #2e7d32; margin-bottom: 8px;">Resultados de búsqueda (''' + search_type_text + ''')</h3>
-                    <p><strong>''' + str(len(products)) + ''' productos encontrados</strong></p>
-                    <p><strong>Mejor precio: $''' + f'{min_price:.2f}' + '''</strong></p>
-                    <p><strong>Precio promedio: $''' + f'{avg_price:.2f}' + '''</strong></p>
-                </div>'''
-        
-        content = '''
-        <div style="max-width: 800px; margin: 0 auto;">
-            <div style="background: rgba(255,255,255,0.15); padding: 12px; border-radius: 8px; margin-bottom: 15px; text-align: center; display: flex; align-items: center; justify-content: center;">
-                <span style="color: white; font-size: 14px;"><strong>''' + user_name_escaped + '''</strong></span>
-                <div style="margin-left: 15px;">
-                    <a href="''' + url_for('auth_logout') + '''" style="background: rgba(220,53,69,0.9); color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px; margin-right: 8px;">Salir</a>
-                    <a href="''' + url_for('search_page') + '''" style="background: rgba(40,167,69,0.9); color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px;">Nueva Busqueda</a>
-                </div>
-            </div>
-            
-            <h1 style="color: white; text-align: center; margin-bottom: 8px;">Resultados: "''' + query + '''"</h1>
-            <p style="text-align: center; color: rgba(255,255,255,0.9); margin-bottom: 25px;">Busqueda completada</p>
-            
-            ''' + stats + '''
-            ''' + products_html + '''
-        </div>'''
-        
-        return render_template_string(render_page('Resultados - Price Finder USA', content))
+        return render_streamed(
+            'results.html',
+            title='Resultados - Price Finder USA',
+            user_name=user_name,
+            query=str(search_data.get('query', 'busqueda')),
+            search_type=search_data.get('search_type', 'texto'),
+            products=products,
+            prices=prices
+        )
     except Exception as e:
-        print(f"Results page error: {e}")
+        log.error('Error en página de resultados', error=str(e))
         flash('Error al mostrar resultados.', 'danger')
         return redirect(url_for('search_page'))
 
+def _cache_gauges():
+    values = {}
+    caches = [('search', price_finder.cache.stats())]
+    if image_query_cache:
+        caches.append(('image_query', image_query_cache.stats()))
+    for name, stats in caches:
+        for field in ('hits', 'stale_hits', 'negative_hits', 'misses', 'evictions', 'hit_ratio'):
+            if field in stats:
+                values[(('cache', name), ('field', field))] = stats[field]
+    return values
+
+metrics.register(Gauge('pricefinder_cache', 'Estadísticas de las cachés (aciertos, fallos, expulsiones, ratio)', callback=_cache_gauges))
+metrics.register(Gauge('pricefinder_search_jobs_pending', 'Jobs de búsqueda en cola o en ejecución',
+                       callback=lambda: {(): search_jobs.stats()['pending']}))
+metrics.register(Gauge('pricefinder_single_flight_in_flight', 'Búsquedas a SerpAPI en curso (una por clave)',
+                       callback=lambda: {(): price_finder.single_flight.stats()['in_flight']}))
+metrics.register(Gauge('pricefinder_serpapi_rate_limiter', 'Peticiones retrasadas o rechazadas por el limitador de SerpAPI',
+                       callback=lambda: {(('outcome', k),): v for k, v in price_finder.rate_limiter.stats().items() if k in ('acquired', 'delayed', 'rejected')}))
+metrics.register(Gauge('pricefinder_login_throttle_tracked_keys', 'Claves (IP/email) con estado en el limitador de login',
+                       callback=lambda: {(): login_throttle.stats()['tracked_keys']}))
+metrics.register(Gauge('pricefinder_gemini_queue', 'Llamadas a Gemini en curso y en cola',
+                       callback=lambda: {(('state', k),): v for k, v in gemini_client.stats().items() if k in ('in_flight', 'queued')} if gemini_client else {}))
+CIRCUIT_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+metrics.register(Gauge('pricefinder_serpapi_circuit_state', 'Estado del circuit breaker de SerpAPI (0 cerrado, 1 semiabierto, 2 abierto)',
+                       callback=lambda: {(): CIRCUIT_STATES[price_finder.circuit_breaker.stats()['state']]}))
+
+# /metrics expone tráfico y estado interno: solo IPs permitidas o quien envíe METRICS_TOKEN
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = frozenset(
+    ip.strip() for ip in os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip.strip()
+)
+
+def metrics_allowed():
+    if METRICS_TOKEN:
+        expected = f'Bearer {METRICS_TOKEN}'.encode('utf-8')
+        if hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'), expected):
+            return True
+    return request.remote_addr in METRICS_ALLOWED_IPS
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics_allowed():
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/health')
 def health_check():
     try:
@@ -907,34 +4248,89 @@ def health_check():
             'status': 'OK', 
             'timestamp': datetime.now().isoformat(),
             'firebase_auth': 'enabled' if firebase_auth.firebase_web_api_key else 'disabled',
+            'firebase_token_verifier': firebase_auth.token_verifier.stats() if firebase_auth.token_verifier else None,
+            'login_throttle': login_throttle.stats(),
             'serpapi': 'enabled' if price_finder.is_api_configured() else 'disabled',
             'gemini_vision': 'enabled' if GEMINI_READY else 'disabled',
-            'pil_available': 'enabled' if PIL_AVAILABLE else 'disabled'
+            'gemini_client': gemini_client.stats() if gemini_client else None,
+            'pil_available': 'enabled' if PIL_AVAILABLE else 'disabled',
+            'search_cache': price_finder.cache.stats(),
+            'query_index': price_finder.query_index.stats() if price_finder.query_index else None,
+            'query_suggester': query_suggester.stats(),
+            'serpapi_rate_limiter': price_finder.rate_limiter.stats(),
+            'serpapi_circuit_breaker': price_finder.circuit_breaker.stats(),
+            'http_pools': http_client.stats(),
+            'image_query_cache': image_query_cache.stats() if image_query_cache else None,
+            'price_history': price_history.stats() if price_history else None,
+            'search_jobs': search_jobs.stats()
         })
     except Exception as e:
         return jsonify({'status': 'ERROR', 'message': str(e)}), 500
 
+@app.route('/assets/<name>')
+def static_asset(name):
+    body = STATIC_ASSETS.get(name)
+    if body is None:
+        return not_found(None)
+    etag = ASSET_VERSIONS[name]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='text/css')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 # Middleware
 @app.before_request
-def before_request():
-    if 'timestamp' in session:
+def start_request_metrics():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_start = time.perf_counter()
+    g.request_timings = []
+    request_id_var.set(g.request_id)
+    log_context_var.set({'request_id': g.request_id, 'user': session.get('user_id'), 'path': request.path})
+    request_timings_var.set(g.request_timings)
+    HTTP_IN_FLIGHT.inc()
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    if 'request_start' in g:
+        HTTP_IN_FLIGHT.dec()
+
+def touch_session(sess):
+    """Cierra la sesión tras 20 minutos de inactividad y registra la actividad actual"""
+    if 'timestamp' in sess:
         try:
-            timestamp_str = session['timestamp']
+            timestamp_str = sess['timestamp']
             if isinstance(timestamp_str, str) and len(timestamp_str) > 10:
                 last_activity = datetime.fromisoformat(timestamp_str)
                 time_diff = (datetime.now() - last_activity).total_seconds()
                 if time_diff > 1200:  # 20 minutos
-                    session.clear()
+                    sess.clear()
         except:
-            session.clear()
+            sess.clear()
     
-    session['timestamp'] = datetime.now().isoformat()
+    sess['timestamp'] = datetime.now().isoformat()
+
+@app.before_request
+def before_request():
+    if request.endpoint == 'static_asset':
+        return
+    touch_session(session)
 
 @app.after_request
 def after_request(response):
     response.headers['X-Content-Type-Options'] = 'nosniff'
     response.headers['X-Frame-Options'] = 'DENY'
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    # Assets y sugerencias definen su propia política de caché
+    if request.endpoint not in ('static_asset', 'api_suggest'):
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    if 'request_start' in g:
+        elapsed = time.perf_counter() - g.request_start
+        HTTP_LATENCY.observe(elapsed, endpoint=request.endpoint or 'unknown', status=response.status_code)
+        response.headers['X-Request-ID'] = g.request_id
+        timings = ', '.join(f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in g.request_timings)
+        response.headers['Server-Timing'] = f'{timings}, total;dur={elapsed * 1000:.1f}' if timings else f'total;dur={elapsed * 1000:.1f}'
     return response
 
 # Error handlers
@@ -955,6 +4351,5 @@ if __name__ == '__main__':
     print(f"Puerto: {os.environ.get('PORT', '5000')}")
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), debug=False, threaded=True)
 else:
-    import logging
     logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
     logging.getLogger('werkzeug').setLevel(logging.WARNING)